@@ -0,0 +1,258 @@
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from itertools import accumulate
+from pathlib import Path
+
+import json
+
+__all__ = ['Plan', 'RateTimeline', 'load_tariffs', 'price_session', 'compare_plans']
+
+TARIFFS = Path(__file__).parent / 'tariffs.json'
+
+
+class RateTimeline:
+    """
+    A plan's rates over one year, compiled into sorted intervals.
+
+    Times are minutes since midnight on January 1. Interval i covers [boundaries[i], boundaries[i + 1]) at
+    rates[i] $/kWh. Prefix sums of rate-minutes and peak minutes make pricing any interval two binary searches.
+    days holds each day's (peak_day, peak_rate, offpeak_rate) by day of year (0 = Jan 1), for pricing a day
+    directly without walking the plan's seasons.
+    """
+
+    def __init__(self, year: int, boundaries: list, rates: list, peak: list, days: list):
+        self.year = year
+        self.boundaries = boundaries
+        self.rates = rates
+        self.peak = peak
+        self.days = days
+        spans = [end - start for start, end in zip(boundaries, boundaries[1:])]
+        self.cost_prefix = [0.0] + list(accumulate(rate * span for rate, span in zip(rates, spans)))
+        self.peak_prefix = [0] + list(accumulate(span if is_peak else 0 for is_peak, span in zip(peak, spans)))
+
+    def __repr__(self):
+        return f'RateTimeline({self.year}, {len(self.rates)} intervals)'
+
+    def __len__(self):
+        return self.boundaries[-1]
+
+    def _integral(self, prefix: list, values: list, minute: int):
+        idx = min(bisect_right(self.boundaries, minute), len(values)) - 1
+        return prefix[idx] + values[idx] * (minute - self.boundaries[idx])
+
+    def cost(self, start: int, end: int) -> float:
+        """
+        Sum of the per-minute rates over [start, end).
+        """
+
+        return self._integral(self.cost_prefix, self.rates, end) - self._integral(self.cost_prefix, self.rates, start)
+
+    def peak_minutes(self, start: int, end: int) -> int:
+        return self._integral(self.peak_prefix, self.peak, end) - self._integral(self.peak_prefix, self.peak, start)
+
+    def minute_rates(self, start: int, end: int):
+        """
+        Per-minute rates over [start, end), as a NumPy array.
+        """
+
+        import numpy as np
+
+        first = bisect_right(self.boundaries, start) - 1
+        last = bisect_right(self.boundaries, end - 1)
+        spans = [
+            min(stop, end) - max(begin, start)
+            for begin, stop in zip(self.boundaries[first:last], self.boundaries[first + 1:last + 1])
+        ]
+        return np.repeat(np.asarray(self.rates[first:last], dtype=np.float64), spans)
+
+
+class Plan:
+    """
+    A tariff plan loaded from the tariffs file.
+
+    Rates are the plan's base peak/offpeak rates, replaced by the first season containing the moment being
+    priced. A moment is in a season when it falls strictly between midnight starting the 'after' day and
+    midnight starting the 'before' day (seasons may wrap the new year). Peak hours apply on peak weekdays that
+    are not holidays. Overrides name rate replacements for forced peak/offpeak pricing.
+    """
+
+    def __init__(self, name: str, spec: dict):
+        self.name = name
+        self.description = spec.get('description', '')
+        self.timezone = spec['timezone']
+        self.peak_start, self.peak_end = (time.fromisoformat(hours) for hours in spec['peak_hours'])
+        self.peak_weekdays = frozenset(spec['peak_weekdays'])
+        self.holidays = frozenset(date.fromisoformat(day) for day in spec.get('holidays', ()))
+        self.base_rates = dict(spec['rates'])
+        self.seasons = [
+            (
+                season['name'],
+                tuple(map(int, season['after'].split('-'))),
+                tuple(map(int, season['before'].split('-'))),
+                dict(season['rates']),
+            )
+            for season in spec.get('seasons', ())
+        ]
+        self.overrides = spec.get('overrides', dict())
+        self._timelines = dict()
+
+    def __repr__(self):
+        return f'Plan({self.name})'
+
+    def season(self, moment) -> str:
+        """
+        Name of the season containing a date or naive local datetime, or None for the base rates.
+        """
+
+        if not isinstance(moment, datetime):
+            moment = datetime(moment.year, moment.month, moment.day)
+        for name, after, before, _ in self.seasons:
+            after_dt = datetime(moment.year, *after)
+            before_dt = datetime(moment.year, *before)
+            if after_dt < before_dt:
+                if after_dt < moment < before_dt:
+                    return name
+            elif moment > after_dt or moment < before_dt:
+                return name
+        return None
+
+    def rates(self, moment, force_peak=False, force_offpeak=False) -> tuple:
+        """
+        (peak, offpeak) rates for a date or naive local datetime.
+        """
+
+        season = self.season(moment)
+        rates = dict(self.base_rates)
+        for name, _, _, season_rates in self.seasons:
+            if name == season:
+                rates.update(season_rates)
+                break
+        if force_offpeak:
+            rates.update(self.overrides.get('force_offpeak', dict()))
+        if force_peak:
+            rates.update(self.overrides.get('force_peak', dict()))
+        return rates['peak'], rates['offpeak']
+
+    def is_peak_day(self, day: date) -> bool:
+        return day.weekday() in self.peak_weekdays and day not in self.holidays
+
+    def timeline(self, year: int, force_peak=False, force_offpeak=False) -> RateTimeline:
+        """
+        The compiled rate timeline for a year, built once and cached on the plan.
+        """
+
+        key = (year, bool(force_peak), bool(force_offpeak))
+        if key not in self._timelines:
+            self._timelines[key] = self.compile(year, force_peak, force_offpeak)
+        return self._timelines[key]
+
+    def compile(self, year: int, force_peak=False, force_offpeak=False) -> RateTimeline:
+        peak_start = self.peak_start.hour * 60 + self.peak_start.minute
+        peak_end = self.peak_end.hour * 60 + self.peak_end.minute
+
+        boundaries, rates, peak, days = list(), list(), list(), list()
+
+        def append(minute, rate, is_peak):
+            # Merge with the previous interval when nothing changes
+            if rates and rates[-1] == rate and peak[-1] == is_peak:
+                return
+            boundaries.append(minute)
+            rates.append(rate)
+            peak.append(is_peak)
+
+        day = date(year, 1, 1)
+        minute = 0
+        while day.year == year:
+            peak_rate, offpeak_rate = self.rates(day, force_peak, force_offpeak)
+            days.append((self.is_peak_day(day), peak_rate, offpeak_rate))
+            if days[-1][0] and peak_start < peak_end:
+                append(minute, offpeak_rate, False)
+                append(minute + peak_start, peak_rate, True)
+                append(minute + peak_end, offpeak_rate, False)
+            else:
+                append(minute, offpeak_rate, False)
+            day += timedelta(days=1)
+            minute += 1440
+        boundaries.append(minute)
+
+        return RateTimeline(year, boundaries, rates, peak, days)
+
+
+@lru_cache(maxsize=None)
+def load_tariffs(path=TARIFFS) -> dict:
+    """
+    Load every plan in a tariffs file.
+
+    Returns
+    -------
+    dict
+        Plan name -> Plan
+    """
+
+    with open(path) as json_tariff_file:
+        specs = json.load(json_tariff_file)
+    return {name: Plan(name, spec) for name, spec in specs.items()}
+
+
+def _minute_of_year(moment: datetime) -> int:
+    return (moment - datetime(moment.year, 1, 1)) // timedelta(minutes=1)
+
+
+def price_session(plan: Plan, start: datetime, stop: datetime, force_peak=False, force_offpeak=False) -> tuple:
+    """
+    Price a charging interval of naive local times, which may span days or years.
+
+    Returns
+    -------
+    tuple
+        (charge_time_hr, peak_duration_hr, average_rate)
+    """
+
+    minutes = 0
+    peak_minutes = 0
+    cost = 0.0
+    moment = start
+    while moment < stop:
+        year_end = datetime(moment.year + 1, 1, 1)
+        segment_end = min(stop, year_end)
+        timeline = plan.timeline(moment.year, force_peak, force_offpeak)
+        begin = _minute_of_year(moment)
+        end = _minute_of_year(segment_end) if segment_end < year_end else len(timeline)
+        minutes += end - begin
+        peak_minutes += timeline.peak_minutes(begin, end)
+        cost += timeline.cost(begin, end)
+        moment = segment_end
+
+    average_rate = cost / minutes if minutes else 0.0
+    return minutes / 60, peak_minutes / 60, average_rate
+
+
+def compare_plans(sessions, plans=None, path=TARIFFS) -> dict:
+    """
+    Total cost of a set of charging sessions under each plan.
+
+    Only the TOU-D plan is currently shipped in tariffs.json, so by default this totals a single plan until more
+    plans are added to the file (or another file is passed as path).
+
+    Parameters
+    ----------
+    sessions : Iterable
+        (start, stop, kwh) tuples of naive local times and energy drawn.
+    plans : Iterable
+        Plan names to compare, defaults to every plan in the tariffs file.
+
+    Returns
+    -------
+    dict
+        Plan name -> total cost
+    """
+
+    tariffs = load_tariffs(path)
+    plans = list(plans) if plans else list(tariffs)
+    totals = dict.fromkeys(plans, 0.0)
+    for start, stop, kwh in sessions:
+        for name in plans:
+            _, _, average_rate = price_session(tariffs[name], start, stop)
+            totals[name] += average_rate * kwh
+    return totals
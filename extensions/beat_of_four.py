@@ -1,19 +1,37 @@
 import hikari
 import lightbulb
 import json
-import re
-from random import choice, randint, shuffle
+import math
+import random
+from bisect import bisect_right
+from itertools import accumulate, permutations
 from spellinator.constants import *
 from datetime import datetime
 from pathlib import Path
 
+from extensions.metrics import track_command
 from spellinator.spellinator import list_columns
 
 beat_of_four_plugin = lightbulb.Plugin("Beat-of-Four")
-_syllables = []
+_tables = None
+
+# Names that fit in one embed field
+MAX_NAMES_SHOWN = 20
 
 
 @beat_of_four_plugin.command
+@lightbulb.option(
+    'cursor',
+    'Continue a unique listing from the cursor of a previous page.',
+    type=hikari.OptionType.STRING,
+    default=None,
+)
+@lightbulb.option(
+    'unique',
+    'Only list names that have not been listed before, with a cursor for the next page.',
+    type=hikari.OptionType.BOOLEAN,
+    default=False,
+)
 @lightbulb.option(
     'number',
     'How many names to generate.',
@@ -26,16 +44,12 @@ _syllables = []
 )
 @lightbulb.implements(lightbulb.SlashCommand)
 async def beat_of_four(ctx: lightbulb.Context) -> None:
-    await gen_bof_names(ctx)
+    with track_command('beat-of-four'):
+        await gen_bof_names(ctx)
 
 
 async def gen_bof_names(ctx: lightbulb.Context) -> None:
-    global _syllables
-    beat_of_fours = list()
-    for x in range(ctx.options.number):
-        beat_of_fours.append(gen_beat_of_four(_syllables))
-
-    formatted_bof_names = list_columns(beat_of_fours, 2, True, 6, 20)
+    number = max(1, min(ctx.options.number, MAX_NAMES_SHOWN))
 
     response = hikari.Embed(
         color=color_royalblue,
@@ -44,11 +58,33 @@ async def gen_bof_names(ctx: lightbulb.Context) -> None:
 
     response.description = "Beat-of-Four"
     response.title = None
+
+    tables = get_tables()
+    if ctx.options.unique or ctx.options.cursor:
+        try:
+            beat_of_fours, next_cursor = page_beat_of_four(tables, number, ctx.options.cursor)
+        except ValueError as err:
+            response.add_field(name='Error', value=str(err), inline=True)
+            await ctx.respond(response)
+            return
+        response.add_field(name='Possible Names', value=f'{len(tables):,}', inline=True)
+        response.add_field(name='Next Cursor', value=f'`{next_cursor}`' if next_cursor else 'None', inline=True)
+    else:
+        beat_of_fours = gen_beat_of_four_batch(tables, number)
+
+    formatted_bof_names = list_columns(beat_of_fours, 2, True, 6, max_chars=embed_field_limit - 6)
+
     response.add_field(
         name="List of Beat-of-Four Names",
         value=f'```{formatted_bof_names}```',
-        inline=True
+        inline=False
     )
+    if ctx.options.number > MAX_NAMES_SHOWN:
+        response.add_field(
+            name='Note',
+            value=f'Only {MAX_NAMES_SHOWN} names fit in one message, use unique with the cursor for more.',
+            inline=False
+        )
     response.set_footer(
         text=f"Requested by {ctx.member.display_name}",
         icon=ctx.member.avatar_url or ctx.member.default_avatar_url,
@@ -57,41 +93,282 @@ async def gen_bof_names(ctx: lightbulb.Context) -> None:
     await ctx.respond(response)
 
 
-def gen_beat_of_four(syllables):
-    joined = ''
+class BeatOfFourTables:
+    """
+    Precomputed syllable compatibility tables for sampling Beat-of-Four names without rejection.
+
+    A name is two to five syllables in one of the compositions below, chosen uniformly, shuffled into a
+    pattern of syllable types. A name is valid when it does not start with 'y', does not end in a vowel and has
+    no doubled letter once capitalized. Doubles can only appear inside a syllable or at a join, so validity is a
+    chain over (previous syllable's last letter, syllable). Counting valid completions from the back of each
+    pattern lets names be drawn uniformly from the valid ones directly, exactly as the old retry loop did.
+    """
+
+    vowels = ('a', 'e', 'i', 'o', 'u')
+    # (two-letter syllables, three-letter syllables), each chosen with equal probability
+    compositions = ((2, 2), (3, 1), (4, 0), (5, 0))
+
+    def __init__(self, syllables):
+        self.syllables = [sorted(set(kind)) for kind in syllables]
+
+        # Syllables allowed in the first, a middle or the last position, per syllable type
+        self.allowed = dict()
+        for kind, options in enumerate(self.syllables):
+            # Capitalizing hides a double in the first two letters of the first syllable
+            self.allowed['first', kind] = [
+                syl for syl in options if syl[0] != 'y' and not self.has_double(syl[1:])
+            ]
+            self.allowed['middle', kind] = [syl for syl in options if not self.has_double(syl)]
+            self.allowed['last', kind] = [
+                syl for syl in options if syl[-1] not in self.vowels and not self.has_double(syl)
+            ]
+
+        # Every type pattern per composition, with its number of valid names
+        self.patterns = dict()
+        # (pattern, position, previous last letter) -> (candidate syllables, cumulative completion counts)
+        self.choices = dict()
+        for composition in self.compositions:
+            patterns = sorted(set(permutations([0] * composition[0] + [1] * composition[1])))
+            counts = [self.compile(pattern) for pattern in patterns]
+            viable = [(pattern, count) for pattern, count in zip(patterns, counts) if count]
+            self.patterns[composition] = (
+                [pattern for pattern, _ in viable],
+                list(accumulate(count for _, count in viable)),
+            )
+
+        # Index over every valid name: patterns in a fixed order with the cumulative name counts
+        self.index_patterns = [pattern for composition in self.compositions
+                               for pattern in self.patterns[composition][0]]
+        self.index_ends = list(accumulate(self.choices[pattern, 0, None][1][-1]
+                                          for pattern in self.index_patterns))
+
+    def __len__(self):
+        return self.index_ends[-1] if self.index_ends else 0
+
+    @staticmethod
+    def has_double(text: str) -> bool:
+        return any(a == b for a, b in zip(text, text[1:]))
+
+    def role(self, pattern: tuple, position: int) -> str:
+        if position == 0:
+            return 'first'
+        return 'last' if position == len(pattern) - 1 else 'middle'
+
+    def compile(self, pattern: tuple) -> int:
+        """
+        Build the sampling tables for one type pattern, returning its number of valid names.
+        """
+
+        # Valid completions of positions after the current one, keyed by the current syllable's last letter
+        completions = None
+        for position in range(len(pattern) - 1, -1, -1):
+            candidates = self.allowed[self.role(pattern, position), pattern[position]]
+            weights = [completions[syl[-1]] if completions else 1 for syl in candidates]
+            previous = {None} if position == 0 else {syl[-1] for syl in self.syllables[0] + self.syllables[1]}
+            totals = dict()
+            for prev in previous:
+                options = [(syl, weight) for syl, weight in zip(candidates, weights) if weight and syl[0] != prev]
+                cum_weights = list(accumulate(weight for _, weight in options))
+                self.choices[pattern, position, prev] = ([syl for syl, _ in options], cum_weights)
+                totals[prev] = cum_weights[-1] if cum_weights else 0
+            completions = totals
+
+        return completions[None]
+
+    def sample(self, rng=random) -> str:
+        composition = rng.choice(self.compositions)
+        patterns, cum_counts = self.patterns[composition]
+        if not patterns:
+            raise ValueError(f'No valid Beat-of-Four names with composition {composition}')
+        pattern = rng.choices(patterns, cum_weights=cum_counts)[0]
+
+        names = []
+        prev = None
+        for position in range(len(pattern)):
+            candidates, cum_weights = self.choices[pattern, position, prev]
+            syllable = rng.choices(candidates, cum_weights=cum_weights)[0]
+            names.append(syllable)
+            prev = syllable[-1]
+
+        return ''.join(names).capitalize()
+
+    def name(self, index: int) -> str:
+        """
+        Return the name at a position in the index over all valid names, 0 <= index < len(self).
+        """
+
+        if not 0 <= index < len(self):
+            raise IndexError(f'Name index {index} out of range')
+        slot = bisect_right(self.index_ends, index)
+        pattern = self.index_patterns[slot]
+        rank = index - (self.index_ends[slot - 1] if slot else 0)
+
+        names = []
+        prev = None
+        for position in range(len(pattern)):
+            candidates, cum_weights = self.choices[pattern, position, prev]
+            pick = bisect_right(cum_weights, rank)
+            rank -= cum_weights[pick - 1] if pick else 0
+            names.append(candidates[pick])
+            prev = candidates[pick][-1]
+
+        return ''.join(names).capitalize()
+
+    def indices(self, name: str) -> list:
+        """
+        Return every index whose syllable sequence spells name, the inverse of name().
+        """
+
+        name = name.lower()
+        found = []
+        for slot, pattern in enumerate(self.index_patterns):
+            # Walk the name's splits into the pattern's syllables, summing the ranks name() would subtract
+            stack = [(0, 0, None, self.index_ends[slot - 1] if slot else 0)]
+            while stack:
+                position, start, prev, index = stack.pop()
+                if position == len(pattern):
+                    if start == len(name):
+                        found.append(index)
+                    continue
+                candidates, cum_weights = self.choices[pattern, position, prev]
+                for pick, syllable in enumerate(candidates):
+                    if name.startswith(syllable, start):
+                        stack.append((position + 1, start + len(syllable), syllable[-1],
+                                      index + (cum_weights[pick - 1] if pick else 0)))
+
+        return found
+
+
+def gen_beat_of_four(tables: BeatOfFourTables):
+    return tables.sample()
+
+
+def gen_beat_of_four_batch(tables: BeatOfFourTables, count: int, rng=random):
+    """
+    Generate count Beat-of-Four names in one call.
+    """
+
+    sample = tables.sample
+    return [sample(rng) for _ in range(count)]
+
+
+def gen_unique_beat_of_four(tables: BeatOfFourTables, count: int, rng=random):
+    """
+    Generate up to count distinct names, drawn uniformly from the whole name space without replacement.
+    """
+
+    names = dict()
+    size = len(tables)
+    visited = set()
+    fresh = True
+    # Different syllable sequences can spell the same name, so top up until enough distinct names are found or
+    # every sequence has been visited. Each pass visits at least one new sequence, so the loop always ends.
+    while len(names) < count and len(visited) < size:
+        wanted = count - len(names)
+        remaining = size - len(visited)
+        if remaining <= max(len(visited), 2 * wanted):
+            # Listing the unvisited sequences costs no more than the ones visited or wanted
+            batch = rng.sample([index for index in range(size) if index not in visited], remaining)
+        elif fresh:
+            batch = rng.sample(range(size), wanted)
+        else:
+            # The last draw found none new, but most sequences are unvisited, so rejection finds one quickly
+            index = rng.randrange(size)
+            while index in visited:
+                index = rng.randrange(size)
+            batch = [index]
+        fresh = False
+        for index in batch:
+            if index in visited:
+                continue
+            visited.add(index)
+            fresh = True
+            names.setdefault(tables.name(index), None)
+            if len(names) >= count:
+                break
+
+    return list(names)
+
+
+def _permutation(tables: BeatOfFourTables, seed: int):
+    """
+    Return (a, b) for the affine permutation index -> (a * index + b) % len(tables) selected by seed.
+    """
+
+    size = len(tables)
+    rng = random.Random(seed)
+    multiplier = rng.randrange(1, size) if size > 1 else 1
+    while math.gcd(multiplier, size) != 1:
+        multiplier = rng.randrange(1, size)
+    return multiplier, rng.randrange(size)
+
+
+def page_beat_of_four(tables: BeatOfFourTables, count: int, cursor: str = None):
+    """
+    Page through the name space in a shuffled order that never repeats a name.
+
+    Parameters
+    ----------
+    tables : BeatOfFourTables
+        The compiled syllable tables.
+    count : int
+        Names to return in this page.
+    cursor : str
+        Cursor returned by the previous page, or None to start a new shuffled order.
+
+    Returns
+    -------
+    tuple
+        (names, next_cursor). next_cursor is None once the whole space has been visited.
+    """
+
+    if cursor:
+        try:
+            seed, offset = (int(part, 36) for part in cursor.split('-'))
+        except ValueError:
+            raise ValueError(f'Invalid cursor {cursor!r}')
+    else:
+        seed, offset = random.getrandbits(32), 0
 
-    two_beat = syllables[0]
-    three_beat = syllables[1]
+    size = len(tables)
+    multiplier, shift = _permutation(tables, seed)
+    names = []
+    while len(names) < count and offset < size:
+        index = (multiplier * offset + shift) % size
+        name = tables.name(index)
+        # A name spelled by several sequences is only listed at its lowest index, so it is never on two pages
+        if min(tables.indices(name)) == index:
+            names.append(name)
+        offset += 1
 
-    twos = randint(2, 5)
-    threes = 4 - twos
-    retry = True
+    next_cursor = f'{_base36(seed)}-{_base36(offset)}' if offset < size else None
+    return names, next_cursor
 
-    while retry:
-        beat_of_four_str = []
-        for x in range(twos):
-            beat_of_four_str.append(choice(two_beat))
 
-        for x in range(threes):
-            beat_of_four_str.append(choice(three_beat))
+def _base36(number: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    encoded = ''
+    while True:
+        number, digit = divmod(number, 36)
+        encoded = digits[digit] + encoded
+        if not number:
+            return encoded
 
-        shuffle(beat_of_four_str)
-        if beat_of_four_str[-1][-1] not in ['a', 'e', 'i', 'o', 'u']:
-            if beat_of_four_str[0][0] not in ['y']:
-                retry = False
 
-        joined = ''.join(beat_of_four_str).capitalize()
-        if re.search(r'((\w)\2)+', joined):
-            retry = True
+def get_tables() -> BeatOfFourTables:
+    """
+    The compiled syllable tables, loaded on first use rather than at bot startup.
+    """
 
-    return joined
+    global _tables
+    if _tables is None:
+        syllables_path = Path('spellinator/en/', 'syllables.json')
+        with open(syllables_path, 'r') as json_syllable_file:
+            _tables = BeatOfFourTables(json.load(json_syllable_file))
+    return _tables
 
 
 def load(bot: lightbulb.BotApp) -> None:
-    global _syllables
-    syllables_path = Path('spellinator/en/', 'syllables.json')
-    with open(syllables_path, 'r') as json_syllable_file:
-        _syllables = json.load(json_syllable_file)
     bot.add_plugin(beat_of_four_plugin)
 
 
@@ -1,12 +1,22 @@
 from datetime import datetime, time, timedelta
+from functools import lru_cache
+import math
 
 import hikari
 import lightbulb
 from pytz import timezone
 
+from extensions.metrics import track_command
 from spellinator.constants import *
+from extensions._tariffs import load_tariffs
 
 BZ4X_BATT = 66.6
+BZ4X_CHARGER_KW = 6.6
+
+DEFAULT_PLAN = 'TOU-D'
+
+# Longest horizon the charging window searches, the price timeline holds one entry per minute of it
+MAX_WINDOW_HOURS = 7 * 24
 
 energy_cost_plugin = lightbulb.Plugin("eCost")
 
@@ -70,7 +80,62 @@ energy_cost_plugin = lightbulb.Plugin("eCost")
 )
 @lightbulb.implements(lightbulb.SlashCommand)
 async def energy_cost(ctx: lightbulb.Context) -> None:
-    await ecost(ctx)
+    with track_command('ecost'):
+        await ecost(ctx)
+
+
+@energy_cost_plugin.command
+@lightbulb.option(
+    'isoc',
+    'State of Charge Start',
+    type=hikari.OptionType.INTEGER,
+)
+@lightbulb.option(
+    'esoc',
+    "Ending State of Charge",
+    type=hikari.OptionType.INTEGER,
+)
+@lightbulb.option(
+    'power',
+    'Charger power in kW',
+    default=BZ4X_CHARGER_KW,
+    type=hikari.OptionType.FLOAT,
+    min_value=0.1,
+)
+@lightbulb.option(
+    'hours',
+    'Hours from now the charge must be finished within',
+    default=24,
+    type=hikari.OptionType.INTEGER,
+    min_value=1,
+    max_value=MAX_WINDOW_HOURS,
+)
+@lightbulb.option(
+    'split',
+    'Allow splitting the charge into several sessions',
+    default=True,
+    type=hikari.OptionType.BOOLEAN,
+)
+@lightbulb.option(
+    'efficiency',
+    'Charging efficiency: batt_rx / pwr_delivered',
+    default=0.90,
+    type=hikari.OptionType.FLOAT,
+)
+@lightbulb.option(
+    'capacity',
+    'Battery capacity of EV @ 100%',
+    default=BZ4X_BATT,
+    type=hikari.OptionType.FLOAT,
+)
+@lightbulb.command(
+    "ecost-window",
+    "Cheapest time to charge",
+)
+@lightbulb.implements(lightbulb.SlashCommand)
+async def energy_cost_window(ctx: lightbulb.Context) -> None:
+    with track_command('ecost-window'):
+        await ecost_window(ctx)
 
 
 def ecost_calculator(
@@ -82,87 +147,294 @@ def ecost_calculator(
         today_ovrd=None,
         efficiency=0.90,
         battery_capacity=BZ4X_BATT,
+        plan=DEFAULT_PLAN,
     ):
-    bayarea = timezone('America/Los_Angeles')
-    if today_ovrd:
-        today_dt = datetime(
-            today_ovrd.year,
-            today_ovrd.month,
-            today_ovrd.day,
-            tzinfo=bayarea,
-        )
-    else:
-        today_dt = datetime.now(bayarea)
-    current_year = today_dt.year
-    current_month = today_dt.month
-    current_day = today_dt.day
-    tou_d_summer_start = datetime(current_year, 6, 1, tzinfo=bayarea)
-    tou_d_summer_end = datetime(current_year, 10, 1, tzinfo=bayarea)
-
-    tou_d_peak_start = datetime(
-        year=current_year,
-        month=current_month,
-        day=current_day,
-        hour=17,
-    )
-    tou_d_peak_end = datetime(
-        year=current_year,
-        month=current_month,
-        day=current_day,
-        hour=20,
-    )
+    tariff = load_tariffs()[plan]
+    today = today_ovrd if today_ovrd else datetime.now(timezone(tariff.timezone))
+    # The day's rates come from the compiled timeline, which is built once per year and plan
+    timeline = tariff.timeline(today.year, force_peak, force_offpeak)
+    peak_day, peak_price, offpeak_price = timeline.days[today.timetuple().tm_yday - 1]
 
     # Assume 15% loss on charger for now
     kwh_consumed = (battery_capacity * soc_delta / 100) / efficiency
 
-    charge_start = datetime(
-        year=current_year,
-        month=current_month,
-        day=current_day,
-        hour=charge_start_time.hour,
-        minute=charge_start_time.minute,
-    )
-    charge_end = datetime(
-        year=current_year,
-        month=current_month,
-        day=current_day,
-        hour=charge_stop_time.hour,
-        minute=charge_stop_time.minute,
-    )
+    start = charge_start_time.hour * 60 + charge_start_time.minute
+    stop = charge_stop_time.hour * 60 + charge_stop_time.minute
+    charge_time_hr = ((stop - start) * 60) / 3600
+
+    peak_start = tariff.peak_start.hour * 60 + tariff.peak_start.minute
+    peak_end = tariff.peak_end.hour * 60 + tariff.peak_end.minute
+    if peak_day and peak_end > start and stop > peak_start:
+        peak_minutes = (peak_end - peak_start) - max(0, start - peak_start) - max(0, peak_end - stop)
+        peak_duration = (peak_minutes * 60) / 3600
+    else:
+        peak_duration = 0
+
+    peak_cost = peak_price * peak_duration
+    offpeak_cost = offpeak_price * (charge_time_hr - peak_duration)
+    average_cost = (peak_cost + offpeak_cost) / charge_time_hr
+    total_cost = average_cost * kwh_consumed
+
+    return kwh_consumed, peak_duration, peak_cost, offpeak_cost, charge_time_hr, total_cost, average_cost
+
+
+@lru_cache(maxsize=None)
+def plan_calendar(plan: str, year: int, force_peak=False, force_offpeak=False):
+    """
+    Per-day calendar of a tariff plan for a year, indexed by day of year (0 = Jan 1).
+
+    Returns
+    -------
+    tuple
+        (peak_day, peak_rate, offpeak_rate) arrays. Rates are those ecost_calculator would price each day at.
+    """
+
+    import numpy as np
+
+    days = load_tariffs()[plan].timeline(year, force_peak, force_offpeak).days
+    peak_day = np.array([peak for peak, _, _ in days], dtype=bool)
+    rates = np.array([(peak_rate, offpeak_rate) for _, peak_rate, offpeak_rate in days], dtype=np.float64)
+    peak_rate, offpeak_rate = rates[:, 0].copy(), rates[:, 1].copy()
+    for array in (peak_day, peak_rate, offpeak_rate):
+        array.flags.writeable = False
+    return peak_day, peak_rate, offpeak_rate
+
+
+def _minutes_of_day(times):
+    """
+    Convert times (datetime.time, 'HH:MM' strings or minutes after midnight) to an array of minutes.
+    """
+
+    import numpy as np
 
-    charge_time = charge_end - charge_start
-    charge_time_hr = charge_time.total_seconds() / 3600
+    values = np.asarray(times)
+    if np.issubdtype(values.dtype, np.integer):
+        return values.astype(np.int64)
+    values = values.astype(object).ravel()
+    minutes = np.empty(values.shape, dtype=np.int64)
+    for idx, value in enumerate(values):
+        if isinstance(value, str):
+            value = time.fromisoformat(value)
+        if isinstance(value, time):
+            value = value.hour * 60 + value.minute
+        minutes[idx] = value
+    return minutes
 
-    tou_d_start_peak_overlap = tou_d_peak_end > charge_start and charge_end > tou_d_peak_start
-    tou_d_end_peak_overlap = tou_d_peak_end > charge_start and charge_end > tou_d_peak_start
-    tou_d_peak_overlap = tou_d_start_peak_overlap or tou_d_end_peak_overlap
 
-    if (today_dt.weekday() < 5) and tou_d_peak_overlap:
-        peak_duration = tou_d_peak_end - tou_d_peak_start
-        if tou_d_start_peak_overlap:
-            peak_duration -= max(timedelta(0), charge_start - tou_d_peak_start)
-        if tou_d_end_peak_overlap:
-            peak_duration -= max(timedelta(0), tou_d_peak_end - charge_end)
+def ecost_batch(
+        soc_delta,
+        charge_start_times,
+        charge_stop_times,
+        dates,
+        force_peak=False,
+        force_offpeak=False,
+        efficiency=0.90,
+        battery_capacity=BZ4X_BATT,
+        plan=DEFAULT_PLAN,
+    ):
+    """
+    Vectorized ecost_calculator over many charging sessions.
+
+    Every argument may be a scalar or an array, broadcast against the others. Row i returns exactly what
+    ecost_calculator(soc_delta[i], charge_start_times[i], charge_stop_times[i], force_peak[i], force_offpeak[i],
+    dates[i], efficiency[i], battery_capacity[i]) returns, as float arrays. Like ecost_calculator, a
+    zero-length session divides by zero, which NumPy reports as nan instead of raising.
+
+    Parameters
+    ----------
+    soc_delta : array_like
+        State of charge gained, in percent.
+    charge_start_times, charge_stop_times : array_like
+        datetime.time, 'HH:MM' strings or minutes after midnight.
+    dates : array_like
+        Session dates, as datetime.date/datetime or anything np.datetime64 accepts.
 
-        peak_duration = peak_duration.total_seconds() / 3600
+    Returns
+    -------
+    tuple
+        (kwh_consumed, peak_duration, peak_cost, offpeak_cost, charge_time_hr, total_cost, average_cost)
+    """
+
+    import numpy as np
+
+    days = np.asarray(dates)
+    if np.issubdtype(days.dtype, np.datetime64):
+        days = days.astype('datetime64[D]')
     else:
-        peak_duration = 0
+        days = np.asarray([
+            value.date() if isinstance(value, datetime) else value for value in days.astype(object).ravel()
+        ], dtype='datetime64[D]')
+    starts = _minutes_of_day(charge_start_times)
+    stops = _minutes_of_day(charge_stop_times)
+    soc_delta, starts, stops, days, force_peak, force_offpeak, efficiency, battery_capacity = np.broadcast_arrays(
+        np.asarray(soc_delta, dtype=np.float64), starts, stops, days, np.asarray(force_peak, dtype=bool),
+        np.asarray(force_offpeak, dtype=bool), np.asarray(efficiency, dtype=np.float64),
+        np.asarray(battery_capacity, dtype=np.float64),
+    )
 
-    peak_price = 0.56 if (tou_d_summer_start < today_dt < tou_d_summer_end) else 0.48
-    peak_price = 0.43 if force_offpeak else peak_price
-    peak_price = 0.56 if force_peak else peak_price
+    # Calendar lookups, one precomputed table per year and override combination in the batch
+    years = days.astype('datetime64[Y]')
+    day_of_year = (days - years).astype(np.int64)
+    weekday = np.empty(days.shape, dtype=bool)
+    peak_price = np.empty(days.shape, dtype=np.float64)
+    offpeak_price = np.empty(days.shape, dtype=np.float64)
+    for year in np.unique(years):
+        for forced_peak in (False, True):
+            for forced_offpeak in (False, True):
+                rows = (years == year) & (force_peak == forced_peak) & (force_offpeak == forced_offpeak)
+                if not rows.any():
+                    continue
+                year_weekday, year_peak, year_offpeak = plan_calendar(
+                    plan, int(year.astype(np.int64)) + 1970, forced_peak, forced_offpeak)
+                weekday[rows] = year_weekday[day_of_year[rows]]
+                peak_price[rows] = year_peak[day_of_year[rows]]
+                offpeak_price[rows] = year_offpeak[day_of_year[rows]]
 
-    offpeak_price = 0.44 if (tou_d_summer_start < today_dt < tou_d_summer_end) else 0.43
-    offpeak_price = 0.43 if force_peak else offpeak_price
+    kwh_consumed = (battery_capacity * soc_delta / 100) / efficiency
+
+    charge_time_hr = ((stops - starts) * 60) / 3600
+
+    tariff = load_tariffs()[plan]
+    peak_start = tariff.peak_start.hour * 60 + tariff.peak_start.minute
+    peak_end = tariff.peak_end.hour * 60 + tariff.peak_end.minute
+    peak_overlap = (peak_end > starts) & (stops > peak_start)
+    peak_minutes = (
+        (peak_end - peak_start)
+        - np.maximum(0, starts - peak_start)
+        - np.maximum(0, peak_end - stops)
+    )
+    peak_duration = np.where(weekday & peak_overlap, (peak_minutes * 60) / 3600, 0.0)
 
     peak_cost = peak_price * peak_duration
     offpeak_cost = offpeak_price * (charge_time_hr - peak_duration)
-    average_cost = (peak_cost + offpeak_cost) / charge_time_hr
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average_cost = (peak_cost + offpeak_cost) / charge_time_hr
     total_cost = average_cost * kwh_consumed
 
     return kwh_consumed, peak_duration, peak_cost, offpeak_cost, charge_time_hr, total_cost, average_cost
 
 
+def price_timeline(start: datetime, minutes: int, force_peak=False, force_offpeak=False, plan=DEFAULT_PLAN):
+    """
+    Per-minute price ($/kWh) of a tariff plan for the minutes following a naive local start time, priced like
+    ecost_calculator.
+
+    Returns
+    -------
+    np.ndarray
+        Price of minute i, starting at start + i minutes.
+    """
+
+    import numpy as np
+
+    tariff = load_tariffs()[plan]
+    stop = start + timedelta(minutes=minutes)
+    pieces = list()
+    moment = start
+    while moment < stop:
+        year_end = datetime(moment.year + 1, 1, 1)
+        segment_end = min(stop, year_end)
+        timeline = tariff.timeline(moment.year, force_peak, force_offpeak)
+        begin = (moment - datetime(moment.year, 1, 1)) // timedelta(minutes=1)
+        end = begin + (segment_end - moment) // timedelta(minutes=1)
+        pieces.append(timeline.minute_rates(begin, end))
+        moment = segment_end
+
+    return np.concatenate(pieces) if pieces else np.empty(0, dtype=np.float64)
+
+
+def optimal_charging_window(
+        soc_delta,
+        charger_power=BZ4X_CHARGER_KW,
+        earliest_start=None,
+        horizon=timedelta(days=1),
+        allow_split=True,
+        force_peak=False,
+        force_offpeak=False,
+        efficiency=0.90,
+        battery_capacity=BZ4X_BATT,
+        plan=DEFAULT_PLAN,
+    ):
+    """
+    Find the cheapest time to charge soc_delta percent within a horizon, at minute resolution.
+
+    Charging draws charger_power for ceil(kWh / charger_power) minutes. Without splitting, every contiguous
+    window is priced in one pass from the prefix sums of the price timeline. With splitting, the cheapest
+    minutes are taken, earliest first among equal prices, and merged into sessions.
+
+    Parameters
+    ----------
+    soc_delta : float
+        State of charge to add, in percent.
+    charger_power : float
+        Power delivered by the charger, in kW.
+    earliest_start : datetime
+        Naive local time charging may start, defaults to now in the plan's timezone (rounded up to a minute).
+    horizon : timedelta
+        How long after earliest_start charging must be finished, at most MAX_WINDOW_HOURS.
+    allow_split : bool
+        Allow the charge to be split across several sessions.
+
+    Returns
+    -------
+    tuple
+        (sessions, kwh_consumed, total_cost, average_cost) where sessions is a list of (start, stop)
+        datetimes, or ([], kwh_consumed, None, None) if the charge does not fit in the horizon.
+
+    Raises
+    ------
+    ValueError
+        If charger_power or efficiency is not positive, the charge is negative, or the horizon is outside
+        (0, MAX_WINDOW_HOURS] hours.
+    """
+
+    import numpy as np
+
+    if charger_power <= 0:
+        raise ValueError(f'Charger power must be more than 0 kW, not {charger_power} kW.')
+    if efficiency <= 0:
+        raise ValueError(f'Charging efficiency must be more than 0, not {efficiency}.')
+    if soc_delta < 0:
+        raise ValueError(f'Ending state of charge is {-soc_delta}% below the starting one.')
+    if not timedelta(0) < horizon <= timedelta(hours=MAX_WINDOW_HOURS):
+        raise ValueError(f'Charging must finish within 1 to {MAX_WINDOW_HOURS} hours.')
+
+    if earliest_start is None:
+        now = datetime.now(timezone(load_tariffs()[plan].timezone)).replace(tzinfo=None)
+        earliest_start = now.replace(second=0, microsecond=0) + timedelta(minutes=1 if now.second else 0)
+
+    kwh_consumed = (battery_capacity * soc_delta / 100) / efficiency
+    needed = math.ceil(kwh_consumed / charger_power * 60)
+    minutes = int(horizon.total_seconds() // 60)
+    if needed > minutes:
+        return [], kwh_consumed, None, None
+    if needed <= 0:
+        return [], kwh_consumed, 0.0, 0.0
+
+    prices = price_timeline(earliest_start, minutes, force_peak, force_offpeak, plan)
+    # Rank in integer micro-dollars so equal-cost windows tie exactly and the earliest one wins
+    ranks = np.rint(prices * 1e6).astype(np.int64)
+
+    if allow_split:
+        chosen = np.sort(np.argsort(ranks, kind='stable')[:needed])
+        breaks = np.flatnonzero(np.diff(chosen) != 1) + 1
+        runs = [(int(run[0]), int(run[-1]) + 1) for run in np.split(chosen, breaks)]
+    else:
+        prefix = np.concatenate(([0], np.cumsum(ranks)))
+        first = int(np.argmin(prefix[needed:] - prefix[:-needed]))
+        chosen = np.arange(first, first + needed)
+        runs = [(first, first + needed)]
+    price_minutes = float(prices[chosen].sum())
+
+    sessions = [
+        (earliest_start + timedelta(minutes=begin), earliest_start + timedelta(minutes=end)) for begin, end in runs
+    ]
+    average_cost = price_minutes / needed
+    total_cost = average_cost * kwh_consumed
+
+    return sessions, kwh_consumed, total_cost, average_cost
+
+
 async def ecost(ctx: lightbulb.Context) -> None:
     soc_delta = ctx.options.esoc - ctx.options.isoc
 
@@ -195,5 +467,41 @@ async def ecost(ctx: lightbulb.Context) -> None:
     await ctx.respond(response)
 
 
+async def ecost_window(ctx: lightbulb.Context) -> None:
+    soc_delta = ctx.options.esoc - ctx.options.isoc
+
+    response = hikari.Embed(
+        color=color_neongreen,
+        timestamp=datetime.now().astimezone()
+    )
+    response.description = "Cheapest Charging Window"
+    response.title = None
+
+    try:
+        sessions, kwh_consumed, total_cost, average_cost = optimal_charging_window(
+            soc_delta, ctx.options.power, horizon=timedelta(hours=ctx.options.hours), allow_split=ctx.options.split,
+            efficiency=ctx.options.efficiency, battery_capacity=ctx.options.capacity,
+        )
+    except ValueError as err:
+        response.add_field(name='Error', value=str(err))
+    else:
+        response.add_field(name='KWh', value=f'{kwh_consumed:.3f} KWh')
+        if total_cost is None:
+            response.add_field(name='Error', value=f'Charging takes longer than {ctx.options.hours} hours at '
+                                                   f'{ctx.options.power} kW.')
+        elif not sessions:
+            response.add_field(name='Schedule', value='No charging needed.', inline=False)
+        else:
+            schedule = '\n'.join(f'{start:%a %H:%M} -> {stop:%a %H:%M}' for start, stop in sessions)
+            response.add_field(name='Schedule', value=f'```{schedule}```', inline=False)
+            response.add_field(name='Average Cost per KWh', value=f'${average_cost:.3f}', inline=True)
+            response.add_field(name='Cost', value=f'${total_cost:.2f}', inline=True)
+    response.set_footer(
+        text=f"Requested by {ctx.member.display_name}",
+        icon=ctx.member.avatar_url or ctx.member.default_avatar_url,
+    )
+    await ctx.respond(response)
+
+
 def load(bot: lightbulb.BotApp) -> None:
     bot.add_plugin(energy_cost_plugin)
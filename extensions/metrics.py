@@ -0,0 +1,190 @@
+import asyncio
+import os
+import weakref
+
+from contextlib import contextmanager
+from time import perf_counter
+
+import hikari
+import lightbulb
+from aiohttp import web
+
+from spellinator import spellinator as engine
+from spellinator.library import registry as libraries
+from spellinator.metrics import Counter, Gauge, Histogram, REGISTRY
+
+metrics_plugin = lightbulb.Plugin("Metrics")
+
+LOOP_LAG_INTERVAL = 0.5
+
+command_latency = Histogram(
+    'spellbot_command_latency_seconds',
+    'Time spent handling a slash command.',
+    ('command',),
+    registry=REGISTRY,
+)
+command_errors = Counter(
+    'spellbot_command_errors_total',
+    'Slash commands that raised instead of responding.',
+    ('command',),
+    registry=REGISTRY,
+)
+requests_shed = Counter(
+    'spellbot_requests_shed_total',
+    'Requests refused by admission control, by reason.',
+    ('command', 'reason'),
+    registry=REGISTRY,
+)
+cpu_queue_depth = Gauge(
+    'spellbot_cpu_queue_depth',
+    'CPU-bound requests waiting for or holding a worker.',
+    ('command',),
+    registry=REGISTRY,
+)
+loop_lag = Histogram(
+    'spellbot_event_loop_lag_seconds',
+    'How late the event loop woke a periodic sleep.',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    registry=REGISTRY,
+)
+heartbeat_latency = Gauge(
+    'spellbot_gateway_heartbeat_latency_seconds',
+    'Latest gateway heartbeat round trip, NaN before the first heartbeat.',
+    registry=REGISTRY,
+)
+spell_stage_seconds = Histogram(
+    'spellinator_stage_seconds',
+    'Engine time per spelling stage.',
+    ('stage',),
+    registry=REGISTRY,
+)
+spell_rejections = Counter(
+    'spellinator_rejections_total',
+    'Candidate spellings rejected by the engine.',
+    ('reason',),
+    registry=REGISTRY,
+)
+spell_stack_limited = Counter(
+    'spellinator_stack_limited_total',
+    'Spelling requests that hit the stack limit.',
+    registry=REGISTRY,
+)
+spell_cache = Counter(
+    'spellbot_spell_cache_total',
+    'Spell requests looked up in the precomputed result store, by hit or miss.',
+    ('result',),
+    registry=REGISTRY,
+)
+library_reloads = Counter(
+    'spellbot_library_reloads_total',
+    'Library reloads after its files changed, by whether the new version compiled.',
+    ('result',),
+    registry=REGISTRY,
+)
+spell_interrupted = Counter(
+    'spellinator_interrupted_total',
+    'Spelling requests stopped early with partial results, by reason.',
+    ('reason',),
+    registry=REGISTRY,
+)
+weight_table_lookups = Counter(
+    'spellinator_weight_table_lookups_total',
+    'Weight table lookups since startup.',
+    registry=REGISTRY,
+)
+weight_table_entries = Gauge(
+    'spellinator_weight_table_entries',
+    'Compiled weight table entries, one per cache miss.',
+    registry=REGISTRY,
+)
+
+_state = {
+    'runner': None,
+    'lag_task': None,
+}
+
+# Lookups already counted per table, so a rebuilt table adds its own lookups rather than resetting the counter
+_counted_lookups = weakref.WeakKeyDictionary()
+
+
+@contextmanager
+def track_command(command: str):
+    """
+    Record the latency of a command handler, and count it as an error if it raises.
+    """
+
+    start = perf_counter()
+    try:
+        yield
+    except Exception:
+        command_errors.inc(command=command)
+        raise
+    finally:
+        command_latency.observe(perf_counter() - start, command=command)
+
+
+def observe_spell(stats: engine.SpellStats) -> None:
+    """
+    Stats hook for spellinator.run() and run_async(), folding a request's SpellStats into the registry.
+    """
+
+    for stage, seconds in stats.timings.items():
+        spell_stage_seconds.observe(seconds, stage=stage)
+    for reason in ('length', 'weight', 'final'):
+        spell_rejections.inc(getattr(stats, f'{reason}_rejections'), reason=reason)
+    if stats.stack_limited:
+        spell_stack_limited.inc()
+    if stats.interrupted:
+        spell_interrupted.inc(reason=stats.interrupted)
+
+
+@REGISTRY.add_collector
+def collect_weight_tables() -> None:
+    tables = engine.weight_tables()
+    tables += [table for library in libraries.libraries() for table in library.weight_tables.values()]
+    for table in tables:
+        weight_table_lookups.inc(table.lookups - _counted_lookups.get(table, 0))
+        _counted_lookups[table] = table.lookups
+    weight_table_entries.set(sum(len(table) for table in tables))
+
+
+async def measure_loop_lag() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+
+async def serve_metrics(request: web.Request) -> web.Response:
+    heartbeat_latency.set(metrics_plugin.bot.heartbeat_latency)
+    return web.Response(body=REGISTRY.render(), headers={'Content-Type': REGISTRY.content_type})
+
+
+@metrics_plugin.listener(hikari.StartedEvent)
+async def start_metrics(_: hikari.StartedEvent) -> None:
+    host = os.environ.get('METRICS_HOST', '127.0.0.1')
+    port = int(os.environ.get('METRICS_PORT', 9464))
+
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    _state['runner'] = runner
+    _state['lag_task'] = asyncio.create_task(measure_loop_lag())
+
+
+@metrics_plugin.listener(hikari.StoppingEvent)
+async def stop_metrics(_: hikari.StoppingEvent) -> None:
+    if _state['lag_task'] is not None:
+        _state['lag_task'].cancel()
+        _state['lag_task'] = None
+    if _state['runner'] is not None:
+        await _state['runner'].cleanup()
+        _state['runner'] = None
+
+
+def load(bot: lightbulb.BotApp) -> None:
+    bot.add_plugin(metrics_plugin)
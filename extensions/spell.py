@@ -1,74 +1,277 @@
-import re
-
-import hikari
-import lightbulb
-
-from spellinator.spellinator import main
-from spellinator.constants import *
-
-from datetime import datetime
-from pprint import pprint
-
-spell_plugin = lightbulb.Plugin("Spell")
-
-
-@spell_plugin.command
-@lightbulb.option(
-    'show_phonemes',
-    "Show phonemes",
-    type=hikari.OptionType.BOOLEAN,
-    default=False,
-)
-@lightbulb.option(
-    "word",
-    "Word to spellinate",
-    type=str,
-    required=True,
-    modifier=lightbulb.OptionModifier.GREEDY,
-)
-@lightbulb.command(
-    "spell",
-    "Respell a word",
-)
-@lightbulb.implements(lightbulb.SlashCommand)
-async def standard_spell(ctx: lightbulb.Context) -> None:
-    await spell(ctx)
-
-
-async def spell(ctx: lightbulb.Context, index: int = None) -> None:
-    word = ctx.options.word
-
-    if not word:
-        await ctx.respond("No word specified.")
-        return
-
-    response = hikari.Embed(
-        color=color_neongreen,
-        timestamp=datetime.now().astimezone()
-    )
-    if len(word) > 14:
-        err_str = 'Sorry, that word is too long, results will take a long time to generate.'
-        response.add_field(name='Error', value=err_str, inline=True)
-
-    else:
-        spell_args = [word, '-s', '20', '--print-width', '60', '--limit', '10']
-        if ctx.options.show_phonemes:
-            spell_args.append('-a')
-
-        spellings = main(spell_args)
-
-        response.add_field(name='Spellings', value=f'```{spellings}```', inline=True)
-
-    response.description = f'```{word}```'
-    response.title = None
-
-    response.set_footer(
-        text=f"Requested by {ctx.member.display_name}",
-        icon=ctx.member.avatar_url or ctx.member.default_avatar_url,
-    )
-
-    await ctx.respond(response)
-
-
-def load(bot: lightbulb.BotApp) -> None:
-    bot.add_plugin(spell_plugin)
+import asyncio
+import math
+import os
+import re
+
+import hikari
+import lightbulb
+
+from extensions.metrics import cpu_queue_depth, library_reloads, observe_spell, requests_shed, spell_cache
+from extensions.metrics import track_command
+from spellinator.admission import QueueFull, RateLimiter, WorkQueue
+from spellinator.library import Library, registry
+from spellinator.spellinator import estimate_segmentation, run_async
+from spellinator.store import STANDARD_ARGS, STORE, ResultStore
+from spellinator.constants import *
+
+from datetime import datetime
+from pathlib import Path
+
+spell_plugin = lightbulb.Plugin("Spell")
+
+SPELL_LIBRARY = Path('spellinator/en')
+MAX_WORD_LENGTH = 14
+COST_PER_TOKEN = 5000
+USER_CAPACITY = 6
+# Segmentation nodes, as counted by estimate_segmentation, a request may cost before it is refused; a request
+# takes 1 + cost / COST_PER_TOKEN tokens, so this is the most a user's full bucket can ever pay for
+MAX_COST = (USER_CAPACITY - 1) * COST_PER_TOKEN
+# Seconds a spelling may run before its partial results are returned
+SPELL_TIME_LIMIT = 10.0
+# Node expansions between yields to the event loop, a few milliseconds of work
+SPELL_YIELD_EVERY = 200
+# Seconds between checks of the library files for edits
+LIBRARY_POLL_INTERVAL = 2.0
+
+user_limiter = RateLimiter(rate=0.2, capacity=USER_CAPACITY)
+guild_limiter = RateLimiter(rate=1.0, capacity=20)
+# Spellings share the event loop, so running more than one at a time would only slow each of them down
+work_queue = WorkQueue(workers=1, max_pending=8)
+# Precomputed results from `python -m spellinator warm`, opened at load
+_store = None
+_watch_task = None
+
+
+@spell_plugin.command
+@lightbulb.option(
+    'show_phonemes',
+    "Show phonemes",
+    type=hikari.OptionType.BOOLEAN,
+    default=False,
+)
+@lightbulb.option(
+    "word",
+    "Word to spellinate",
+    type=str,
+    required=True,
+    modifier=lightbulb.OptionModifier.GREEDY,
+)
+@lightbulb.command(
+    "spell",
+    "Respell a word",
+)
+@lightbulb.implements(lightbulb.SlashCommand)
+async def standard_spell(ctx: lightbulb.Context) -> None:
+    with track_command('spell'):
+        await spell(ctx)
+
+
+@spell_plugin.command
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.option(
+    'show_phonemes',
+    "Show phonemes",
+    type=hikari.OptionType.BOOLEAN,
+    default=False,
+)
+@lightbulb.option(
+    "word",
+    "Word to profile",
+    type=str,
+    required=True,
+)
+@lightbulb.command(
+    "spell-profile",
+    "Profile a spell request (bot owners only)",
+    ephemeral=True,
+)
+@lightbulb.implements(lightbulb.SlashCommand)
+async def profile_spell(ctx: lightbulb.Context) -> None:
+    with track_command('spell-profile'):
+        await spell_profile(ctx)
+
+
+async def spell_profile(ctx: lightbulb.Context) -> None:
+    """
+    Profile a request with the bot's standard arguments and library, and attach the summary.
+
+    Skips the store and admission control, as the point is to see what a slow word costs. The runs take a work
+    queue slot, so they never overlap a spelling, and run in a worker thread since they can't yield to the loop.
+    """
+
+    # Imported here, only this owner command needs the profilers
+    from spellinator.profiling import profile_request
+
+    words = ctx.options.word.split()
+    if not words:
+        await ctx.respond("No word specified.")
+        return
+
+    word = words[0].lower()
+    spell_args = [word, *STANDARD_ARGS]
+    if ctx.options.show_phonemes:
+        spell_args.append('-a')
+
+    # Profiling runs the request several times, well past the interaction's response deadline
+    await ctx.respond(hikari.ResponseType.DEFERRED_MESSAGE_CREATE)
+    library = registry.get(SPELL_LIBRARY)
+    try:
+        with cpu_queue_depth.track_inprogress(command='spell-profile'):
+            async with work_queue.slot():
+                report = await asyncio.to_thread(profile_request, spell_args, library)
+    except QueueFull:
+        requests_shed.inc(command='spell-profile', reason='queue')
+        await ctx.respond('Spellbot is busy right now, try again shortly.')
+        return
+
+    stats = report.stats
+    await ctx.respond(
+        f'Profile of `{word}`: {stats.total_time:.3f}s, peak {report.memory.peak / 2 ** 20:.1f} MiB',
+        attachment=hikari.Bytes(report.summary().encode(), f'profile-{word}.txt'),
+    )
+
+
+def request_cost(word: str, library: Library) -> int:
+    """
+    Estimate the cost of spelling a word as the size of its segmentation tree.
+    """
+
+    # The bot always passes --limit, which runs the segmentation in fast mode
+    return estimate_segmentation(word.split()[0].lower(), library.grapheme_dict.values(), fast_mode=True)
+
+
+def admit(word: str, user_id, guild_id, library: Library) -> str:
+    """
+    Decide whether a spell request may run.
+
+    Returns
+    -------
+    str
+        An error message for the user if the request is refused, otherwise None. Tokens are only taken from
+        the user and guild buckets when the request is admitted.
+    """
+
+    if len(word) > MAX_WORD_LENGTH:
+        requests_shed.inc(command='spell', reason='length')
+        return 'Sorry, that word is too long, results will take a long time to generate.'
+
+    cost = request_cost(word, library)
+    if cost > MAX_COST:
+        requests_shed.inc(command='spell', reason='cost')
+        return 'Sorry, that word has too many possible pronunciations to spell quickly.'
+
+    tokens = 1 + cost / COST_PER_TOKEN
+    retry_after = user_limiter.retry_after(user_id, tokens)
+    if guild_id is not None:
+        retry_after = max(retry_after, guild_limiter.retry_after(guild_id, tokens))
+    if math.isinf(retry_after):
+        # More tokens than a bucket holds, the request could never be admitted
+        requests_shed.inc(command='spell', reason='cost')
+        return 'Sorry, that word has too many possible pronunciations to spell quickly.'
+    if retry_after > 0:
+        requests_shed.inc(command='spell', reason='rate')
+        return f'Slow down! Try again in {math.ceil(retry_after)}s.'
+
+    user_limiter.consume(user_id, tokens)
+    if guild_id is not None:
+        guild_limiter.consume(guild_id, tokens)
+
+    return None
+
+
+async def spell(ctx: lightbulb.Context, index: int = None) -> None:
+    word = ctx.options.word
+
+    if not word:
+        await ctx.respond("No word specified.")
+        return
+
+    response = hikari.Embed(
+        color=color_neongreen,
+        timestamp=datetime.now().astimezone()
+    )
+    # The request keeps this version of the library even if it is reloaded before the request completes
+    library = registry.get(SPELL_LIBRARY)
+    cached = None
+    if _store is not None and _store.library == library.fingerprint:
+        cached = _store.get(word, ctx.options.show_phonemes)
+    spell_cache.inc(result='hit' if cached is not None else 'miss')
+    err_str = admit(word, ctx.author.id, ctx.guild_id, library) if cached is None else None
+    if err_str:
+        response.add_field(name='Error', value=err_str, inline=True)
+
+    elif cached is not None:
+        response.add_field(name='Spellings', value=f'```{cached}```' if cached else 'None found.', inline=True)
+
+    else:
+        spell_args = [word, *STANDARD_ARGS]
+        if ctx.options.show_phonemes:
+            spell_args.append('-a')
+
+        try:
+            with cpu_queue_depth.track_inprogress(command='spell'):
+                async with work_queue.slot():
+                    spellings, stats = await run_async(spell_args, stats_hook=observe_spell,
+                                                       timeout=SPELL_TIME_LIMIT, yield_every=SPELL_YIELD_EVERY,
+                                                       library=library)
+        except QueueFull:
+            requests_shed.inc(command='spell', reason='queue')
+            response.add_field(name='Error', value='Spellbot is busy right now, try again shortly.', inline=True)
+        else:
+            name = 'Spellings (partial, time limit reached)' if stats.interrupted else 'Spellings'
+            response.add_field(name=name, value=f'```{spellings}```' if spellings else 'None found.', inline=True)
+
+    response.description = f'```{word}```'
+    response.title = None
+
+    response.set_footer(
+        text=f"Requested by {ctx.member.display_name}",
+        icon=ctx.member.avatar_url or ctx.member.default_avatar_url,
+    )
+
+    await ctx.respond(response)
+
+
+def open_store(path) -> ResultStore:
+    """
+    Open a result store, or return None if it is missing or was computed with other arguments than the bot's.
+
+    Stores are also checked per request against the fingerprint of the current library, so results computed
+    with an older version of the library are never served.
+    """
+
+    try:
+        store = ResultStore(path)
+    except (OSError, ValueError):
+        return None
+    if store.params != list(STANDARD_ARGS):
+        store.close()
+        return None
+    return store
+
+
+def count_reloads(reloaded: dict) -> None:
+    for library in reloaded.values():
+        library_reloads.inc(result='error' if isinstance(library, Exception) else 'ok')
+
+
+@spell_plugin.listener(hikari.StartedEvent)
+async def start_library_watch(_: hikari.StartedEvent) -> None:
+    global _watch_task
+    _watch_task = asyncio.create_task(registry.watch(LIBRARY_POLL_INTERVAL, count_reloads))
+
+
+@spell_plugin.listener(hikari.StoppingEvent)
+async def stop_library_watch(_: hikari.StoppingEvent) -> None:
+    global _watch_task
+    if _watch_task is not None:
+        _watch_task.cancel()
+        _watch_task = None
+
+
+def load(bot: lightbulb.BotApp) -> None:
+    global _store
+    _store = open_store(os.environ.get('SPELL_STORE', STORE))
+    # Compiled up front so the first request doesn't pay for it
+    registry.get(SPELL_LIBRARY)
+    bot.add_plugin(spell_plugin)
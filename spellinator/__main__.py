@@ -0,0 +1,36 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+from importlib import import_module
+
+import sys
+
+# Subcommand -> module with a main(argv), imported only when run so each command starts fast
+COMMANDS = {
+    'spell': 'spellinator.spellinator',
+    'warm': 'spellinator.store',
+    'bench': 'spellinator.bench',
+    'diff': 'spellinator.difftest',
+    'analyze': 'spellinator.analyze',
+}
+
+USAGE = f'usage: python -m spellinator {{{",".join(COMMANDS)}}} [args...]'
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in COMMANDS:
+        print(USAGE, file=sys.stderr)
+        return 0 if argv and argv[0] in ('-h', '--help') else 2
+
+    command, *args = argv
+    result = import_module(COMMANDS[command]).main(args)
+    if command == 'spell':
+        print(result)
+        return 0
+
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(main())
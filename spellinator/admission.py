@@ -0,0 +1,125 @@
+# coding=utf-8
+
+from contextlib import asynccontextmanager
+from time import monotonic
+
+import asyncio
+
+__all__ = ['TokenBucket', 'RateLimiter', 'WorkQueue', 'QueueFull']
+
+
+class QueueFull(Exception):
+    """
+    Raised when a WorkQueue already holds its maximum number of pending requests.
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket holding up to capacity tokens, refilled at rate tokens per second.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock=monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def __repr__(self):
+        return f'TokenBucket({self.tokens:.2f}/{self.capacity})'
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, tokens: float = 1) -> float:
+        """
+        Seconds until the given number of tokens will be available, 0 if they already are.
+        """
+
+        self.refill()
+        if tokens > self.capacity:
+            return float('inf')
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def consume(self, tokens: float = 1) -> bool:
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by an arbitrary id (user, guild, ...), created on first use.
+
+    Buckets that have refilled completely carry no state worth keeping, so they are dropped whenever the
+    number of tracked keys passes max_keys.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 10000, clock=monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = dict()
+
+    def bucket(self, key) -> TokenBucket:
+        if key not in self.buckets:
+            if len(self.buckets) >= self.max_keys:
+                self.prune()
+            self.buckets[key] = TokenBucket(self.rate, self.capacity, self.clock)
+        return self.buckets[key]
+
+    def prune(self):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill()
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+    def retry_after(self, key, tokens: float = 1) -> float:
+        return self.bucket(key).retry_after(tokens)
+
+    def consume(self, key, tokens: float = 1) -> bool:
+        return self.bucket(key).consume(tokens)
+
+
+class WorkQueue:
+    """
+    Bounded asyncio queue in front of a fixed number of workers.
+
+    At most workers requests run at once, and at most max_pending requests (running or waiting) are admitted;
+    beyond that slot() raises QueueFull so the caller can shed the request instead of queueing it.
+    """
+
+    def __init__(self, workers: int = 1, max_pending: int = 8):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._semaphore = None
+
+    def __len__(self):
+        return self.pending
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.full:
+            raise QueueFull(f'{self.pending} requests already pending')
+
+        # Created lazily so the semaphore binds to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+
+        self.pending += 1
+        try:
+            async with self._semaphore:
+                yield self
+        finally:
+            self.pending -= 1
@@ -0,0 +1,335 @@
+# coding=utf-8
+
+from pathlib import Path
+
+import argparse
+import json
+import sys
+
+__all__ = ['PROFILE_NAME', 'Prediction', 'CostModel', 'build_profile', 'load_profile', 'write_profile',
+           'choose_parameters', 'worst_cases']
+
+# File the profile is stored under in the library directory, next to weights.csv and phonemes.csv
+PROFILE_NAME = 'profile.json'
+_VERSION = 1
+
+# Transcription nodes one stack slot costs per segmentation tree once the stack limit binds, between 4 and 11
+# for en words (arthur, knight, spellinator, mississippi at stack limits 20 and 200)
+NODES_PER_SLOT = 8
+MIN_STACK_LIMIT = 20
+
+_roles = ('starts', 'middles', 'ends')
+
+
+def build_profile(phoneme_dict: dict, grapheme_dict: dict, fingerprint: str = None) -> dict:
+    """
+    Fan-out statistics of a compiled library.
+
+    For every grapheme and role (starts, middles, ends) the profile records how many phonemes the grapheme
+    may be read as in that role, and how many graphemes those phonemes may in turn be written with in the
+    same role, i.e. how many ways a segmentation node for the grapheme can be transcribed. For every
+    phoneme it records how many graphemes it is written with in each role.
+
+    Returns
+    -------
+    dict
+        JSON-serializable profile, see CostModel.
+    """
+
+    graphemes = dict()
+    for name, grapheme in grapheme_dict.items():
+        graphemes[name] = {
+            role: [len(phonemes), sum(len(getattr(phoneme, role)) for phoneme in phonemes)]
+            for role, phonemes in ((role, getattr(grapheme, role)) for role in _roles)
+        }
+
+    phonemes = {
+        name: {role: len(getattr(phoneme, role)) for role in _roles}
+        for name, phoneme in phoneme_dict.items() if name
+    }
+
+    return {'version': _VERSION, 'fingerprint': fingerprint, 'graphemes': graphemes, 'phonemes': phonemes}
+
+
+def write_profile(profile: dict, path) -> None:
+    with open(path, 'w') as fp:
+        json.dump(profile, fp, indent=1, sort_keys=True)
+
+
+def load_profile(library) -> dict:
+    """
+    The profile stored with a spellinator.library.Library, or one built from it if the stored profile is
+    missing or was computed for other phonemes (see Library.profile_fingerprint).
+    """
+
+    path = library.directory / PROFILE_NAME
+    try:
+        with open(path) as fp:
+            profile = json.load(fp)
+    except (OSError, ValueError):
+        profile = None
+    if profile and profile.get('version') == _VERSION and profile.get('fingerprint') == library.profile_fingerprint:
+        return profile
+
+    return build_profile(library.phoneme_dict, library.grapheme_dict, library.profile_fingerprint)
+
+
+class Prediction:
+    """
+    Predicted cost of spelling a word, before any weight or length pruning.
+
+    segmentation_nodes is exactly what reverse_translate builds without fast mode. trees is the number of
+    segmentation trees (start nodes). transcriptions counts complete transcriptions and work every partial
+    transcription, both upper bounds for the transcription stage with no stack limit.
+    """
+
+    def __init__(self, word: str, segmentation_nodes: int, trees: int, work: int, transcriptions: int):
+        self.word = word
+        self.segmentation_nodes = segmentation_nodes
+        self.trees = trees
+        self.work = work
+        self.transcriptions = transcriptions
+
+    def __repr__(self):
+        return (f'Prediction({self.word!r}, segmentation_nodes={self.segmentation_nodes}, trees={self.trees}, '
+                f'work={self.work}, transcriptions={self.transcriptions})')
+
+    def as_dict(self):
+        return {
+            'word': self.word,
+            'segmentation_nodes': self.segmentation_nodes,
+            'trees': self.trees,
+            'work': self.work,
+            'transcriptions': self.transcriptions,
+        }
+
+
+class CostModel:
+    """
+    Predicts request cost from a library profile alone, without segmenting.
+
+    A pass over the word's prefixes counts, for every position, the segmentation nodes ending there and the
+    partial transcriptions reaching it: a start grapheme from the beginning of the word, then middle
+    graphemes, then an end grapheme finishing it. Each count is a sum over the graphemes ending at the
+    position of the count where the grapheme begins times the grapheme's fan-out in its role.
+    """
+
+    def __init__(self, profile: dict):
+        self.profile = profile
+        self.graphemes = profile['graphemes']
+        self.max_grapheme = max(map(len, self.graphemes), default=0)
+
+    def __repr__(self):
+        return f'CostModel({len(self.graphemes)} graphemes)'
+
+    def predict(self, word: str) -> Prediction:
+        length = len(word)
+        # Segmentation nodes and partial transcriptions ending at each position
+        nodes = [0] * (length + 1)
+        partial = [0] * (length + 1)
+        trees = 0
+        segmentation_nodes = 0
+        transcriptions = 0
+
+        for end in range(1, length + 1):
+            for start in range(max(0, end - self.max_grapheme), end):
+                fan_out = self.graphemes.get(word[start:end])
+                if fan_out is None:
+                    continue
+                if start == 0:
+                    phonemes, renderings = fan_out['starts']
+                    nodes[end] += phonemes
+                    partial[end] += renderings
+                    trees += phonemes
+                    if end == length:
+                        # A start covering the word is also a tree of its own, ending in the null phoneme
+                        trees += phonemes
+                        segmentation_nodes += phonemes
+                        transcriptions += renderings
+                    continue
+                if end < length:
+                    phonemes, renderings = fan_out['middles']
+                    nodes[end] += nodes[start] * phonemes
+                    partial[end] += partial[start] * renderings
+                else:
+                    phonemes, renderings = fan_out['ends']
+                    segmentation_nodes += nodes[start] * phonemes
+                    transcriptions += partial[start] * renderings
+
+        segmentation_nodes += sum(nodes)
+        work = sum(partial) + transcriptions
+
+        return Prediction(word, segmentation_nodes, trees, work, transcriptions)
+
+
+def choose_parameters(model: CostModel, word: str, budget: int, stack_limit: int, fast_mode: bool = False) -> tuple:
+    """
+    Pick the stack limit and segmentation mode for a word so the request stays within a budget of nodes.
+
+    Words whose whole search fits the budget get a stack limit that can never bind, so their results are
+    complete. Larger words get the stack limit that spends about the budget across their segmentation trees,
+    but never more than the requested one or less than MIN_STACK_LIMIT, and fast segmentation when the
+    segmentation alone would exceed the budget.
+
+    Returns
+    -------
+    tuple
+        (stack_limit, fast_mode, prediction)
+    """
+
+    prediction = model.predict(word)
+    if prediction.segmentation_nodes > budget:
+        fast_mode = True
+    if prediction.work <= budget:
+        stack_limit = max(stack_limit, prediction.work)
+    else:
+        fitted = budget // (max(1, prediction.trees) * NODES_PER_SLOT)
+        stack_limit = max(MIN_STACK_LIMIT, min(stack_limit, fitted))
+
+    return stack_limit, fast_mode, prediction
+
+
+def worst_cases(model: CostModel, length: int, count: int = 5, beam: int = 16) -> list:
+    """
+    Search for the words of a given length with the highest predicted work.
+
+    Words are grown a grapheme at a time from the start graphemes, keeping the beam prefixes with the most
+    partial transcriptions.
+
+    Returns
+    -------
+    list
+        Up to count Predictions, most expensive first.
+    """
+
+    names = [name for name in model.graphemes if name.isalpha()]
+    starts = [name for name in names if model.graphemes[name]['starts'][1]]
+    middles = [name for name in names if model.graphemes[name]['middles'][1]]
+    ends = [name for name in names if model.graphemes[name]['ends'][1]]
+
+    def potential(prefix):
+        # Partial transcriptions of the prefix; the NUL never matches, so no end grapheme closes the word
+        return model.predict(prefix + '\0').work
+
+    finished = dict()
+    prefixes = sorted(set(name for name in starts if len(name) < length), key=potential, reverse=True)[:beam]
+    while prefixes:
+        grown = set()
+        for prefix in prefixes:
+            for name in ends:
+                if len(prefix) + len(name) == length:
+                    word = prefix + name
+                    if word not in finished:
+                        finished[word] = model.predict(word)
+            for name in middles:
+                if len(prefix) + len(name) < length:
+                    grown.add(prefix + name)
+        prefixes = sorted(grown, key=potential, reverse=True)[:beam]
+
+    return sorted(finished.values(), key=lambda prediction: prediction.work, reverse=True)[:count]
+
+
+def parse_args(argv):
+    """
+    Parse command line arguments for the library analysis.
+
+    Returns
+    -------
+    args
+        Parsed arguments object from argparse
+    """
+
+    parser = argparse.ArgumentParser(prog='spellinator analyze',
+                                     description='Profile the fan-out of a library and report its worst-case inputs.')
+
+    parser.add_argument(
+        '-y',
+        '--library',
+        default='spellinator/en',
+        help='Directory path containing weights.csv and phonemes.csv'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=Path,
+        help=f'Where to store the profile, defaults to {PROFILE_NAME} in the library directory.'
+    )
+
+    parser.add_argument(
+        '--top',
+        default=10,
+        type=int,
+        help='Graphemes, phonemes and worst-case words to list.'
+    )
+
+    parser.add_argument(
+        '--lengths',
+        nargs='+',
+        default=[6, 10, 14],
+        type=int,
+        help='Word lengths to search worst-case inputs for.'
+    )
+
+    parser.add_argument(
+        '--beam',
+        default=16,
+        type=int,
+        help='Prefixes kept per step of the worst-case search.'
+    )
+
+    parser.add_argument(
+        'words',
+        nargs='*',
+        help='Words to predict the cost of.'
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # Imported here so the engine can import this module for its cost model
+    from spellinator.library import Library
+
+    args = parse_args(argv)
+
+    library = Library(args.library)
+    profile = build_profile(library.phoneme_dict, library.grapheme_dict, library.profile_fingerprint)
+    output = args.output if args.output else library.directory / PROFILE_NAME
+    write_profile(profile, output)
+    model = CostModel(profile)
+
+    print(f'{library.directory}: {len(profile["graphemes"])} graphemes, {len(profile["phonemes"])} phonemes, '
+          f'fingerprint {library.profile_fingerprint}, profile written to {output}')
+
+    def total(fan_out):
+        return sum(renderings for _, renderings in fan_out.values())
+
+    print('\nGraphemes by fan-out (phonemes / transcriptions per role)')
+    print(f'{"grapheme":<10}  {"starts":>9}  {"middles":>9}  {"ends":>9}')
+    for name, fan_out in sorted(profile['graphemes'].items(), key=lambda item: total(item[1]),
+                                reverse=True)[:args.top]:
+        cells = '  '.join(f'{f"{fan_out[role][0]}/{fan_out[role][1]}":>9}' for role in _roles)
+        print(f'{name:<10}  {cells}')
+
+    print('\nPhonemes by fan-out (graphemes per role)')
+    print(f'{"phoneme":<10}  {"starts":>7}  {"middles":>7}  {"ends":>7}')
+    for name, fan_out in sorted(profile['phonemes'].items(), key=lambda item: sum(item[1].values()),
+                                reverse=True)[:args.top]:
+        print(f'{name:<10}  {fan_out["starts"]:>7}  {fan_out["middles"]:>7}  {fan_out["ends"]:>7}')
+
+    predictions = [model.predict(word.lower()) for word in args.words]
+    for length in args.lengths:
+        print(f'Searching worst cases of length {length}...', file=sys.stderr, flush=True)
+        predictions.extend(worst_cases(model, length, args.top, args.beam))
+
+    print(f'\n{"word":<16}  {"segmentation":>12}  {"trees":>6}  {"work":>14}  {"transcriptions":>14}')
+    for prediction in predictions:
+        print(f'{prediction.word:<16}  {prediction.segmentation_nodes:>12}  {prediction.trees:>6}  '
+              f'{prediction.work:>14}  {prediction.transcriptions:>14}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
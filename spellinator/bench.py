@@ -0,0 +1,429 @@
+#! /usr/bin/env python3
+# coding=utf-8
+
+from pathlib import Path
+from statistics import geometric_mean
+from time import perf_counter
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tracemalloc
+
+from spellinator import spellinator as engine
+from spellinator.library import Library
+
+__all__ = ['CORPUS', 'STACK_LIMITS', 'IMPORTS', 'run_benchmarks', 'bench_process', 'import_time', 'compare']
+
+CORPUS = {
+    'short': ['cat', 'ox', 'tea'],
+    'medium': ['arthur', 'phone', 'knight'],
+    'long': ['transportation'],
+}
+
+STACK_LIMITS = (20, 200, 1000)
+
+# Modules whose cold import time is part of the CLI / bot startup budget
+IMPORTS = ('spellinator.spellinator',)
+
+BASELINE = Path(__file__).parent / 'bench_baseline.json'
+
+# Timed runs per case, the fastest of which is kept; cases stop repeating once they have run for REPEAT_SECONDS
+REPEAT = 5
+REPEAT_SECONDS = 2.0
+
+# A single case's time must grow past (1 + CASE_TOLERANCE) times its baseline to be flagged by itself. On a shared
+# machine single cases swing by more than --tolerance from run to run, so smaller slowdowns are only flagged through
+# the geometric mean over every case, which averages that noise out
+CASE_TOLERANCE = 1.0
+
+# Counts that must match the baseline exactly; import cases count modules, which may only shrink
+EXACT = ('nodes', 'results')
+
+
+def parse_args(argv):
+    """
+    Parse command line arguments for the benchmark runner.
+
+    Returns
+    -------
+    args
+        Parsed arguments object from argparse
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the spelling engine over a fixed corpus.')
+
+    parser.add_argument(
+        '-y',
+        '--library',
+        default='spellinator/en',
+        help='Directory path containing weights.csv and phonemes.csv'
+    )
+
+    parser.add_argument(
+        '--corpus',
+        nargs='+',
+        choices=list(CORPUS),
+        default=list(CORPUS),
+        help='Corpus groups to run.'
+    )
+
+    parser.add_argument(
+        '-s',
+        '--stack-limits',
+        nargs='+',
+        type=int,
+        default=list(STACK_LIMITS),
+        help='Stack limits to run each word at.'
+    )
+
+    parser.add_argument(
+        '-b',
+        '--baseline',
+        default=BASELINE,
+        type=Path,
+        help='Baseline JSON to compare against.'
+    )
+
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Write the results to the baseline file instead of comparing.'
+    )
+
+    parser.add_argument(
+        '-t',
+        '--tolerance',
+        default=0.25,
+        type=float,
+        help='Allowed relative memory growth of a case, and slowdown of the geometric mean over all cases.'
+    )
+
+    parser.add_argument(
+        '--case-tolerance',
+        default=CASE_TOLERANCE,
+        type=float,
+        help='Allowed relative slowdown of a single case.'
+    )
+
+    parser.add_argument(
+        '--imports',
+        nargs='*',
+        default=list(IMPORTS),
+        help='Modules to measure the cold import time of, none to skip.'
+    )
+
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Random seed used for every case.'
+    )
+
+    parser.add_argument(
+        '--hash-seed',
+        default=0,
+        type=int,
+        help='PYTHONHASHSEED for the processes the words are benchmarked in, so set iteration order is the same in '
+             'every run.'
+    )
+
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        default=REPEAT,
+        type=int,
+        help='Timed runs per case; the fastest is compared.'
+    )
+
+    # Benchmark a single word in this process and print its cases as JSON, used by run_benchmarks
+    parser.add_argument(
+        '--worker',
+        help=argparse.SUPPRESS
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=Path,
+        help='Optional JSON file to store the results.'
+    )
+
+    return parser.parse_args(argv)
+
+
+def count_nodes(phonetic_sequences):
+    """
+    Count the nodes and complete pronunciations in a segmentation tree.
+
+    Returns
+    -------
+    tuple
+        (nodes, pronunciations)
+    """
+
+    nodes = 0
+    pronunciations = 0
+    work = list(phonetic_sequences)
+    while work:
+        node = work.pop()
+        nodes += 1
+        if not node.follow and node.stop_valid:
+            pronunciations += 1
+        work.extend(node.follow)
+
+    return nodes, pronunciations
+
+
+def measure(func, seed, repeat=REPEAT):
+    """
+    Run func up to repeat times for wall time, then once more under tracemalloc for peak memory, reseeding every
+    time. Slow cases, whose noise is small next to their run time, stop repeating after REPEAT_SECONDS.
+
+    Returns
+    -------
+    tuple
+        (result, seconds, peak_kib), seconds being the fastest run.
+    """
+
+    seconds = float('inf')
+    spent = 0.0
+    for _ in range(repeat):
+        random.seed(seed)
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        seconds = min(seconds, elapsed)
+        spent += elapsed
+        if spent >= REPEAT_SECONDS:
+            break
+
+    random.seed(seed)
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, seconds, peak / 1024
+
+
+def bench_word(library: Library, word: str, stack_limits, seed, repeat=REPEAT):
+    """
+    Benchmark every engine stage for a single word.
+
+    Returns
+    -------
+    dict
+        Case name -> {seconds, peak_kib, nodes, results}
+    """
+
+    cases = dict()
+    engine.SequenceNode.target_length = len(word)
+
+    phonetic_sequences, seconds, peak = measure(
+        lambda: engine.reverse_translate(word, library.grapheme_dict.values()), seed, repeat)
+    nodes, pronunciations = count_nodes(phonetic_sequences)
+    cases[f'reverse_translate/{word}'] = {
+        'seconds': seconds, 'peak_kib': peak, 'nodes': nodes, 'results': pronunciations,
+    }
+
+    # Each measured stage runs twice, so keep the stats of the last (traced) run
+    stats = engine.SpellStats(word)
+
+    def fresh_stats():
+        nonlocal stats
+        stats = engine.SpellStats(word)
+        return stats
+
+    for stack_limit in stack_limits:
+        weight_table = engine.WeightTable(library.weight_dict)
+
+        def transcribe_all():
+            request_stats = fresh_stats()
+            return [
+                engine.transcribe(pseq, library.phoneme_dict, library.weight_dict,
+                                  stack_limit=stack_limit, weight_table=weight_table, stats=request_stats)
+                for pseq in phonetic_sequences
+            ]
+
+        m_rna, seconds, peak = measure(transcribe_all, seed, repeat)
+        cases[f'transcribe/{word}/{stack_limit}'] = {
+            'seconds': seconds, 'peak_kib': peak, 'nodes': stats.transcription_nodes,
+            'results': sum(map(len, m_rna)),
+        }
+
+        def true_translate():
+            return engine.true_translate(phonetic_sequences, library.phoneme_dict, library.weight_dict,
+                                         stack_limit=stack_limit, weight_table=weight_table,
+                                         stats=fresh_stats())
+
+        _, seconds, peak = measure(true_translate, seed, repeat)
+        cases[f'true_translate/{word}/{stack_limit}'] = {
+            'seconds': seconds, 'peak_kib': peak, 'nodes': stats.transcription_nodes, 'results': stats.results,
+        }
+
+        argv = [word, '-y', str(library.directory), '-s', str(stack_limit)]
+        (_, stats), seconds, peak = measure(lambda: engine.run(argv), seed, repeat)
+        cases[f'main/{word}/{stack_limit}'] = {
+            'seconds': seconds, 'peak_kib': peak,
+            'nodes': stats.segmentation_nodes + stats.transcription_nodes, 'results': stats.results,
+        }
+
+    return cases
+
+
+def import_time(module: str, repeat: int = 5):
+    """
+    Cold import time of a module in a fresh interpreter, as reported by python -X importtime.
+
+    Returns
+    -------
+    tuple
+        (seconds, modules) for the fastest of repeat runs, where modules counts every module the import loaded.
+    """
+
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            capture_output=True, text=True, check=True, cwd=Path(__file__).parent.parent,
+        )
+        # import time: self [us] | cumulative | imported package
+        rows = [line.split('|') for line in proc.stderr.splitlines() if line.startswith('import time:')][1:]
+        cumulative = {name.strip(): int(total) for _, total, name in rows}
+        seconds = cumulative[module] / 1e6
+        if best is None or seconds < best[0]:
+            best = (seconds, len(rows))
+
+    return best
+
+
+def bench_process(library, word: str, stack_limits, seed, repeat=REPEAT, hash_seed=0) -> dict:
+    """
+    bench_word in a fresh interpreter with a pinned PYTHONHASHSEED, so the sets the engine iterates, and with them
+    the work a stack-limited case does, are the same in every run.
+    """
+
+    argv = [sys.executable, '-m', 'spellinator.bench', '--worker', word, '-y', str(Path(library).resolve()),
+            '--seed', str(seed), '--repeat', str(repeat), '-s', *map(str, stack_limits)]
+    proc = subprocess.run(argv, capture_output=True, text=True, check=True, cwd=Path(__file__).parent.parent,
+                          env=dict(os.environ, PYTHONHASHSEED=str(hash_seed)))
+    return json.loads(proc.stdout)
+
+
+def run_benchmarks(library='spellinator/en', corpus=None, stack_limits=STACK_LIMITS, seed=0, imports=IMPORTS,
+                   repeat=REPEAT, hash_seed=0):
+    """
+    Benchmark the engine over the selected corpus groups, each word in its own process (see bench_process).
+
+    Returns
+    -------
+    dict
+        Case name -> {seconds, peak_kib, nodes, results}
+    """
+
+    cases = dict()
+    for module in imports:
+        print(f'Importing {module}...', file=sys.stderr, flush=True)
+        seconds, modules = import_time(module)
+        cases[f'import/{module}'] = {'seconds': seconds, 'peak_kib': 0.0, 'nodes': modules, 'results': 0}
+
+    corpus = corpus if corpus else list(CORPUS)
+    for group in corpus:
+        for word in CORPUS[group]:
+            print(f'Benchmarking {word}...', file=sys.stderr, flush=True)
+            cases.update(bench_process(library, word, stack_limits, seed, repeat, hash_seed))
+
+    return cases
+
+
+def compare(cases: dict, baseline: dict, tolerance=0.25, case_tolerance=CASE_TOLERANCE):
+    """
+    Compare benchmark results against a stored baseline.
+
+    Node and result counts must match exactly, as every run does the same work; a change means the engine's
+    results changed, not its speed. Peak memory is flagged per case beyond the tolerance. Times are flagged per case
+    beyond the case tolerance, and overall when the geometric mean of the cases' time ratios passes the tolerance.
+
+    Returns
+    -------
+    list
+        Human-readable regression messages, empty when nothing regressed.
+    """
+
+    regressions = list()
+    ratios = list()
+    for name, case in cases.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        for metric in EXACT:
+            if metric not in case or metric not in base:
+                continue
+            if name.startswith('import/'):
+                if case[metric] > base[metric]:
+                    regressions.append(f'{name}: {metric} {base[metric]} -> {case[metric]}')
+            elif case[metric] != base[metric]:
+                regressions.append(f'{name}: {metric} changed {base[metric]} -> {case[metric]}')
+
+        # Ignore noise on trivially small cases
+        if case['peak_kib'] > max(base['peak_kib'], 64) * (1 + tolerance):
+            regressions.append(f'{name}: peak_kib {base["peak_kib"]:.3f} -> {case["peak_kib"]:.3f}')
+        ratio = max(case['seconds'], 0.01) / max(base['seconds'], 0.01)
+        ratios.append(ratio)
+        if ratio > 1 + case_tolerance:
+            regressions.append(f'{name}: seconds {base["seconds"]:.3f} -> {case["seconds"]:.3f}')
+
+    if ratios and geometric_mean(ratios) > 1 + tolerance:
+        regressions.append(f'all cases: seconds {geometric_mean(ratios):.2f}x the baseline (geometric mean)')
+
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.worker:
+        json.dump(bench_word(Library(args.library), args.worker, args.stack_limits, args.seed, args.repeat), sys.stdout)
+        return 0
+
+    cases = run_benchmarks(args.library, args.corpus, args.stack_limits, args.seed, args.imports, args.repeat,
+                           args.hash_seed)
+
+    name_width = max(map(len, cases))
+    print(f'{"case":<{name_width}}  {"seconds":>9}  {"peak KiB":>10}  {"nodes":>9}  {"results":>8}')
+    for name, case in cases.items():
+        print(f'{name:<{name_width}}  {case["seconds"]:>9.4f}  {case["peak_kib"]:>10.1f}  '
+              f'{case["nodes"]:>9}  {case["results"]:>8}')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(cases, fp, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump(cases, fp, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+
+    if not args.baseline.exists():
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create one.')
+        return 0
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+
+    regressions = compare(cases, baseline, args.tolerance, args.case_tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
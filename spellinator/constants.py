@@ -1,3 +1,6 @@
 color_crimson = 0xDC143C
 color_neongreen = 0x39FF14
-color_royalblue = 0x4169E1
\ No newline at end of file
+color_royalblue = 0x4169E1
+
+# Discord caps embed field values at this many characters
+embed_field_limit = 1024
@@ -0,0 +1,254 @@
+# coding=utf-8
+
+from pathlib import Path
+from statistics import geometric_mean
+from time import perf_counter
+
+import argparse
+import json
+import random
+import sys
+
+from spellinator import reference
+from spellinator import spellinator as engine
+from spellinator.library import Library
+
+__all__ = ['EXHAUSTIVE_STACK_LIMIT', 'LIBRARIES', 'MAX_NODES', 'generate_corpus', 'diff_word', 'run_diff', 'summarize']
+
+LIBRARIES = ('spellinator/en', 'spellinator/sp')
+
+# Generated words are kept to segmentation trees this size, as exhaustive spelling grows exponentially with it
+MAX_NODES = 400
+
+# Larger than any stack a corpus word reaches, so no branch is ever dropped and the visiting order can't matter
+EXHAUSTIVE_STACK_LIMIT = 10 ** 9
+
+
+def parse_args(argv):
+    """
+    Parse command line arguments for the differential test.
+
+    Returns
+    -------
+    args
+        Parsed arguments object from argparse
+    """
+
+    parser = argparse.ArgumentParser(prog='spellinator diff',
+                                     description='Compare the engine against the frozen reference engine.')
+
+    parser.add_argument(
+        '-y',
+        '--library',
+        nargs='+',
+        default=list(LIBRARIES),
+        help='Library directories to generate words from.'
+    )
+
+    parser.add_argument(
+        'words',
+        nargs='*',
+        help='Words to compare, instead of a generated corpus.'
+    )
+
+    parser.add_argument(
+        '-n',
+        '--count',
+        default=20,
+        type=int,
+        help='Generated words per library.'
+    )
+
+    parser.add_argument(
+        '--min-length',
+        default=3,
+        type=int,
+        help='Shortest generated word.'
+    )
+
+    parser.add_argument(
+        '--max-length',
+        default=8,
+        type=int,
+        help='Longest generated word.'
+    )
+
+    parser.add_argument(
+        '--max-nodes',
+        default=MAX_NODES,
+        type=int,
+        help='Skip generated words with larger segmentation trees, which take too long to spell exhaustively.'
+    )
+
+    parser.add_argument(
+        '-s',
+        '--stack-limit',
+        default=EXHAUSTIVE_STACK_LIMIT,
+        type=int,
+        help='Stack limit for both engines. Results only have to match when neither reaches it.'
+    )
+
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Random seed for the corpus and both engines.'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        type=Path,
+        help='Optional JSON file to store the per-word report.'
+    )
+
+    return parser.parse_args(argv)
+
+
+def generate_corpus(library: Library, count: int, min_length: int = 3, max_length: int = 8, seed=0,
+                    max_nodes: int = MAX_NODES) -> list:
+    """
+    Words the library can segment, built from a start grapheme, middle graphemes and an end grapheme.
+
+    Words whose segmentation tree (see estimate_segmentation) has more than max_nodes nodes are skipped.
+
+    Returns
+    -------
+    list
+        Up to count distinct words, the same for the same library and seed.
+    """
+
+    rng = random.Random(seed)
+    # Sorted, since grapheme order follows set iteration and so the hash seed
+    graphemes = sorted((name for name in library.grapheme_dict if name.isalpha()))
+    starts = [name for name in graphemes if library.grapheme_dict[name].starts]
+    middles = [name for name in graphemes if library.grapheme_dict[name].middles]
+    ends = [name for name in graphemes if library.grapheme_dict[name].ends]
+
+    words = dict()
+    for _ in range(count * 100):
+        if len(words) >= count:
+            break
+        target = rng.randint(min_length, max_length)
+        word = rng.choice(starts)
+        while len(word) < target - 1:
+            word += rng.choice(middles)
+        word += rng.choice(ends)
+        if not min_length <= len(word) <= max_length or word in words:
+            continue
+        if engine.estimate_segmentation(word, library.grapheme_dict.values()) <= max_nodes:
+            words[word] = None
+
+    return list(words)
+
+
+def diff_word(library: Library, word: str, allow_homographs=False, stack_limit=EXHAUSTIVE_STACK_LIMIT, seed=0):
+    """
+    Spell a word with the frozen reference and with the engine, and compare the result sets.
+
+    Returns
+    -------
+    dict
+        The word's report: result counts, spellings missing from or extra in the engine's results, whether
+        either engine reached the stack limit, both run times and the engine's speedup.
+    """
+
+    # Each speller gets its own generator, seeded alike, so neither touches the shared random module's state
+    start = perf_counter()
+    expected, reference_limited = reference.spell(word, library.phoneme_dict, library.grapheme_dict,
+                                                  library.weight_dict, allow_homographs, stack_limit=stack_limit,
+                                                  rng=random.Random(seed))
+    reference_seconds = perf_counter() - start
+
+    argv = [word, '-y', str(library.directory), '-s', str(stack_limit)] + (['-a'] if allow_homographs else [])
+    args = engine.parse_args(argv)
+    stats = engine.SpellStats(word)
+    actual = set()
+    start = perf_counter()
+    for _ in engine.iter_spell(args, stats, actual, library=library, rng=random.Random(seed)):
+        pass
+    candidate_seconds = perf_counter() - start
+
+    return {
+        'library': library.directory.name,
+        'word': word,
+        'homographs': allow_homographs,
+        'reference': len(expected),
+        'candidate': len(actual),
+        'missing': sorted(expected - actual),
+        'extra': sorted(actual - expected),
+        'limited': reference_limited or stats.stack_limited,
+        'reference_seconds': reference_seconds,
+        'candidate_seconds': candidate_seconds,
+        'speedup': reference_seconds / candidate_seconds if candidate_seconds else float('inf'),
+    }
+
+
+def run_diff(libraries=LIBRARIES, words=None, count=20, min_length=3, max_length=8, max_nodes=MAX_NODES,
+             stack_limit=EXHAUSTIVE_STACK_LIMIT, seed=0) -> list:
+    """
+    Diff every word of a generated (or given) corpus, with and without homographs, in every library.
+
+    Returns
+    -------
+    list
+        One diff_word report per word, library and homograph setting.
+    """
+
+    reports = list()
+    for directory in libraries:
+        library = Library(directory)
+        corpus = words if words else generate_corpus(library, count, min_length, max_length, seed, max_nodes)
+        for word in corpus:
+            print(f'Comparing {library.directory.name}/{word}...', file=sys.stderr, flush=True)
+            for allow_homographs in (False, True):
+                reports.append(diff_word(library, word.lower(), allow_homographs, stack_limit, seed))
+
+    return reports
+
+
+def summarize(reports: list) -> dict:
+    """
+    Totals over a run: words compared, mismatches (words whose result sets differ without either engine
+    reaching the stack limit) and the geometric mean speedup.
+    """
+
+    mismatches = [report for report in reports if (report['missing'] or report['extra']) and not report['limited']]
+    speedups = [report['speedup'] for report in reports if 0 < report['speedup'] < float('inf')]
+    return {
+        'compared': len(reports),
+        'mismatches': len(mismatches),
+        'limited': sum(report['limited'] for report in reports),
+        'speedup': geometric_mean(speedups) if speedups else None,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    reports = run_diff(args.library, args.words, args.count, args.min_length, args.max_length, args.max_nodes,
+                       args.stack_limit, args.seed)
+
+    name_width = max((len(f'{report["library"]}/{report["word"]}') for report in reports), default=4)
+    print(f'{"word":<{name_width}}  {"-a":>2}  {"results":>8}  {"missing":>7}  {"extra":>5}  {"speedup":>7}')
+    for report in reports:
+        name = f'{report["library"]}/{report["word"]}'
+        flag = 'a' if report['homographs'] else ''
+        note = '  stack limited' if report['limited'] else ''
+        print(f'{name:<{name_width}}  {flag:>2}  {report["reference"]:>8}  {len(report["missing"]):>7}  '
+              f'{len(report["extra"]):>5}  {report["speedup"]:>6.2f}x{note}')
+
+    summary = summarize(reports)
+    speedup = f'{summary["speedup"]:.2f}x' if summary['speedup'] else 'n/a'
+    print(f'{summary["compared"]} compared, {summary["mismatches"]} mismatched, {summary["limited"]} stack limited, '
+          f'{speedup} mean speedup')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'summary': summary, 'words': reports}, fp, indent=2)
+
+    return 1 if summary['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
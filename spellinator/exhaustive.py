@@ -0,0 +1,263 @@
+# coding=utf-8
+
+from heapq import merge
+from tempfile import TemporaryDirectory
+
+import os
+import sys
+
+from spellinator.spellinator import SequenceNode, SpellStats, WeightTable, column_count, join_graphemes, list_columns
+from spellinator.spellinator import request_library, sequence_weight, transcription_roots, transcription_step
+
+__all__ = ['SortedSpill', 'segmentation_graph', 'iter_transcriptions', 'spell_exhaustive', 'run_exhaustive']
+
+# Spellings shown in columns when --exhaustive runs without --limit; --output gets all of them
+PRINT_LIMIT = 1000
+
+# Runs merged at once, kept well under the open file limit
+MAX_FANIN = 64
+
+# Bytes a buffered spelling costs beyond its own size: its set slot, at the set's worst load factor, and
+# its share of the list it is sorted into
+_ENTRY_OVERHEAD = 64
+
+
+class SortedSpill:
+    """
+    Set of strings held within a memory budget, iterated in sorted order without duplicates.
+
+    Strings are buffered in a set until their estimated size passes memory_cap bytes, then written out as a
+    sorted run in a temporary directory. Iterating merges the runs and the buffer. Holding the strings costs at
+    most memory_cap bytes, and the merge holds one line per run.
+    """
+
+    def __init__(self, memory_cap: int, directory=None):
+        self.memory_cap = memory_cap
+        self.buffer = set()
+        self.buffer_bytes = 0
+        self.runs = list()
+        self._written = 0
+        self._tmp = TemporaryDirectory(prefix='spellinator-', dir=directory)
+
+    def __repr__(self):
+        return f'SortedSpill({len(self.buffer)} buffered, {len(self.runs)} runs)'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.buffer = set()
+        self._tmp.cleanup()
+
+    def add(self, item: str) -> None:
+        if item in self.buffer:
+            return
+        self.buffer.add(item)
+        self.buffer_bytes += sys.getsizeof(item) + _ENTRY_OVERHEAD
+        if self.buffer_bytes > self.memory_cap:
+            self.spill()
+
+    def _write_run(self, items) -> str:
+        path = os.path.join(self._tmp.name, f'{self._written}.run')
+        self._written += 1
+        with open(path, 'w', encoding='utf-8') as fp:
+            for item in items:
+                fp.write(item)
+                fp.write('\n')
+        return path
+
+    def spill(self) -> None:
+        if not self.buffer:
+            return
+        self.runs.append(self._write_run(sorted(self.buffer)))
+        self.buffer = set()
+        self.buffer_bytes = 0
+
+    def _read_run(self, path):
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                yield line[:-1]
+
+    def _merge(self, streams):
+        previous = None
+        for item in merge(*streams):
+            if item != previous:
+                yield item
+                previous = item
+
+    def __iter__(self):
+        # Merge in rounds so no more than MAX_FANIN runs are open at once
+        while len(self.runs) >= MAX_FANIN:
+            batch, self.runs = self.runs[:MAX_FANIN], self.runs[MAX_FANIN:]
+            self.runs.append(self._write_run(self._merge([self._read_run(path) for path in batch])))
+            for path in batch:
+                os.remove(path)
+
+        return self._merge([self._read_run(path) for path in self.runs] + [iter(sorted(self.buffer))])
+
+
+def segmentation_graph(rna: str, genes, stats: SpellStats = None) -> list:
+    """
+    The segmentation trees reverse_translate builds for a word (without fast mode), with the nodes below each
+    remainder built once and shared.
+
+    Every node's children depend only on its remainder, which is always a suffix of the word (see
+    estimate_segmentation), so the nodes with the same remainder share one list of children. The graph holds at
+    most one node per suffix and reading of a grapheme, where the tree can grow exponentially with the word, and
+    walking it from the returned roots follows the same paths as walking the trees. stats.segmentation_nodes
+    counts the nodes of the graph.
+    """
+
+    stats = stats if stats is not None else SpellStats(rna)
+    genes = list(genes)
+    starting_genes = [gene for gene in genes if gene.starts]
+    middling_genes = [gene for gene in genes if gene.middles]
+    ending_genes = [gene for gene in genes if gene.ends]
+
+    def node(amino, remainder, stop_valid=False):
+        stats.segmentation_nodes += 1
+        return SequenceNode(amino, remainder, stop_valid, stats.segmentation_nodes - 1)
+
+    # Children of a node with the given remainder, built from the shortest remainder up
+    children = {'': []}
+    for idx in range(len(rna) - 1, 0, -1):
+        remaining_word = rna[idx:]
+        follow = list()
+        for eg in ending_genes:
+            if remaining_word == str(eg):
+                follow.extend(node(amino, None, True) for amino in eg.ends)
+        for mg in middling_genes:
+            if remaining_word.startswith(str(mg)) and len(remaining_word) > len(str(mg)):
+                new_remainder = remaining_word[len(str(mg)):]
+                for amino in mg.middles:
+                    middle = node(amino, new_remainder)
+                    middle.follow = children[new_remainder]
+                    follow.append(middle)
+        children[remaining_word] = follow
+
+    roots = list()
+    for sg in starting_genes:
+        if rna == str(sg):
+            roots.extend(node(amino, None, True) for amino in sg.starts)
+        if rna.startswith(str(sg)):
+            for amino in sg.starts:
+                start = node(amino, rna[len(str(sg)):])
+                start.follow = children[start.remainder]
+                roots.append(start)
+
+    return roots
+
+
+def iter_transcriptions(start_codon, mapping_dict: dict, weight_table: WeightTable, allow_homographs: bool = False,
+                        graph_threshold: float = 0.25, length_threshold: float = 1.10, target_length: int = 1,
+                        stats: SpellStats = None):
+    """
+    Every transcription of a segmentation tree, as transcribe would find them with no stack limit.
+
+    Each step is transcribe's own (see transcription_step), but the tree is walked depth first, so only the
+    branches pending along the current path are held rather than every partial transcription. Transcriptions are
+    yielded as they complete and may repeat.
+
+    Yields
+    ------
+    tuple
+        (anticodon, codon) if allow_homographs, else anticodon.
+    """
+
+    stats = stats if stats is not None else SpellStats()
+    stack = transcription_roots(start_codon, mapping_dict, tuple)
+
+    while stack:
+        curr, anticodon, codon = stack.pop()
+        stats.transcription_nodes += 1
+
+        completed, children = transcription_step(curr, anticodon, codon, mapping_dict, weight_table,
+                                                 graph_threshold, length_threshold, target_length, stats, tuple)
+        for new_anticodon, new_codon in completed:
+            yield (new_anticodon, new_codon) if allow_homographs else new_anticodon
+        stack.extend(children)
+
+
+def spell_exhaustive(args, stats: SpellStats, library=None, memory_cap: int = None, directory=None) -> SortedSpill:
+    """
+    Every spelling of a parsed request, scored as true_translate does, collected into a SortedSpill.
+
+    The segmentation is always complete (--limit does not switch on fast mode) and built as a segmentation_graph,
+    so it stays small next to --memory-cap however many paths it has. --stack-limit is ignored.
+
+    Parameters
+    ----------
+    memory_cap : int
+        Bytes of spellings held in memory, defaults to --memory-cap.
+    directory : str
+        Where to spill sorted runs, defaults to the system temporary directory.
+
+    Returns
+    -------
+    SortedSpill
+        The spellings; the caller closes it to remove the spilled runs.
+    """
+
+    weight_dict, weight_table, grapheme_dict, phoneme_dict = request_library(args, library)
+    target_length = len(stats.word)
+    memory_cap = memory_cap if memory_cap is not None else int(args.memory_cap * 2 ** 20)
+
+    with stats.timer('segmentation'):
+        phonetic_sequences = segmentation_graph(stats.word, grapheme_dict.values(), stats)
+
+    spellings = SortedSpill(memory_cap, directory)
+    with stats.timer('transcription'):
+        for pseq in phonetic_sequences:
+            for seq in iter_transcriptions(pseq, phoneme_dict, weight_table, args.allow_homographs,
+                                           args.graph_threshold, args.length_threshold, target_length, stats):
+                graphic = join_graphemes(seq[0] if args.allow_homographs else seq)
+                if sequence_weight(graphic, weight_table.weights) < args.graph_threshold:
+                    stats.final_rejections += 1
+                elif args.allow_homographs:
+                    phonetic = ''.join(map(str, seq[1]))
+                    spellings.add(f'{phonetic:<{target_length + 2}}' + ' -> ' + graphic)
+                else:
+                    spellings.add(graphic)
+
+    return spellings
+
+
+def run_exhaustive(args, stats: SpellStats, stats_hook=None, library=None) -> str:
+    """
+    Run a parsed --exhaustive request: write every spelling, sorted, to --output and print the first ones.
+
+    Returns
+    -------
+    str
+        The first --limit (or PRINT_LIMIT) spellings in columns.
+    """
+
+    with spell_exhaustive(args, stats, library) as spellings:
+        with stats.timer('formatting'):
+            shown = list()
+            limit = args.limit if args.limit else PRINT_LIMIT
+            output = open(args.output, 'w') if args.output else None
+            try:
+                for spelling in spellings:
+                    if output is not None:
+                        output.write(f'\n{spelling}' if stats.results else spelling)
+                    if len(shown) < limit:
+                        shown.append(spelling)
+                    stats.results += 1
+            finally:
+                if output is not None:
+                    output.close()
+
+            printer = list_columns(shown, column_count(args, len(stats.word)), True, 6, None, args.max_chars)
+
+    if args.metrics:
+        with open(args.metrics, 'w') as fp:
+            fp.write(stats.to_openmetrics())
+
+    if stats_hook:
+        stats_hook(stats)
+
+    return printer
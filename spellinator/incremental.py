@@ -0,0 +1,275 @@
+# coding=utf-8
+
+from pathlib import Path
+
+import random
+
+from spellinator.spellinator import join_graphemes, load_nemes, load_weights, load_weight_table, sequence_weight
+
+__all__ = ['IncrementalSpeller', 'load_speller']
+
+
+class IncrementalSpeller:
+    """
+    Spell a word as it is typed, extending the previous keystroke's work instead of starting over.
+
+    The segmentation is kept as a lattice of grapheme edges keyed by the position they end at, so typing a
+    character only matches the graphemes ending at the new position. For every position the speller keeps a
+    frontier of partial transcriptions (start and middle graphemes, already checked against the weight model)
+    that a later edge may continue. Frontiers are built the first time an edge continues from them and kept for
+    every later keystroke, so completing the current text mostly joins end graphemes onto existing frontiers.
+    A frontier cut short by max_work, or built on one that was, is kept but expanded again by the next completion.
+
+    Results match true_translate over reverse_translate's full (non fast_mode) segmentation with no stack
+    limit. The length threshold only ever rejects a transcription for its final length, so it is applied at
+    completion. Completing a keystroke expands at most max_work transcriptions; past that the remaining ones
+    are dropped, in random order like transcribe's stack limit, and truncated is set.
+    """
+
+    def __init__(self, grapheme_dict: dict, phoneme_dict: dict, weight_table, allow_homographs: bool = False,
+                 graph_threshold: float = 0.25, length_threshold: float = 1.10, max_work: int = 20000, rng=random):
+        self.grapheme_dict = grapheme_dict
+        self.phoneme_dict = phoneme_dict
+        self.weight_table = weight_table
+        self.allow_homographs = allow_homographs
+        self.graph_threshold = graph_threshold
+        self.length_threshold = length_threshold
+        self.max_work = max_work
+        self.rng = rng
+        self.max_grapheme = max(map(len, grapheme_dict), default=0)
+        self._renderings = dict()
+
+        self.text = ''
+        # Index j holds the edges and frontier of position j, i.e. after j characters. Frontiers are None until
+        # first needed, and hold (anticodon, codon, length, has_middle) states of grapheme and phoneme names.
+        self.ending_at = [[]]
+        self.starting_at = [[]]
+        self.frontiers = [set()]
+        self.truncated_at = [False]
+        # Positions whose frontier the current completion has already built, truncated or not
+        self._expanded = set()
+        self.work = 0
+        self._results = None
+        self._completion_truncated = False
+
+    def __repr__(self):
+        return f'IncrementalSpeller({self.text!r}, {sum(len(f) for f in self.frontiers if f)} states)'
+
+    def __len__(self):
+        return len(self.text)
+
+    @property
+    def truncated(self) -> bool:
+        """
+        Whether any frontier of the current text, or its completion, was cut short by max_work.
+        """
+
+        return any(self.truncated_at) or self._completion_truncated
+
+    def append(self, chars: str) -> None:
+        for char in chars:
+            self.text += char
+            end = len(self.text)
+            self.ending_at.append([])
+            self.starting_at.append([])
+            self.frontiers.append(None)
+            self.truncated_at.append(False)
+
+            for start in range(max(0, end - self.max_grapheme), end):
+                grapheme = self.grapheme_dict.get(self.text[start:end])
+                if grapheme is not None:
+                    self.ending_at[end].append((start, grapheme))
+                    self.starting_at[start].append((end, grapheme))
+
+        self._results = None
+
+    def pop(self, count: int = 1) -> None:
+        """
+        Forget the last count characters, e.g. on backspace. Earlier positions are kept as they are.
+        """
+
+        keep = max(0, len(self.text) - count)
+        self.text = self.text[:keep]
+        del self.ending_at[keep + 1:]
+        del self.frontiers[keep + 1:]
+        del self.truncated_at[keep + 1:]
+        for edges in self.starting_at[:keep + 1]:
+            edges[:] = [edge for edge in edges if edge[0] <= keep]
+        del self.starting_at[keep + 1:]
+        self._results = None
+
+    def update(self, text: str) -> set:
+        """
+        Move to new text, reusing the state of the prefix it shares with the current text.
+
+        Returns
+        -------
+        set
+            The spellings of the new text.
+        """
+
+        words = text.split()
+        word = words[0].lower() if words else ''
+        shared = 0
+        for old, new in zip(self.text, word):
+            if old != new:
+                break
+            shared += 1
+        self.pop(len(self.text) - shared)
+        self.append(word[shared:])
+
+        return self.spellings()
+
+    def _render(self, phoneme, role: str) -> tuple:
+        # Grapheme names a phoneme is written with in a role, cached by name
+        key = (str(phoneme), role)
+        if key not in self._renderings:
+            self._renderings[key] = tuple(map(str, getattr(self.phoneme_dict[str(phoneme)], role)))
+        return self._renderings[key]
+
+    def _spend(self) -> bool:
+        if self.work >= self.max_work:
+            return False
+        self.work += 1
+        return True
+
+    def _frontier(self, position: int) -> set:
+        cached = self.frontiers[position]
+        if cached is not None and (not self.truncated_at[position] or position in self._expanded):
+            return cached
+
+        # A truncated frontier's states are all valid, so expanding it again only adds to them
+        states = set(cached) if cached else set()
+        truncated = False
+        incomplete = False
+        edges = self.ending_at[position]
+        for start, grapheme in self.rng.sample(edges, len(edges)):
+            if start == 0:
+                for phoneme in grapheme.starts:
+                    codon = (str(phoneme),) if self.allow_homographs else ()
+                    for first in self._render(phoneme, 'starts'):
+                        states.add(((first,), codon, len(first), False))
+                continue
+            if not grapheme.middles:
+                continue
+
+            frontier = list(self._frontier(start))
+            incomplete = incomplete or self.truncated_at[start]
+            for anticodon, codon, length, _ in self.rng.sample(frontier, len(frontier)):
+                for phoneme in grapheme.middles:
+                    new_codon = codon + (str(phoneme),) if self.allow_homographs else ()
+                    for middle in self._render(phoneme, 'middles'):
+                        if not self._spend():
+                            truncated = True
+                            break
+                        new_anticodon = anticodon + (middle,)
+                        if self.weight_table.score(new_anticodon) >= self.graph_threshold:
+                            states.add((new_anticodon, new_codon, length + len(middle), True))
+                    if truncated:
+                        break
+                if truncated:
+                    break
+            if truncated:
+                break
+
+        self.frontiers[position] = states
+        self.truncated_at[position] = truncated or incomplete
+        self._expanded.add(position)
+        return states
+
+    def _has_follow(self, position: int) -> bool:
+        # Mirrors a segmentation node having children: a middle leaving text after it, or an end finishing it
+        end = len(self.text)
+        return any(
+            (stop < end and grapheme.middles) or (stop == end and grapheme.ends)
+            for stop, grapheme in self.starting_at[position]
+        )
+
+    def _complete(self) -> set:
+        end = len(self.text)
+        self.work = 0
+        self._expanded.clear()
+        self._completion_truncated = False
+        if not end:
+            return set()
+
+        transcriptions = set()
+        # A start that covers the word, or that the segmentation cannot continue, is transcribed on its own
+        nulls = self._render('', 'ends')
+        for stop, grapheme in self.starting_at[0]:
+            if stop == end or not self._has_follow(stop):
+                for phoneme in grapheme.starts:
+                    codon = (str(phoneme),) if self.allow_homographs else ()
+                    for first in self._render(phoneme, 'starts'):
+                        for null in nulls:
+                            transcriptions.add(((first, null), codon))
+
+        truncated = False
+        for start, grapheme in self.ending_at[end]:
+            if start == 0 or not grapheme.ends:
+                continue
+            for anticodon, codon, length, has_middle in self._frontier(start):
+                if has_middle and length / end > self.length_threshold:
+                    continue
+                for phoneme in grapheme.ends:
+                    new_codon = codon + (str(phoneme),) if self.allow_homographs else ()
+                    for last in self._render(phoneme, 'ends'):
+                        if not self._spend():
+                            truncated = True
+                            break
+                        transcriptions.add((anticodon + (last,), new_codon))
+                    if truncated:
+                        break
+                if truncated:
+                    break
+            if truncated:
+                break
+        self._completion_truncated = truncated
+
+        spellings = set()
+        weights = dict()
+        for anticodon, codon in transcriptions:
+            graphic = join_graphemes(anticodon)
+            if graphic not in weights:
+                weights[graphic] = sequence_weight(graphic, self.weight_table.weights)
+            if weights[graphic] < self.graph_threshold:
+                continue
+            if self.allow_homographs:
+                phonetic = ''.join(codon)
+                spellings.add(f'{phonetic:<{end + 2}}' + ' -> ' + graphic)
+            else:
+                spellings.add(graphic)
+
+        return spellings
+
+    def spellings(self) -> set:
+        """
+        Spellings of the current text, computed once per keystroke.
+        """
+
+        if self._results is None:
+            self._results = self._complete()
+        return self._results
+
+
+def load_speller(library='spellinator/en', phoneme_map=None, context_window: int = 3, **kwargs) -> IncrementalSpeller:
+    """
+    Build an IncrementalSpeller over a library directory, sharing the engine's memoized library and weights.
+
+    Parameters
+    ----------
+    library : str
+        Directory path containing weights.csv and phonemes.csv
+    phoneme_map : str
+        Optional output phoneme map for transliterations.
+    kwargs
+        Passed on to IncrementalSpeller.
+    """
+
+    weights = Path(library, 'weights.csv')
+    weight_table = load_weight_table(weights, load_weights(weights), context_window)
+    phoneme_dict, grapheme_dict = load_nemes(Path(library, 'phonemes.csv'))
+    if phoneme_map:
+        phoneme_dict, _ = load_nemes(phoneme_map)
+
+    return IncrementalSpeller(grapheme_dict, phoneme_dict, weight_table, **kwargs)
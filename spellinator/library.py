@@ -0,0 +1,173 @@
+# coding=utf-8
+
+from pathlib import Path
+
+import asyncio
+import csv
+import hashlib
+import os
+import threading
+
+from spellinator.analyze import load_profile
+from spellinator.spellinator import WeightTable, compile_nemes, generate_weights
+
+__all__ = ['Library', 'LibraryRegistry', 'library_files', 'fingerprint', 'registry']
+
+
+def library_files(directory) -> tuple:
+    """
+    The (weights, phonemes) files of a library directory.
+    """
+
+    return Path(directory, 'weights.csv'), Path(directory, 'phonemes.csv')
+
+
+def fingerprint(paths) -> str:
+    """
+    Hash of the contents of a library's files, identifying the version results were computed with.
+    """
+
+    digest = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        with open(path, 'rb') as fp:
+            digest.update(fp.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _mtimes(paths) -> tuple:
+    return tuple(os.stat(path).st_mtime_ns for path in paths)
+
+
+class Library:
+    """
+    One compiled version of a library directory, never modified once built.
+
+    Requests hold on to the Library they started with, so a reload only affects requests started after it. Weight
+    tables are built lazily per context window and belong to this version, so a reload never mixes weights.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.files = library_files(directory)
+        self.fingerprint = fingerprint(self.files)
+        # The fan-out profile depends only on the phonemes, so editing the weights keeps a stored profile valid
+        self.profile_fingerprint = fingerprint(self.files[1:])
+        self.weight_dict = generate_weights(self.files[0])
+        self.phoneme_dict, self.grapheme_dict = compile_nemes(self.files[1])
+        self.weight_tables = dict()
+        self._profile = None
+
+    def __repr__(self):
+        return f'Library({self.directory}, {self.fingerprint})'
+
+    @property
+    def profile(self) -> dict:
+        """
+        The fan-out profile of this version, from the profile.json written by `spellinator analyze` when it
+        matches profile_fingerprint, otherwise built on first use.
+        """
+
+        if self._profile is None:
+            self._profile = load_profile(self)
+        return self._profile
+
+    def weight_table(self, context_window: int = 3) -> WeightTable:
+        if context_window not in self.weight_tables:
+            self.weight_tables[context_window] = WeightTable(self.weight_dict, context_window)
+        return self.weight_tables[context_window]
+
+
+class LibraryRegistry:
+    """
+    The current Library of each library directory in use, reloaded when its files change.
+
+    poll() compares file modification times and recompiles changed libraries, then swaps the new version in with a
+    single dict assignment; lookups never wait for a recompile. A library that fails to compile (e.g. a file caught
+    half written) keeps its previous version until its files change again. watch() polls from the event loop,
+    compiling in a worker thread.
+    """
+
+    def __init__(self):
+        self._current = dict()
+        self._mtimes = dict()
+        # Serializes loading and reloading, never held by lookups of a loaded library
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'LibraryRegistry({len(self._current)} libraries)'
+
+    def __len__(self):
+        return len(self._current)
+
+    def libraries(self) -> list:
+        return list(self._current.values())
+
+    def get(self, directory) -> Library:
+        """
+        The current version of a library, compiling it on first request.
+        """
+
+        key = Path(directory).resolve()
+        library = self._current.get(key)
+        if library is None:
+            with self._lock:
+                if key not in self._current:
+                    self._load(key)
+                library = self._current[key]
+        return library
+
+    def _load(self, key: Path) -> Library:
+        before = _mtimes(library_files(key))
+        library = Library(key)
+        # Files changed while compiling are left for the next poll to pick up again
+        if _mtimes(library.files) == before:
+            self._mtimes[key] = before
+        if key not in self._current or self._current[key].fingerprint != library.fingerprint:
+            self._current[key] = library
+        return self._current[key]
+
+    def poll(self) -> dict:
+        """
+        Reload every library whose files changed since it was compiled.
+
+        Returns
+        -------
+        dict
+            Directory -> the new Library, or the exception that kept it from loading, for each library reloaded.
+            A file touched without changing its contents reloads nothing.
+        """
+
+        reloaded = dict()
+        with self._lock:
+            for key, library in list(self._current.items()):
+                try:
+                    if _mtimes(library.files) == self._mtimes.get(key):
+                        continue
+                    new_library = self._load(key)
+                except (OSError, ValueError, csv.Error) as exc:
+                    # Not retried until the files change again
+                    try:
+                        self._mtimes[key] = _mtimes(library.files)
+                    except OSError:
+                        pass
+                    reloaded[key] = exc
+                    continue
+                if new_library is not library:
+                    reloaded[key] = new_library
+
+        return reloaded
+
+    async def watch(self, interval: float = 2.0, callback=None) -> None:
+        """
+        Poll forever, every interval seconds, calling callback with poll()'s result whenever something reloaded.
+        """
+
+        while True:
+            await asyncio.sleep(interval)
+            reloaded = await asyncio.to_thread(self.poll)
+            if reloaded and callback:
+                callback(reloaded)
+
+
+registry = LibraryRegistry()
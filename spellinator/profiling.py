@@ -0,0 +1,265 @@
+# coding=utf-8
+
+from collections import Counter
+from contextlib import contextmanager
+from copy import copy
+from time import perf_counter_ns
+
+import cProfile
+import os
+import pstats
+import random
+import sys
+import tracemalloc
+
+from spellinator.spellinator import SpellStats, WeightTable, finish_spell, iter_reverse_translate
+from spellinator.spellinator import iter_spell, iter_transcribe, join_graphemes, list_columns, parse_args
+from spellinator.spellinator import sequence_weight
+
+__all__ = ['HOTSPOTS', 'ProfiledStats', 'ProfileReport', 'StackCollector', 'profile_request']
+
+# Engine functions the breakdown always lists, whether or not the request reached them
+HOTSPOTS = (iter_reverse_translate, iter_transcribe, WeightTable.score, WeightTable.__getitem__, sequence_weight,
+            join_graphemes, list_columns)
+
+# Rows in the lists of functions by own time and of live allocations
+TOP = 10
+
+
+def _where(code) -> str:
+    return f'{os.path.basename(code.co_filename)}:{code.co_qualname}'
+
+
+class ProfiledStats(SpellStats):
+    """
+    SpellStats that also measures memory per stage while tracemalloc is tracing.
+
+    peaks holds the most memory each stage allocated on top of what was held when it started, and blocks the
+    memory blocks it left allocated (negative when it freed more than it allocated). peak is the request's peak.
+    tracemalloc and sys.getallocatedblocks count the whole process, so allocations by other threads while the
+    request runs are included.
+    """
+
+    def __init__(self, word: str = ''):
+        super().__init__(word)
+        self.peaks = dict.fromkeys(self.stages, 0)
+        self.blocks = dict.fromkeys(self.stages, 0)
+        self.peak = 0
+
+    @contextmanager
+    def timer(self, stage: str):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+        blocks = sys.getallocatedblocks()
+        try:
+            with super().timer(stage):
+                yield self
+        finally:
+            self.blocks[stage] += sys.getallocatedblocks() - blocks
+            _, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            self.peaks[stage] = max(self.peaks[stage], peak - current)
+
+
+class StackCollector:
+    """
+    Profile function (see sys.setprofile) charging the time between calls and returns to the stack it was spent in.
+
+    The stack is followed from the call and return events, starting empty where the collector is installed. Stacks
+    are written in the collapsed format of flamegraph.pl and speedscope: one line per stack, frames joined by ';',
+    then the microseconds spent in it. Expect the request to run ten to twenty times slower while it is collecting.
+    """
+
+    def __init__(self):
+        self.stacks = Counter()
+        # The stack at each depth, joined, so an event never walks the frames
+        self._stacks = list()
+        self._last = perf_counter_ns()
+
+    def __repr__(self):
+        return f'StackCollector({len(self.stacks)} stacks)'
+
+    def _push(self, name: str) -> None:
+        self._stacks.append(f'{self._stacks[-1]};{name}' if self._stacks else name)
+
+    def __call__(self, frame, event, arg):
+        now = perf_counter_ns()
+        if self._stacks:
+            self.stacks[self._stacks[-1]] += now - self._last
+        if event == 'call':
+            self._push(_where(frame.f_code))
+        elif event == 'c_call':
+            self._push(f'{getattr(arg, "__module__", None) or "builtins"}:{arg.__qualname__}')
+        elif self._stacks:
+            # return, c_return or c_exception; returns of calls made before the collector was installed are ignored
+            self._stacks.pop()
+        self._last = perf_counter_ns()
+
+    def write(self, stream) -> int:
+        lines = 0
+        for stack, nanoseconds in sorted(self.stacks.items()):
+            if nanoseconds >= 1000:
+                stream.write(f'{stack} {nanoseconds // 1000}\n')
+                lines += 1
+        return lines
+
+
+class ProfileReport:
+    """
+    Where a single spell request spends its time and memory.
+
+    stats comes from a run without any profiler, so its stage timings are the request's real ones. hotspots are
+    (function, calls, own seconds, cumulative seconds) rows from cProfile for HOTSPOTS, ranked by cumulative time,
+    and functions the TOP rows by own time across everything. memory is the ProfiledStats of a run under tracemalloc
+    and allocations the (line, bytes, blocks) still allocated by the engine when the request completed.
+    """
+
+    def __init__(self, stats: SpellStats, hotspots: list, functions: list, total: float, memory: ProfiledStats,
+                 allocations: list, collapsed=None):
+        self.stats = stats
+        self.hotspots = hotspots
+        self.functions = functions
+        self.total = total
+        self.memory = memory
+        self.allocations = allocations
+        self.collapsed = collapsed
+
+    def __repr__(self):
+        return f'ProfileReport({self.stats.word!r}, {self.total:.3f}s profiled, peak {self.memory.peak} bytes)'
+
+    def summary(self) -> str:
+        stats, memory = self.stats, self.memory
+        lines = [
+            f'Profile of {stats.word!r}: {stats.results} results, {stats.segmentation_nodes} segmentation nodes, '
+            f'{stats.transcription_nodes} transcription nodes, {stats.rejections} rejections'
+            f'{", stack limited" if stats.stack_limited else ""}',
+            '',
+            f'{"stage":<14}  {"seconds":>9}  {"share":>6}  {"peak KiB":>10}  {"net blocks":>10}',
+        ]
+        for stage in stats.stages:
+            share = stats.timings[stage] / stats.total_time if stats.total_time else 0.0
+            lines.append(f'{stage:<14}  {stats.timings[stage]:>9.4f}  {share:>6.1%}  '
+                         f'{memory.peaks[stage] / 1024:>10.1f}  {memory.blocks[stage]:>10}')
+        lines.append(f'{"total":<14}  {stats.total_time:>9.4f}  {"":>6}  {memory.peak / 1024:>10.1f}  '
+                     f'{sum(memory.blocks.values()):>10}')
+
+        def table(title, rows):
+            lines.extend(['', f'{title:<44}  {"calls":>9}  {"own s":>8}  {"cum s":>8}  {"cum %":>6}'])
+            for name, calls, own, cumulative in rows:
+                share = cumulative / self.total if self.total else 0.0
+                lines.append(f'{name:<44}  {calls:>9}  {own:>8.4f}  {cumulative:>8.4f}  {share:>6.1%}')
+
+        table('engine hotspots (cProfile)', self.hotspots)
+        table('most own time', self.functions)
+
+        lines.extend(['', f'{"live allocations after the request":<44}  {"KiB":>9}  {"blocks":>8}'])
+        for where, size, blocks in self.allocations:
+            lines.append(f'{where:<44}  {size / 1024:>9.1f}  {blocks:>8}')
+        lines.extend(['', 'Memory is measured for the whole process, including other threads running meanwhile.'])
+
+        if self.collapsed:
+            lines.extend(['', f'Collapsed stacks written to {self.collapsed}'])
+
+        return '\n'.join(lines)
+
+
+def _spell(args, stats: SpellStats, library, seed) -> str:
+    # A fresh copy for every run, as --budget rewrites the parsed arguments. The request gets its own generator,
+    # as the profile may run in a thread while other requests draw from the shared one.
+    args = copy(args)
+    if args.exhaustive:
+        # Imported here like in run(), only the command line enumerates exhaustively
+        from spellinator.exhaustive import run_exhaustive
+        return run_exhaustive(args, stats, library=library)
+
+    glist_full = set()
+    for _ in iter_spell(args, stats, glist_full, library=library, rng=random.Random(seed)):
+        pass
+    return finish_spell(args, glist_full, stats)
+
+
+def profile_request(argv=None, library=None, seed: int = 0, args=None) -> ProfileReport:
+    """
+    Run one spell request several times, each under a different instrument, and report where it spends its time
+    and memory.
+
+    The request first runs once without instruments, which also compiles the weight table entries it needs, so the
+    later runs measure a warm engine. It then runs under cProfile, under tracemalloc, and with --collapsed under a
+    StackCollector, each shuffling with its own random.Random seeded alike, so every run does the same work and the
+    shared generator is left alone. cProfile and the StackCollector only see the calling thread, but the memory
+    figures are process-wide (see ProfiledStats).
+
+    Parameters
+    ----------
+    argv : list
+        Command line arguments, as accepted by parse_args.
+    library : spellinator.library.Library
+        Library to spell with, instead of the files named in argv.
+    seed : int
+        Seed for the order nodes are visited in.
+    args : argparse.Namespace
+        Arguments already parsed by parse_args, used instead of parsing argv.
+
+    Returns
+    -------
+    ProfileReport
+    """
+
+    args = args if args is not None else parse_args(argv)
+    word = args.input.split()[0].lower()
+
+    stats = SpellStats(word)
+    _spell(args, stats, library, seed)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        _spell(args, SpellStats(word), library, seed)
+    finally:
+        profiler.disable()
+    profile = pstats.Stats(profiler)
+
+    def row(key):
+        _, calls, own, cumulative, _ = profile.stats[key]
+        filename, _, name = key
+        return f'{os.path.basename(filename)}:{name}' if filename != '~' else name, calls, own, cumulative
+
+    hotspots = list()
+    for function in HOTSPOTS:
+        code = function.__code__
+        key = (code.co_filename, code.co_firstlineno, code.co_name)
+        _, calls, own, cumulative = row(key) if key in profile.stats else (None, 0, 0.0, 0.0)
+        hotspots.append((_where(code), calls, own, cumulative))
+    hotspots.sort(key=lambda hotspot: hotspot[3], reverse=True)
+    functions = [row(key) for key in sorted(profile.stats, key=lambda key: profile.stats[key][2], reverse=True)[:TOP]]
+
+    memory = ProfiledStats(word)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        printer = _spell(args, memory, library, seed)
+        _, peak = tracemalloc.get_traced_memory()
+        memory.peak = max(memory.peak, peak)
+        # Only allocations made by the package, not by the interpreter or the profilers
+        package = tracemalloc.Filter(True, os.path.join(os.path.dirname(__file__), '*'))
+        snapshot = tracemalloc.take_snapshot().filter_traces([package, tracemalloc.Filter(False, __file__)])
+        del printer
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    allocations = [(f'{os.path.basename(statistic.traceback[0].filename)}:{statistic.traceback[0].lineno}',
+                    statistic.size, statistic.count) for statistic in snapshot.statistics('lineno')[:TOP]]
+
+    if args.collapsed:
+        collector = StackCollector()
+        sys.setprofile(collector)
+        try:
+            _spell(args, SpellStats(word), library, seed)
+        finally:
+            sys.setprofile(None)
+        with open(args.collapsed, 'w') as fp:
+            collector.write(fp)
+
+    return ProfileReport(stats, hotspots, functions, profile.total_tt, memory, allocations, args.collapsed)
@@ -0,0 +1,188 @@
+# coding=utf-8
+
+# Frozen copy of reverse_translate -> true_translate as they stood before any performance work, the oracle for
+# spellinator.difftest. Plain functions with no stats, generators or caches; only library parsing is shared with the
+# engine. Do not optimize or refactor this module, its job is to stay the same while the engine changes. Change it
+# only to follow an intended change in the engine's results, in a commit of its own.
+
+import random
+import re
+
+__all__ = ['segment', 'spell']
+
+
+class Node:
+    # Hashed by identity, SequenceNode has since moved to hashing by its serial
+    __slots__ = ('gene', 'remainder', 'follow', 'stop_valid')
+
+    def __init__(self, gene, remainder, stop_valid=False):
+        self.gene = gene
+        self.remainder = remainder
+        self.follow = list()
+        self.stop_valid = stop_valid
+
+    def __repr__(self):
+        return str(self.gene)
+
+
+_null_node = Node('', None, True)
+_wrap_pattern = re.compile(r'\.(\S+) ?(\S*)')
+
+
+def segment(rna: str, genes, fast_mode=False) -> list:
+    """
+    Every way to pronounce a word, as a list of phoneme trees. A copy of reverse_translate.
+    """
+
+    results = []
+    starting_genes = set((gene for gene in genes if gene.starts))
+    middling_genes = set((gene for gene in genes if gene.middles))
+    ending_genes = set((gene for gene in genes if gene.ends))
+
+    word_list = []
+    for sg in starting_genes:
+        if rna == str(sg):
+            for amino in sg.starts:
+                results.append(Node(amino, None, True))
+        if rna.startswith(str(sg)):
+            for amino in sg.starts:
+                word_node = Node(amino, rna.replace(str(sg), '', 1))
+                word_list.append(word_node)
+                results.append(word_node)
+
+    while word_list:
+        new_word_list = []
+        for word_node in word_list:
+            mutation_count = 0
+            remaining_word = word_node.remainder
+            for eg in ending_genes:
+                new_remainder = remaining_word.replace(str(eg), '', 1)
+                if remaining_word.endswith(str(eg)) and len(new_remainder) == 0:
+                    for amino in eg.ends:
+                        word_node.follow.append(Node(amino, None, True))
+
+            for mg in middling_genes:
+                if fast_mode and mutation_count > 3:
+                    break
+                new_remainder = remaining_word.replace(str(mg), '', 1)
+                if remaining_word.startswith(str(mg)) and len(new_remainder) > 0:
+                    for amino in mg.middles:
+                        mutation_count += 1
+                        if fast_mode and mutation_count > 3:
+                            break
+                        new_word_node = Node(amino, new_remainder)
+                        word_node.follow.append(new_word_node)
+                        new_word_list.append(new_word_node)
+
+        word_list = new_word_list
+
+    return results
+
+
+def _sequence_weight(graphic: str, weights) -> float:
+    graph_weight = 1.0
+    for weight, sequences in weights:
+        for wseq in sequences:
+            if wseq in graphic:
+                graph_weight *= weight ** graphic.count(wseq)
+
+    return graph_weight
+
+
+def _join_graphemes(anticodon) -> str:
+    graphic_i = ' '.join(map(str, anticodon))
+    graphic_o = re.sub(_wrap_pattern, r'\2\1', graphic_i)
+    return ''.join(graphic_o.split())
+
+
+def _transcribe(start_codon: Node, mapping_dict: dict, weights, allow_homographs, graph_threshold,
+                length_threshold, stack_limit, context_window, target_length, rng) -> tuple:
+    # A copy of transcribe, scoring windows directly instead of through a WeightTable
+    m_rna = set()
+    stack_limited = False
+    stack = set()
+    starts = tuple(mapping_dict[str(start_codon)].starts)
+
+    for start in rng.sample(starts, len(starts)):
+        added = False
+        for follow in rng.sample(start_codon.follow, len(start_codon.follow)):
+            stack.add((follow, (start,), (start_codon,)))
+            added = True
+        if not added:
+            stack.add((_null_node, (start,), (start_codon,)))
+
+    while stack:
+        curr, anticodon, codon = stack.pop()
+
+        if not curr.follow and curr.stop_valid:
+            ends = tuple(mapping_dict[str(curr)].ends)
+            for end in rng.sample(ends, len(ends)):
+                new_anticodon = anticodon + (end,)
+                new_codon = codon + (curr,)
+                m_rna.add((new_anticodon, new_codon) if allow_homographs else new_anticodon)
+
+        for follow in rng.sample(curr.follow, len(curr.follow)):
+            middles = tuple(mapping_dict[str(curr)].middles)
+            for middle in rng.sample(middles, len(middles)):
+                new_anticodon = anticodon + (middle,)
+                if (sum(map(len, new_anticodon)) / target_length) > length_threshold:
+                    continue
+                window = ''.join(map(str, new_anticodon[-context_window:]))
+                if _sequence_weight(window, weights) >= graph_threshold:
+                    if len(stack) < stack_limit:
+                        stack.add((follow, new_anticodon, codon + (curr,)))
+                    else:
+                        stack_limited = True
+
+    return m_rna, stack_limited
+
+
+def spell(word: str, phoneme_dict: dict, grapheme_dict: dict, weight_dict: dict, allow_homographs: bool = False,
+          graph_threshold: float = 0.25, length_threshold: float = 1.10, stack_limit: int = 1000,
+          context_window: int = 3, fast_mode=False, seed=0, rng: random.Random = None) -> tuple:
+    """
+    Spell a word the way the engine did before any performance work.
+
+    Parameters
+    ----------
+    word : str
+        A single lowercase word.
+    phoneme_dict, grapheme_dict, weight_dict : dict
+        A parsed library, as from spellinator.spellinator.load_nemes / load_weights.
+    seed : int
+        Seed for the order nodes are visited in, which only matters when the stack limit is reached.
+    rng : random.Random
+        Generator for the visiting order, instead of one seeded with seed.
+
+    Returns
+    -------
+    tuple
+        (spellings, stack_limited), where spellings is the set of printed spellings.
+    """
+
+    if rng is None:
+        rng = random.Random(seed)
+    weights = sorted(weight_dict.items()) if weight_dict else list()
+    target_length = len(word)
+    stack_limited = False
+
+    glist_full = set()
+    for pseq in segment(word, grapheme_dict.values(), fast_mode):
+        graphic_sequence, limited = _transcribe(pseq, phoneme_dict, weights, allow_homographs, graph_threshold,
+                                                length_threshold, stack_limit, context_window, target_length, rng)
+        stack_limited = stack_limited or limited
+        for seq in graphic_sequence:
+            if allow_homographs:
+                phonetic = ''.join(map(str, seq[1]))
+                graphic = _join_graphemes(seq[0])
+            else:
+                phonetic = ''
+                graphic = _join_graphemes(seq)
+
+            if _sequence_weight(graphic, weights) >= graph_threshold:
+                if allow_homographs:
+                    glist_full.add(f'{phonetic:<{target_length + 2}}' + ' -> ' + graphic)
+                else:
+                    glist_full.add(graphic)
+
+    return glist_full, stack_limited
@@ -3,76 +3,157 @@
 
 from collections import deque
 from collections.abc import Iterable
-from pprint import pprint, pformat
-from time import sleep
+from contextlib import contextmanager
+from functools import partial
+from io import StringIO
+from itertools import islice
+from time import perf_counter
 from pathlib import Path
 
 import csv
 import argparse
 import re
 import math
-import yaml
+import os
 import random
+import sys
 
 _debug = False
 
-__all__ = ['list_columns']
+__all__ = ['list_columns', 'iter_columns', 'write_columns', 'write_lines', 'SpellStats', 'weight_tables', 'run',
+           'run_async', 'main']
 
 
-def list_columns(obj, cols=4, columnwise=True, gap=4, limit=None):
+def iter_columns(obj, cols=4, columnwise=True, gap=4, limit=None):
     """
-    Print the given list in evenly-spaced columns.
+    Lay out the given items in evenly-spaced columns, one row at a time.
+
+    Only the first limit items are taken from obj and converted to strings, so obj may be a lazy iterator
+    over a much larger result set.
 
     Parameters
     ----------
     obj : Iterable
-        The list to be printed.
+        The items to be printed.
     cols : int
-        The number of columns in which the list should be printed.
+        The number of columns in which the items should be printed.
     columnwise : bool, default=True
-        If True, the items in the list will be printed column-wise.
-        If False the items in the list will be printed row-wise.
+        If True, the items will be printed column-wise.
+        If False the items will be printed row-wise.
     gap : int
         The number of spaces that should separate the longest column
         item/s from the next column. This is the effective spacing
-        between columns based on the maximum len() of the list items.
+        between columns based on the maximum len() of the items.
     limit : int
         Limit the output to these many entries
+
+    Yields
+    ------
+    str
+        Each printed row, without a newline.
     """
 
-    sobj = [str(item) for item in obj]
-    if limit:
-        newlen = min(len(sobj), limit)
-        sobj = sobj[:newlen]
+    sobj = [str(item) for item in (islice(obj, limit) if limit else obj)]
+    if not sobj:
+        return
     if cols > len(sobj):
         cols = len(sobj)
-    max_len = max([len(item) for item in sobj])
+    max_len = max(map(len, sobj))
     if columnwise:
         cols = int(math.ceil(float(len(sobj)) / float(cols)))
     plist = [sobj[i: i + cols] for i in range(0, len(sobj), cols)]
     if columnwise:
         if not len(plist[-1]) == cols:
-            plist[-1].extend([''] * (len(sobj) - len(plist[-1])))
+            plist[-1].extend([''] * (cols - len(plist[-1])))
         plist = zip(*plist)
-    printer = '\n'.join([
-        ''.join([c.ljust(max_len + gap) for c in p])
-        for p in plist])
-    return printer
+    for p in plist:
+        yield ''.join([c.ljust(max_len + gap) for c in p])
+
+
+def write_columns(obj, stream, cols=4, columnwise=True, gap=4, limit=None, max_chars=None) -> int:
+    """
+    Write the rows of iter_columns to a stream, separated by newlines.
+
+    Parameters
+    ----------
+    stream
+        Text stream the rows are written to, as they are laid out.
+    max_chars : int
+        Stop before the first row that would take the output past this many characters, e.g. to fit a
+        Discord embed field.
+
+    Returns
+    -------
+    int
+        Number of characters written.
+    """
+
+    written = 0
+    for row in iter_columns(obj, cols, columnwise, gap, limit):
+        chunk = f'\n{row}' if written else row
+        if max_chars is not None and written + len(chunk) > max_chars:
+            break
+        stream.write(chunk)
+        written += len(chunk)
+
+    return written
+
+
+def list_columns(obj, cols=4, columnwise=True, gap=4, limit=None, max_chars=None):
+    """
+    Print the given list in evenly-spaced columns.
+
+    Parameters are those of write_columns; the rows are returned joined into a single string.
+    """
+
+    printer = StringIO()
+    write_columns(obj, printer, cols, columnwise, gap, limit, max_chars)
+    return printer.getvalue()
+
+
+def write_lines(obj, stream) -> int:
+    """
+    Write the given items to a stream one per line, without building the whole output in memory.
+
+    Returns
+    -------
+    int
+        Number of items written.
+    """
+
+    count = 0
+    for item in obj:
+        stream.write(f'\n{item}' if count else str(item))
+        count += 1
+
+    return count
 
 
 class SequenceNode:
+    """
+    Node of a segmentation tree.
+
+    Nodes are equal only to themselves but hash by serial, their creation order within the tree, rather than by
+    address, so the sets transcription keeps its stack in iterate in the same order from run to run and the work
+    a stack-limited request does is reproducible.
+    """
+
     target_length = 1
 
-    def __init__(self, gene, remainder, stop_valid: bool = None):
+    def __init__(self, gene, remainder, stop_valid: bool = None, serial: int = 0):
         self.gene = gene
         self.remainder: str = remainder
         self.follow = list()
         self.stop_valid: bool = stop_valid if stop_valid else False
         self.corruption: float = 1.0
+        self.serial = serial
 
     def __repr__(self):
         return str(self.gene)
 
+    def __hash__(self):
+        return self.serial
+
 
 class Neme:
     def __init__(self, name, starts: set = None, middles: set = None, ends: set = None):
@@ -139,6 +220,208 @@ class Graphemes(Neme):
 null_node = SequenceNode('', None, True)
 
 
+def sequence_weight(graphic: str, weights) -> float:
+    """
+    Score a grapheme string against the weight model.
+
+    Parameters
+    ----------
+    graphic : str
+        The joined grapheme string to score.
+    weights : Iterable
+        (weight, sequences) pairs, as given by sorted(weight_dict.items()).
+
+    Returns
+    -------
+    float
+        Product of weight ** occurrences for every weighted sequence found in the string.
+    """
+
+    graph_weight = 1.0
+    for weight, sequences in weights:
+        for wseq in sequences:
+            if wseq in graphic:
+                graph_weight *= weight ** graphic.count(wseq)
+
+    return graph_weight
+
+
+class WeightTable:
+    """
+    Transition table for the weight model.
+
+    Maps a context window of (previous graphemes..., next grapheme) names to the weight multiplier of the
+    joined window, so scoring an expansion is a single lookup. Entries are compiled lazily on first use.
+    """
+
+    def __init__(self, weight_dict: dict, context_window: int = 3):
+        if context_window < 1:
+            raise ValueError('context_window must be at least 1')
+        self.weights = sorted(weight_dict.items()) if weight_dict else list()
+        self.context_window = context_window
+        self.table = dict()
+        self.lookups = 0
+
+    def __getitem__(self, window: tuple) -> float:
+        try:
+            return self.table[window]
+        except KeyError:
+            weight = self.table[window] = sequence_weight(''.join(window), self.weights)
+            return weight
+
+    def __len__(self):
+        return len(self.table)
+
+    def score(self, anticodon: tuple) -> float:
+        self.lookups += 1
+        return self[tuple(map(str, anticodon[-self.context_window:]))]
+
+
+def _memoized(memo: dict, key, path, build):
+    """
+    memo[key], built by build() on first request and rebuilt whenever the file at path has changed since.
+
+    Entries are stored as (version, value), the version being the file's modification time and size, so an edited
+    library file never keeps serving what was parsed from the old one.
+    """
+
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    entry = memo.get(key)
+    if entry is None or entry[0] != version:
+        entry = memo[key] = (version, build())
+
+    return entry[1]
+
+
+_weight_tables = dict()
+
+
+def load_weight_table(weight_file, weight_dict: dict, context_window: int = 3) -> WeightTable:
+    """
+    Return the memoized WeightTable for a weights file, building an empty (lazy) one on first request and again
+    whenever the file changes. weight_dict should come from load_weights, so it follows the same version.
+    """
+
+    key = (str(Path(weight_file).resolve()), context_window)
+    return _memoized(_weight_tables, key, weight_file, lambda: WeightTable(weight_dict, context_window))
+
+
+def weight_tables() -> list:
+    """
+    The WeightTables currently memoized by load_weight_table, for monitoring their size and use. Tables replaced
+    after their file changed are not included.
+    """
+
+    return [table for _, table in _weight_tables.values()]
+
+
+class SpellStats:
+    """
+    Metrics for a single spelling request.
+
+    Stage timings are in seconds. Rejections are split by reason: length (output too long for the length
+    threshold), weight (context window below the graph threshold) and final (whole spelling below the graph
+    threshold). interrupted is 'deadline' or 'cancelled' when run_async stopped early with partial results.
+    """
+
+    stages = ('segmentation', 'transcription', 'scoring', 'formatting')
+
+    def __init__(self, word: str = ''):
+        self.word = word
+        self.timings = dict.fromkeys(self.stages, 0.0)
+        self.segmentation_nodes = 0
+        self.transcription_nodes = 0
+        self.length_rejections = 0
+        self.weight_rejections = 0
+        self.final_rejections = 0
+        self.stack_limited = False
+        self.interrupted = None
+        self.results = 0
+
+    def __repr__(self):
+        return f'SpellStats({self.as_dict()})'
+
+    @property
+    def rejections(self):
+        return self.length_rejections + self.weight_rejections + self.final_rejections
+
+    @property
+    def total_time(self):
+        return sum(self.timings.values())
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.timings[stage] += perf_counter() - start
+
+    def timed(self, stage: str, steps):
+        """
+        Yield from a generator of engine steps, charging stage only for the time spent inside it.
+
+        Unlike wrapping yield from in timer(), the time the caller holds each yield, e.g. while other coroutines
+        run on the event loop, is not charged. Closing this generator closes steps.
+        """
+
+        steps = iter(steps)
+        try:
+            while True:
+                with self.timer(stage):
+                    try:
+                        step = next(steps)
+                    except StopIteration:
+                        return
+                yield step
+        finally:
+            steps.close()
+
+    def as_dict(self):
+        return {
+            'word': self.word,
+            'timings': dict(self.timings),
+            'segmentation_nodes': self.segmentation_nodes,
+            'transcription_nodes': self.transcription_nodes,
+            'length_rejections': self.length_rejections,
+            'weight_rejections': self.weight_rejections,
+            'final_rejections': self.final_rejections,
+            'stack_limited': self.stack_limited,
+            'interrupted': self.interrupted,
+            'results': self.results,
+        }
+
+    def to_openmetrics(self, prefix: str = 'spellinator') -> str:
+        """
+        Render the stats in the OpenMetrics text exposition format.
+        """
+
+        word = self.word.replace('\\', '\\\\').replace('"', '\\"')
+        lines = [
+            f'# TYPE {prefix}_stage_seconds gauge',
+            f'# UNIT {prefix}_stage_seconds seconds',
+        ]
+        lines.extend(f'{prefix}_stage_seconds{{word="{word}",stage="{stage}"}} {seconds}'
+                     for stage, seconds in self.timings.items())
+        lines.append(f'# TYPE {prefix}_nodes gauge')
+        lines.append(f'{prefix}_nodes{{word="{word}",stage="segmentation"}} {self.segmentation_nodes}')
+        lines.append(f'{prefix}_nodes{{word="{word}",stage="transcription"}} {self.transcription_nodes}')
+        lines.append(f'# TYPE {prefix}_rejections gauge')
+        for reason in ('length', 'weight', 'final'):
+            lines.append(f'{prefix}_rejections{{word="{word}",reason="{reason}"}} '
+                         f'{getattr(self, f"{reason}_rejections")}')
+        lines.append(f'# TYPE {prefix}_stack_limited gauge')
+        lines.append(f'{prefix}_stack_limited{{word="{word}"}} {int(self.stack_limited)}')
+        lines.append(f'# TYPE {prefix}_interrupted gauge')
+        lines.append(f'{prefix}_interrupted{{word="{word}"}} {int(self.interrupted is not None)}')
+        lines.append(f'# TYPE {prefix}_results gauge')
+        lines.append(f'{prefix}_results{{word="{word}"}} {self.results}')
+        lines.append('# EOF')
+
+        return '\n'.join(lines) + '\n'
+
+
 def parse_args(argv):
     """
     Parse command line arguments to a global variable.
@@ -207,6 +490,14 @@ def parse_args(argv):
              'original word by (<threshold> - 1.0) * 100 %%.'
     )
 
+    parser.add_argument(
+        '-c',
+        '--context-window',
+        default=3,
+        type=int,
+        help='Number of trailing graphemes (including the new one) scored against the weights during generation.'
+    )
+
     parser.add_argument(
         '-s',
         '--stack-limit',
@@ -216,6 +507,42 @@ def parse_args(argv):
              'but also take exponentially longer.'
     )
 
+    parser.add_argument(
+        '--budget',
+        type=int,
+        help='Transcription nodes the request may cost. The stack limit and segmentation mode are chosen from the '
+             'library\'s fan-out profile before any work: complete results when the whole search fits, otherwise '
+             'a stack limit (at most --stack-limit) that spends about the budget.'
+    )
+
+    parser.add_argument(
+        '--exhaustive',
+        action='store_true',
+        help='Enumerate every spelling, ignoring --stack-limit, in memory bounded by --memory-cap. Results are '
+             'sorted and deduplicated on disk; use --output to keep them all.'
+    )
+
+    parser.add_argument(
+        '--memory-cap',
+        default=256,
+        type=float,
+        help='MiB of spellings --exhaustive holds in memory before spilling them to disk.'
+    )
+
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Run the request under cProfile and tracemalloc and print where it spends its time and memory instead '
+             'of the spellings.'
+    )
+
+    parser.add_argument(
+        '--collapsed',
+        type=str,
+        help='With --profile, also write the request\'s call stacks to this file in the collapsed format of '
+             'flamegraph.pl.'
+    )
+
     parser.add_argument(
         '-o',
         '--output',
@@ -223,6 +550,12 @@ def parse_args(argv):
         help='Output file to store results.'
     )
 
+    parser.add_argument(
+        '--metrics',
+        type=str,
+        help='Optional file to store request metrics in OpenMetrics text format.'
+    )
+
     parser.add_argument(
         '--print-width',
         default=100,
@@ -236,11 +569,22 @@ def parse_args(argv):
         help='Limit number of generated results.'
     )
 
+    parser.add_argument(
+        '--max-chars',
+        type=int,
+        help='Drop printed rows that would take the printout past this many characters.'
+    )
+
     args = parser.parse_args(argv)
 
     if len([x for x in (args.phonemes, args.weights) if x is not None]) == 1:
         parser.error('--phonemes and --weight must be given together')
 
+    if args.context_window < 1:
+        parser.error('--context-window must be at least 1')
+
+    # --limit trades complete segmentation for speed; --budget may also switch this on
+    args.fast_mode = bool(args.limit)
     args.phonemes = Path(args.phonemes) if args.phonemes is not None else Path(args.library, 'phonemes.csv')
     args.weights = Path(args.weights) if args.weights is not None else Path(args.library, 'weights.csv')
 
@@ -318,8 +662,72 @@ def generate_nemes(neme_file):
     return phoneme_dict, grapheme_dict
 
 
-def reverse_translate(rna: str, genes: Iterable, fast_mode=False):
+_libraries = dict()
+
+
+def load_weights(weight_file) -> dict:
+    """
+    Return the memoized weight dict for a weights file, parsing it on first request and again whenever it changes.
+    """
+
+    key = ('weights', str(Path(weight_file).resolve()))
+    return _memoized(_libraries, key, weight_file, lambda: generate_weights(weight_file))
+
+
+def compile_nemes(neme_file) -> tuple:
+    """
+    Parse a phonemes file into (phoneme_dict, grapheme_dict) ready for spelling.
+
+    The phoneme dict also holds the null phoneme used to end transcriptions. Its grapheme goes into a
+    throwaway dict so segmentation never sees an empty grapheme.
+    """
+
+    phoneme_dict, grapheme_dict = generate_nemes(neme_file)
+    if '' not in phoneme_dict:
+        Phoneme(
+            name='',
+            number=-1,
+            phoneme_dict=phoneme_dict,
+            grapheme_dict=dict(),
+            starts={''},
+            middles={''},
+            ends={''},
+        )
+
+    return phoneme_dict, grapheme_dict
+
+
+def load_nemes(neme_file) -> tuple:
+    """
+    Return the memoized compile_nemes result for a phonemes file, parsing it on first request and again whenever it
+    changes.
+
+    Both dicts are shared between requests and must not be modified.
+    """
+
+    key = ('nemes', str(Path(neme_file).resolve()))
+    return _memoized(_libraries, key, neme_file, lambda: compile_nemes(neme_file))
+
+
+def reverse_translate(rna: str, genes: Iterable, fast_mode=False, stats: SpellStats = None):
     results = []
+    for _ in iter_reverse_translate(rna, genes, results, fast_mode, stats):
+        pass
+
+    return results
+
+
+def iter_reverse_translate(rna: str, genes: Iterable, results: list, fast_mode=False, stats: SpellStats = None,
+                           yield_every: int = None):
+    """
+    Generator form of reverse_translate, appending the segmentation trees to results as they are built.
+
+    Yields after every yield_every node expansions (never when None), so the caller can interleave other work
+    or stop early. Stopping early leaves an incomplete tree in results.
+    """
+
+    stats = stats if stats is not None else SpellStats(rna)
+    expansions = 0
 
     starting_genes = set((gene for gene in genes if gene.starts))
     middling_genes = set((gene for gene in genes if gene.middles))
@@ -330,10 +738,12 @@ def reverse_translate(rna: str, genes: Iterable, fast_mode=False):
     for sg in starting_genes:
         if rna == str(sg):
             for amino in sg.starts:
-                results.append(SequenceNode(amino, None, True))
+                results.append(SequenceNode(amino, None, True, stats.segmentation_nodes))
+                stats.segmentation_nodes += 1
         if rna.startswith(str(sg)):
             for amino in sg.starts:
-                word_node = SequenceNode(amino, rna.replace(str(sg), '', 1))
+                word_node = SequenceNode(amino, rna.replace(str(sg), '', 1), serial=stats.segmentation_nodes)
+                stats.segmentation_nodes += 1
                 # Add to working list
                 word_list.append(word_node)
                 # Add to results list
@@ -352,8 +762,9 @@ def reverse_translate(rna: str, genes: Iterable, fast_mode=False):
                 if remaining_word.endswith(str(eg)) and len(new_remainder) == 0:
                     # print(f'Finished with {str(eg)}')
                     for amino in eg.ends:
-                        new_word_node = SequenceNode(amino, None, True)
+                        new_word_node = SequenceNode(amino, None, True, stats.segmentation_nodes)
                         word_node.follow.append(new_word_node)
+                        stats.segmentation_nodes += 1
 
             for mg in middling_genes:
                 if fast_mode:
@@ -367,9 +778,14 @@ def reverse_translate(rna: str, genes: Iterable, fast_mode=False):
                         if fast_mode:
                             if mutation_count > 3:
                                 break
-                        new_word_node = SequenceNode(amino, new_remainder)
+                        new_word_node = SequenceNode(amino, new_remainder, serial=stats.segmentation_nodes)
                         word_node.follow.append(new_word_node)
                         new_word_list.append(new_word_node)
+                        stats.segmentation_nodes += 1
+
+            expansions += 1
+            if yield_every and not expansions % yield_every:
+                yield
 
         if _debug:
             print(f'Generated {len(results)} {word_list[0].gene.gene_type} patterns so far...', end='\r', flush=True)
@@ -377,7 +793,68 @@ def reverse_translate(rna: str, genes: Iterable, fast_mode=False):
 
     if _debug:
         print('')
-    return results
+
+
+def estimate_segmentation(rna: str, genes: Iterable, fast_mode=False) -> int:
+    """
+    Count the nodes reverse_translate would build for a word, without building them.
+
+    Every node's children depend only on its remainder, which is always a suffix of the word, so the count is
+    a single pass over the suffixes from shortest to longest. The gene sets are built the same way as in
+    reverse_translate so fast_mode truncation visits genes in the same order.
+
+    Parameters
+    ----------
+    rna : str
+        The word to segment.
+    genes : Iterable
+        The graphemes of the library.
+    fast_mode : bool
+        Mirror reverse_translate's fast_mode cap on middle expansions.
+
+    Returns
+    -------
+    int
+        The number of SequenceNodes in the segmentation tree.
+    """
+
+    starting_genes = set((gene for gene in genes if gene.starts))
+    middling_genes = set((gene for gene in genes if gene.middles))
+    ending_genes = set((gene for gene in genes if gene.ends))
+
+    # Nodes below (not including) a node with the given remainder
+    subtree = {'': 0}
+    for idx in range(len(rna) - 1, 0, -1):
+        remaining_word = rna[idx:]
+        count = 0
+        for eg in ending_genes:
+            if remaining_word == str(eg):
+                count += len(eg.ends)
+
+        mutation_count = 0
+        for mg in middling_genes:
+            if fast_mode:
+                if mutation_count > 3:
+                    break
+            if remaining_word.startswith(str(mg)) and len(remaining_word) > len(str(mg)):
+                below = subtree[remaining_word[len(str(mg)):]]
+                for _ in mg.middles:
+                    mutation_count += 1
+                    if fast_mode:
+                        if mutation_count > 3:
+                            break
+                    count += 1 + below
+
+        subtree[remaining_word] = count
+
+    total = 0
+    for sg in starting_genes:
+        if rna == str(sg):
+            total += len(sg.starts)
+        if rna.startswith(str(sg)):
+            total += len(sg.starts) * (1 + subtree[rna.replace(str(sg), '', 1)])
+
+    return total
 
 
 def translate(start_codon: SequenceNode, weight_dict: dict = None, threshold=0.25):
@@ -406,187 +883,444 @@ def translate(start_codon: SequenceNode, weight_dict: dict = None, threshold=0.2
     return proteins
 
 
+_wrap_pattern = re.compile(r'\.(\S+) ?(\S*)')
+
+
+def join_graphemes(anticodon) -> str:
+    """
+    Join a transcription into a spelling, moving each split grapheme (e.g. 'a.e') around the grapheme after it.
+    """
+
+    graphic_i = ' '.join(map(str, anticodon))
+    graphic_o = re.sub(_wrap_pattern, r'\2\1', graphic_i)
+    return ''.join(graphic_o.split())
+
+
 def transcribe(start_codon: SequenceNode, mapping_dict: dict, weight_dict=None,
                allow_homographs: bool = False,
                graph_threshold: float = 0.25, length_threshold: float = 1.10,
-               stack_limit: int = 1000):
-    rejections = 0
+               stack_limit: int = 1000, weight_table: WeightTable = None, context_window: int = 3,
+               stats: SpellStats = None, target_length: int = None):
     m_rna = set()
-    stack = set()
-    stack_limited = False
-    starts = tuple(mapping_dict[str(start_codon)].starts)
-
-    for start in random.sample(starts, len(starts)):
-        added = False
-        for follow in random.sample(start_codon.follow, len(start_codon.follow)):
-            # (new roots, translation, source)
-            stack.add((follow, (start,), (start_codon,)))
-            added = True
-        if not added:
-            stack.add((null_node, (start,), (start_codon,)))
+    for _ in iter_transcribe(start_codon, mapping_dict, m_rna, weight_dict, allow_homographs, graph_threshold,
+                             length_threshold, stack_limit, weight_table, context_window, stats, target_length):
+        pass
 
-    while stack:
-        curr: SequenceNode
-        curr, anticodon, codon = stack.pop()
+    return m_rna
 
-        if not curr.follow and curr.stop_valid:
-            ends = tuple(mapping_dict[str(curr)].ends)
-            for end in random.sample(ends, len(ends)):
-                new_anticodon = anticodon + (end,)
-                new_codon = codon + (curr,)
-                add_tuple = (new_anticodon, new_codon) if allow_homographs else new_anticodon
-                m_rna.add(add_tuple)
-                # if _debug:
-                #     print(new_path)
-
-        for follow in random.sample(curr.follow, len(curr.follow)):
-            middles = tuple(mapping_dict[str(curr)].middles)
-            for middle in random.sample(middles, len(middles)):
+
+def _shuffled(items, rng=random) -> list:
+    return rng.sample(items, len(items))
+
+
+def transcription_roots(start_codon: SequenceNode, mapping_dict: dict, order=_shuffled) -> list:
+    """
+    The (node, anticodon, codon) entries transcription starts from for a segmentation tree: every spelling of
+    its first phoneme, followed by each of its children, or by null_node when it has none.
+
+    order arranges the alternatives at each choice; the default shuffles them, and tuple keeps them as they are.
+    """
+
+    roots = list()
+    for start in order(tuple(mapping_dict[str(start_codon)].starts)):
+        follows = order(start_codon.follow) if start_codon.follow else (null_node,)
+        roots.extend((follow, (start,), (start_codon,)) for follow in follows)
+    return roots
+
+
+def transcription_step(curr: SequenceNode, anticodon: tuple, codon: tuple, mapping_dict: dict,
+                       weight_table: WeightTable, graph_threshold: float, length_threshold: float, target_length: int,
+                       stats: SpellStats, order=_shuffled) -> tuple:
+    """
+    Expand one (node, anticodon, codon) entry of a transcription stack.
+
+    This is the part of transcription every walk shares; iter_transcribe and the exhaustive walk differ only in
+    how they keep and bound their stack. order arranges the alternatives at each choice, as in transcription_roots.
+
+    Returns
+    -------
+    tuple
+        (completed, children): the (anticodon, codon) transcriptions finished at this node, and the entries to
+        push, in order. Children failing the length or weight threshold are counted in stats and left out.
+    """
+
+    completed = list()
+    if not curr.follow and curr.stop_valid:
+        new_codon = codon + (curr,)
+        for end in order(tuple(mapping_dict[str(curr)].ends)):
+            completed.append((anticodon + (end,), new_codon))
+
+    children = list()
+    if curr.follow:
+        middles = tuple(mapping_dict[str(curr)].middles)
+        new_codon = codon + (curr,)
+        for follow in order(curr.follow):
+            for middle in order(middles):
                 new_anticodon = anticodon + (middle,)
-                if (sum(map(len, new_anticodon)) / SequenceNode.target_length) > length_threshold:
-                    rejections += 1
-                    continue
-                graphic = "".join(map(str, new_anticodon[-3:]))
-                graph_weight = 1.0
-                if weight_dict:
-                    for weight_set in sorted(weight_dict.items()):
-                        for wseq in weight_set[1]:
-                            if wseq in graphic:
-                                count = graphic.count(wseq)
-                                graph_weight *= weight_set[0] ** count
-
-                if graph_weight >= graph_threshold:
-                    new_codon = codon + (curr,)
-                    # Limit the stack length
-                    if len(stack) < stack_limit:
-                        stack.add((follow, new_anticodon, new_codon))
-                    else:
-                        stack_limited = True
+                if (sum(map(len, new_anticodon)) / target_length) > length_threshold:
+                    stats.length_rejections += 1
+                elif weight_table.score(new_anticodon) >= graph_threshold:
+                    children.append((follow, new_anticodon, new_codon))
                 else:
-                    rejections += 1
+                    stats.weight_rejections += 1
+
+    return completed, children
+
+
+def iter_transcribe(start_codon: SequenceNode, mapping_dict: dict, m_rna: set, weight_dict=None,
+                    allow_homographs: bool = False,
+                    graph_threshold: float = 0.25, length_threshold: float = 1.10,
+                    stack_limit: int = 1000, weight_table: WeightTable = None, context_window: int = 3,
+                    stats: SpellStats = None, target_length: int = None, yield_every: int = None,
+                    rng: random.Random = None):
+    """
+    Generator form of transcribe, adding transcriptions to m_rna as they are completed.
+
+    Yields after every yield_every stack expansions (never when None). target_length defaults to
+    SequenceNode.target_length; pass it explicitly when requests may interleave. Alternatives are shuffled with
+    rng, or with the random module's shared generator when None.
+    """
+
+    if weight_table is None:
+        weight_table = WeightTable(weight_dict, context_window)
+    stats = stats if stats is not None else SpellStats()
+    target_length = target_length if target_length else SequenceNode.target_length
+    order = partial(_shuffled, rng=rng) if rng is not None else _shuffled
+    expansions = 0
+    stack = set(transcription_roots(start_codon, mapping_dict, order))
+
+    while stack:
+        curr, anticodon, codon = stack.pop()
+        stats.transcription_nodes += 1
+
+        completed, children = transcription_step(curr, anticodon, codon, mapping_dict, weight_table,
+                                                 graph_threshold, length_threshold, target_length, stats, order)
+        for new_anticodon, new_codon in completed:
+            m_rna.add((new_anticodon, new_codon) if allow_homographs else new_anticodon)
+
+        for child in children:
+            # Limit the stack length
+            if len(stack) < stack_limit:
+                stack.add(child)
+            else:
+                stats.stack_limited = True
 
         if _debug:
-            print(f'Generated {len(m_rna)} patterns, rejected {rejections}, stack limit {stack_limited}',
+            print(f'Generated {len(m_rna)} patterns, rejected {stats.rejections}, stack limit {stats.stack_limited}',
                   end='\r', flush=True)
 
+        expansions += 1
+        if yield_every and not expansions % yield_every:
+            yield
+
     if _debug:
         print('')
-    return m_rna
 
 
 def true_translate(phonetic_sequences: list, phoneme_dict: dict, weight_dict: dict = None,
                    allow_homographs: bool = False,
-                   graph_threshold: float = 0.25, length_threshold: float = 1.10, stack_limit: int = 1000):
+                   graph_threshold: float = 0.25, length_threshold: float = 1.10, stack_limit: int = 1000,
+                   weight_table: WeightTable = None, context_window: int = 3, stats: SpellStats = None,
+                   target_length: int = None):
     plist_full = set()
     glist_full = set()
-    wrap_pattern = re.compile(r'\.(\S+) ?(\S*)')
+    for _ in iter_true_translate(phonetic_sequences, phoneme_dict, glist_full, weight_dict, allow_homographs,
+                                 graph_threshold, length_threshold, stack_limit, weight_table, context_window,
+                                 stats, target_length):
+        pass
+
+    return glist_full, plist_full
+
+
+def iter_true_translate(phonetic_sequences: list, phoneme_dict: dict, glist_full: set, weight_dict: dict = None,
+                        allow_homographs: bool = False,
+                        graph_threshold: float = 0.25, length_threshold: float = 1.10, stack_limit: int = 1000,
+                        weight_table: WeightTable = None, context_window: int = 3, stats: SpellStats = None,
+                        target_length: int = None, yield_every: int = None, rng: random.Random = None):
+    """
+    Generator form of true_translate, adding finished spellings to glist_full.
+
+    Yields after every yield_every transcription expansions (never when None). Closing the generator early
+    still scores the transcriptions found so far, so glist_full holds partial results. rng is passed to
+    iter_transcribe.
+    """
+
+    if weight_table is None:
+        weight_table = WeightTable(weight_dict, context_window)
+    stats = stats if stats is not None else SpellStats()
+    target_length = target_length if target_length else SequenceNode.target_length
     # For each way-tree of how it could be pronounced
     for pseq in phonetic_sequences:
-        # Write out the possible phonetics
-        phonetic_list = translate(pseq)
-        plist_full.union(phonetic_list)
-        # list_columns(phonetic_list, 8, True, 2)
         # Generate ways to write the sound-tree
-        graphic_sequence = transcribe(pseq, phoneme_dict, weight_dict,
-                                      allow_homographs,
-                                      graph_threshold, length_threshold, stack_limit)
-        for seq in graphic_sequence:
-            if allow_homographs:
-                phonetic = ''.join(map(str, seq[1]))
-                graphic_i = ' '.join(map(str, seq[0]))
-            else:
-                phonetic = ''
-                graphic_i = ' '.join(map(str, seq))
-            graphic_o = re.sub(wrap_pattern, r'\2\1', graphic_i)
-            graphic = ''.join(graphic_o.split())
-            graph_weight = 1.0
-            if weight_dict:
-                for weight_set in sorted(weight_dict.items()):
-                    for wseq in weight_set[1]:
-                        if wseq in graphic:
-                            count = graphic.count(wseq)
-                            graph_weight *= weight_set[0] ** count
-
-            if graph_weight >= graph_threshold:
-                if allow_homographs:
-                    glist_full.add(f'{phonetic:<{SequenceNode.target_length + 2}}' + ' -> ' + graphic)
-                else:
-                    glist_full.add(graphic)
-            # else:
-            #     print(f'Rejected: {graphic}')
+        graphic_sequence = set()
+        try:
+            yield from stats.timed('transcription', iter_transcribe(
+                pseq, phoneme_dict, graphic_sequence, weight_dict, allow_homographs, graph_threshold,
+                length_threshold, stack_limit, weight_table, stats=stats, target_length=target_length,
+                yield_every=yield_every, rng=rng))
+        finally:
+            with stats.timer('scoring'):
+                for seq in graphic_sequence:
+                    if allow_homographs:
+                        phonetic = ''.join(map(str, seq[1]))
+                        graphic = join_graphemes(seq[0])
+                    else:
+                        phonetic = ''
+                        graphic = join_graphemes(seq)
+                    graph_weight = sequence_weight(graphic, weight_table.weights)
+
+                    if graph_weight >= graph_threshold:
+                        if allow_homographs:
+                            glist_full.add(f'{phonetic:<{target_length + 2}}' + ' -> ' + graphic)
+                        else:
+                            glist_full.add(graphic)
+                    else:
+                        stats.final_rejections += 1
 
-    return glist_full, plist_full
+            stats.results = len(glist_full)
 
 
-def main(argv=None):
-    args = parse_args(argv)
+def request_library(args, library=None) -> tuple:
+    """
+    The parsed library a request spells with: the given spellinator.library.Library, or the memoized files
+    named by args.
 
-    weight_dict = generate_weights(args.weights)
+    Returns
+    -------
+    tuple
+        (weight_dict, weight_table, grapheme_dict, phoneme_dict), where phoneme_dict is the --phoneme-map's
+        when one is given.
+    """
 
-    # pprint(weight_dict)
-    # raise NotImplementedError
+    if library is not None:
+        weight_dict = library.weight_dict
+        weight_table = library.weight_table(args.context_window)
+        phoneme_dict, grapheme_dict = library.phoneme_dict, library.grapheme_dict
+    else:
+        weight_dict = load_weights(args.weights)
+        weight_table = load_weight_table(args.weights, weight_dict, args.context_window)
+        phoneme_dict, grapheme_dict = load_nemes(args.phonemes)
 
-    phoneme_dict, grapheme_dict = generate_nemes(args.phonemes)
+    if args.phoneme_map:
+        phoneme_dict, _ = load_nemes(args.phoneme_map)
 
-    # pydict = dict()
-    # for phon in phoneme_dict.values():
-    #     pydict[str(phon)] = {
-    #         'starts': list(map(str, phon.starts)),
-    #         'middles': list(map(str, phon.middles)),
-    #         'ends': list(map(str, phon.ends)),
-    #     }
-    #
-    # with open('phonemes.yml', 'w') as yfile:
-    #     yaml.dump(pydict, yfile, allow_unicode=True, sort_keys=False)
+    return weight_dict, weight_table, grapheme_dict, phoneme_dict
 
-    if args.phoneme_map:
-        mapped_phoneme_dict, mapped_grapheme_dict = generate_nemes(args.phoneme_map)
-    else:
-        mapped_phoneme_dict, mapped_grapheme_dict = phoneme_dict, grapheme_dict
+
+def request_profile(args, library=None) -> dict:
+    """
+    The fan-out profile of a request's library: the one stored with the given spellinator.library.Library, or
+    one built from the memoized phonemes file named by args.
+    """
+
+    if library is not None:
+        return library.profile
+
+    def build():
+        from spellinator.analyze import build_profile
+        return build_profile(*load_nemes(args.phonemes))
+
+    key = ('profile', str(Path(args.phonemes).resolve()))
+    return _memoized(_libraries, key, args.phonemes, build)
+
+
+def iter_spell(args, stats: SpellStats, glist_full: set, yield_every: int = None, library=None,
+               rng: random.Random = None):
+    """
+    Generator running a parsed request's segmentation and transcription, adding spellings to glist_full.
+
+    Yields after every yield_every node expansions (never when None). Closed during segmentation, it leaves
+    glist_full empty; closed during transcription, glist_full holds the spellings scored so far. A
+    spellinator.library.Library, if given, is used instead of loading args.weights and args.phonemes, and a
+    random.Random, if given, is shuffled with instead of the random module's shared generator.
+    """
+
+    weight_dict, weight_table, grapheme_dict, mapped_phoneme_dict = request_library(args, library)
+
+    if args.budget:
+        from spellinator.analyze import CostModel, choose_parameters
+        args.stack_limit, args.fast_mode, _ = choose_parameters(CostModel(request_profile(args, library)), stats.word,
+                                                                args.budget, args.stack_limit, args.fast_mode)
+
+    # Take the word and generate ways it could be pronounced, as a set of trees
+    phonetic_sequences = list()
+    yield from stats.timed('segmentation', iter_reverse_translate(stats.word, grapheme_dict.values(),
+                                                                  phonetic_sequences, args.fast_mode, stats,
+                                                                  yield_every))
+
+    # print(f'Generated a total of {len(phonetic_sequences)} sequence starts.', flush=True)
+
+    yield from iter_true_translate(phonetic_sequences=phonetic_sequences,
+                                   phoneme_dict=mapped_phoneme_dict,
+                                   glist_full=glist_full,
+                                   allow_homographs=args.allow_homographs,
+                                   weight_dict=weight_dict,
+                                   graph_threshold=args.graph_threshold,
+                                   length_threshold=args.length_threshold,
+                                   stack_limit=args.stack_limit,
+                                   weight_table=weight_table,
+                                   stats=stats,
+                                   target_length=len(stats.word),
+                                   yield_every=yield_every,
+                                   rng=rng)
+
+
+def column_count(args, target_length: int) -> int:
+    """
+    Columns of spellings that fit in --print-width.
+    """
+
+    if args.allow_homographs:
+        return max(1, int(args.print_width // ((2.0 * args.length_threshold) * target_length + 10)))
+    return max(1, int(args.print_width // (target_length * args.length_threshold + 10)))
+
+
+def finish_spell(args, glist_full: set, stats: SpellStats, stats_hook=None) -> str:
+    """
+    Format a request's spellings, write its --output and --metrics files, and report its stats.
+
+    Returns
+    -------
+    str
+        The spellings in columns.
+    """
+
+    with stats.timer('formatting'):
+        printer = list_columns(glist_full, column_count(args, len(stats.word)), True, 6, args.limit, args.max_chars)
+
+        if args.output:
+            with open(args.output, 'w') as fp:
+                write_lines(glist_full, fp)
+
+    if args.metrics:
+        with open(args.metrics, 'w') as fp:
+            fp.write(stats.to_openmetrics())
+
+    if stats_hook:
+        stats_hook(stats)
+
+    return printer
+
+
+def run(argv=None, stats_hook=None, library=None, args=None):
+    """
+    Spellinate a word and collect metrics for the request.
+
+    Parameters
+    ----------
+    argv : list
+        Command line arguments, as accepted by parse_args.
+    stats_hook : callable
+        Optional callback invoked with the SpellStats once the request completes.
+    library : spellinator.library.Library
+        Library to spell with for the whole request, instead of the files named in argv.
+    args : argparse.Namespace
+        Arguments already parsed by parse_args, used instead of parsing argv.
+
+    Returns
+    -------
+    tuple
+        (printer, stats)
+    """
+
+    args = args if args is not None else parse_args(argv)
 
     # Single word input, toss extra words, lowercase only.
     word = args.input.split()[0].lower()
     SequenceNode.target_length = len(word)
-    # Take the word and generate ways it could be pronounced, as a set of trees
-    phonetic_sequences = reverse_translate(word, grapheme_dict.values(), args.limit)
+    stats = SpellStats(word)
+    if args.exhaustive:
+        # Imported here as only the command line enumerates exhaustively
+        from spellinator.exhaustive import run_exhaustive
+        return run_exhaustive(args, stats, stats_hook, library), stats
 
-    # print(f'Generated a total of {len(phonetic_sequences)} sequence starts.', flush=True)
+    glist_full = set()
+    for _ in iter_spell(args, stats, glist_full, library=library):
+        pass
 
-    # Add a null phoneme
-    null = Phoneme(
-        name='',
-        number=-1,
-        phoneme_dict=mapped_phoneme_dict,
-        grapheme_dict=mapped_grapheme_dict,
-        starts={''},
-        middles={''},
-        ends={''},
-    )
+    return finish_spell(args, glist_full, stats, stats_hook), stats
 
-    glist_full, plist_full = true_translate(phonetic_sequences=phonetic_sequences,
-                                            phoneme_dict=mapped_phoneme_dict,
-                                            allow_homographs=args.allow_homographs,
-                                            weight_dict=weight_dict,
-                                            graph_threshold=args.graph_threshold,
-                                            length_threshold=args.length_threshold,
-                                            stack_limit=args.stack_limit)
 
-    if args.allow_homographs:
-        columns = max(1, args.print_width // ((2.0 * args.length_threshold) * SequenceNode.target_length + 10))
-    else:
-        columns = max(1, args.print_width // (SequenceNode.target_length * args.length_threshold + 10))
+async def run_async(argv=None, stats_hook=None, timeout: float = None, yield_every: int = 1000, library=None):
+    """
+    Spellinate a word like run(), on the event loop, yielding to it every yield_every node expansions.
 
-    printer = list_columns(glist_full, columns, True, 6, args.limit)
-    if _debug:
-        print(printer)
+    Unlike run() this keeps no per-request state on SequenceNode, so requests may interleave.
 
-    if args.output:
-        with open(args.output, 'w') as fp:
-            fp.write("\n".join(str(item) for item in glist_full))
+    Parameters
+    ----------
+    argv : list
+        Command line arguments, as accepted by parse_args.
+    stats_hook : callable
+        Optional callback invoked with the SpellStats once the request completes.
+    timeout : float
+        Seconds after which to stop and return the spellings found so far.
+    yield_every : int
+        Node expansions between yields to the event loop.
+    library : spellinator.library.Library
+        Library to spell with for the whole request, instead of the files named in argv.
+
+    Returns
+    -------
+    tuple
+        (printer, stats). If the timeout passed the results are partial and stats.interrupted is 'deadline'.
+
+    Raises
+    ------
+    asyncio.CancelledError
+        When the task is cancelled, after stats_hook has received the partial stats with stats.interrupted set to
+        'cancelled'.
+    """
+
+    # Imported here, asyncio is a large import and only the bot spells on an event loop
+    import asyncio
+
+    args = parse_args(argv)
+
+    # Single word input, toss extra words, lowercase only.
+    word = args.input.split()[0].lower()
+    stats = SpellStats(word)
+    glist_full = set()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    steps = iter_spell(args, stats, glist_full, yield_every, library)
+    try:
+        for _ in steps:
+            if deadline is not None and loop.time() >= deadline:
+                stats.interrupted = 'deadline'
+                break
+            await asyncio.sleep(0)
+    except asyncio.CancelledError:
+        stats.interrupted = 'cancelled'
+        steps.close()
+        # Record what was done before the cancellation, then let it propagate
+        finish_spell(args, glist_full, stats, stats_hook)
+        raise
+    finally:
+        # Scores whatever was transcribed before stopping
+        steps.close()
+
+    return finish_spell(args, glist_full, stats, stats_hook), stats
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        # Imported here as only --profile needs the profilers
+        from spellinator.profiling import profile_request
+        return profile_request(args=args).summary()
+
+    printer, _ = run(args=args)
 
     return printer
 
 
 if __name__ == '__main__':
-    _debug = True
-    main()
+    # Run as a script, sys.path starts at this directory, where this file shadows the package. Put the repository
+    # root there instead and run the package's copy of the module, so the modules it imports on demand
+    # (--exhaustive, --budget, --profile) share one engine with this run.
+    sys.path[0] = str(Path(__file__).resolve().parent.parent)
+    from spellinator import spellinator as engine
+    print(engine.main())
+
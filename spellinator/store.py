@@ -0,0 +1,283 @@
+# coding=utf-8
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from spellinator.constants import embed_field_limit
+from spellinator.library import Library
+
+__all__ = ['STANDARD_ARGS', 'ResultStore', 'store_key', 'write_store', 'warm', 'read_wordlist']
+
+# The arguments the bot spells every word with, after the word itself. -a is added for homographs.
+STANDARD_ARGS = ('-s', '20', '--print-width', '60', '--limit', '10', '--max-chars', str(embed_field_limit - 6))
+
+DEFAULT_LIBRARY = Path(__file__).parent / 'en'
+STORE = DEFAULT_LIBRARY / 'warm.store'
+
+_MAGIC = b'SPST'
+_VERSION = 2
+# magic, version, entry count, length of the JSON metadata
+_HEADER = struct.Struct('<4sHII')
+# key hash, offset of the entry in the data section, entry length
+_INDEX = struct.Struct('<QII')
+
+# (library, fingerprint the warm job expects) in a warm worker process, see _load_library
+_worker_library = None
+
+
+def store_key(word: str, allow_homographs: bool = False) -> bytes:
+    """
+    Key a request the way the engine normalizes it: first word, lowercase, plus the homograph flag.
+    """
+
+    words = word.split()
+    return f'{words[0].lower() if words else ""}\t{int(bool(allow_homographs))}'.encode()
+
+
+def _key_hash(key: bytes) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class ResultStore:
+    """
+    Read-only store of precomputed spellings, memory-mapped from a file written by write_store.
+
+    The file is a header, JSON metadata (the arguments the results were computed with and the fingerprint of
+    the library), an index of (key hash, offset, length) records sorted by hash, then the entries as key, NUL,
+    printed result. Lookups binary search the index in place, so opening the store reads nothing but the header.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, meta_length = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self._mmap.close()
+            raise ValueError(f'{self.path} is not a version {_VERSION} result store')
+        meta_start = _HEADER.size
+        meta = json.loads(self._mmap[meta_start:meta_start + meta_length])
+        self.params = meta['params']
+        self.library = meta['library']
+        self._index_start = meta_start + meta_length
+        self._data_start = self._index_start + self.count * _INDEX.size
+
+    def __repr__(self):
+        return f'ResultStore({self.path}, {self.count} entries)'
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+
+    def _hash_at(self, idx: int) -> int:
+        return _INDEX.unpack_from(self._mmap, self._index_start + idx * _INDEX.size)[0]
+
+    def get(self, word: str, allow_homographs: bool = False, default=None):
+        """
+        The stored result for a word, or default if it was not precomputed.
+        """
+
+        key = store_key(word, allow_homographs)
+        target = _key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._hash_at(mid) < target:
+                low = mid + 1
+            else:
+                high = mid
+        idx = low
+        while idx < self.count:
+            key_hash, offset, length = _INDEX.unpack_from(self._mmap, self._index_start + idx * _INDEX.size)
+            if key_hash != target:
+                break
+            start = self._data_start + offset
+            entry = self._mmap[start:start + length]
+            entry_key, _, value = entry.partition(b'\0')
+            if entry_key == key:
+                return value.decode()
+            idx += 1
+
+        return default
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+
+def write_store(path, results: dict, params=STANDARD_ARGS, library: str = None) -> None:
+    """
+    Write precomputed results to a store file, replacing it atomically so open readers keep a valid map.
+
+    Parameters
+    ----------
+    results : dict
+        (word, allow_homographs) -> printed result
+    params : Iterable
+        The arguments the results were computed with.
+    library : str
+        Fingerprint of the library the results were computed with, see spellinator.library.fingerprint.
+    """
+
+    entries = sorted(
+        (_key_hash(key), key + b'\0' + value.encode())
+        for key, value in ((store_key(word, homographs), value) for (word, homographs), value in results.items())
+    )
+    meta_json = json.dumps({'params': list(params), 'library': library}).encode()
+
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as fp:
+        fp.write(_HEADER.pack(_MAGIC, _VERSION, len(entries), len(meta_json)))
+        fp.write(meta_json)
+        offset = 0
+        for key_hash, entry in entries:
+            fp.write(_INDEX.pack(key_hash, offset, len(entry)))
+            offset += len(entry)
+        for _, entry in entries:
+            fp.write(entry)
+    os.replace(tmp_path, path)
+
+
+def read_wordlist(path) -> list:
+    """
+    Words from a file, one per line, skipping blank lines, # comments and repeats.
+    """
+
+    words = dict()
+    with open(path) as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].split()
+            if line:
+                words[line[0].lower()] = None
+
+    return list(words)
+
+
+def _load_library(directory, expected: str) -> None:
+    global _worker_library
+    _worker_library = (Library(directory), expected)
+
+
+def _spell(request, library: Library = None):
+    # Imported here so worker processes only pay for the engine when they run it
+    from spellinator.spellinator import run
+
+    if library is None:
+        library, expected = _worker_library
+        if library.fingerprint != expected:
+            raise ValueError(f'{library.directory} changed while warming')
+
+    word, allow_homographs, params = request
+    argv = [word, *params] + (['-a'] if allow_homographs else [])
+    printer, _ = run(argv, library=library)
+    return (word, allow_homographs), printer
+
+
+def warm(words, params=STANDARD_ARGS, jobs: int = None, homographs=(False, True), library: Library = None) -> dict:
+    """
+    Spell every word with the given arguments, with and without homographs, in parallel.
+
+    Parameters
+    ----------
+    library : spellinator.library.Library
+        Library to spell with, whatever params name, defaults to DEFAULT_LIBRARY. A Library can't be pickled, so
+        each worker process compiles its directory again and refuses to spell if its fingerprint differs.
+
+    Returns
+    -------
+    dict
+        (word, allow_homographs) -> printed result, ready for write_store
+    """
+
+    library = library if library is not None else Library(DEFAULT_LIBRARY)
+    requests = [(word, allow_homographs, tuple(params)) for word in words for allow_homographs in homographs]
+    jobs = jobs if jobs else os.cpu_count()
+    if jobs == 1:
+        return dict(map(partial(_spell, library=library), requests))
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_load_library,
+                             initargs=(library.directory, library.fingerprint)) as pool:
+        return dict(pool.map(_spell, requests, chunksize=max(1, len(requests) // (jobs * 8))))
+
+
+def parse_args(argv):
+    """
+    Parse command line arguments for the warm job.
+
+    Returns
+    -------
+    args
+        Parsed arguments object from argparse
+    """
+
+    parser = argparse.ArgumentParser(prog='spellinator warm',
+                                     description='Precompute spellings for a word list into a result store.')
+
+    parser.add_argument(
+        '-w',
+        '--wordlist',
+        required=True,
+        type=Path,
+        help='File with one word per line.'
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        default=STORE,
+        type=Path,
+        help='Result store to write.'
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        help='Worker processes, defaults to the number of CPUs.'
+    )
+
+    parser.add_argument(
+        '-y',
+        '--library',
+        help='Library directory, if not the engine default.'
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    words = read_wordlist(args.wordlist)
+    params = list(STANDARD_ARGS) + (['-y', args.library] if args.library else [])
+    # Resolved once, so the results are spelled with the very library the store is fingerprinted with
+    library = Library(Path(args.library).resolve() if args.library else DEFAULT_LIBRARY)
+    print(f'Warming {len(words)} words with {" ".join(params)}...', file=sys.stderr, flush=True)
+    results = warm(words, params, args.jobs, library=library)
+    write_store(args.output, results, params, library.fingerprint)
+    print(f'Wrote {len(results)} results to {args.output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,40 @@
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
 import unittest
-from extensions.energy_cost import ecost_calculator
+from extensions.beat_of_four import BeatOfFourTables, gen_beat_of_four_batch, gen_unique_beat_of_four
+from extensions.beat_of_four import page_beat_of_four
+from extensions.spell import COST_PER_TOKEN, MAX_COST, admit, request_cost, user_limiter
+from extensions.metrics import collect_weight_tables, weight_table_lookups
+from extensions.energy_cost import ecost_batch, ecost_calculator, optimal_charging_window, price_timeline
+from extensions._tariffs import compare_plans, load_tariffs, price_session
+from spellinator.spellinator import generate_weights, sequence_weight, WeightTable, SpellStats, run, run_async
+from spellinator.spellinator import generate_nemes, estimate_segmentation, reverse_translate, load_nemes
+from spellinator.spellinator import list_columns, write_lines, load_weights, load_weight_table, true_translate
+from spellinator.spellinator import SequenceNode
+from spellinator.incremental import load_speller
+from spellinator.admission import QueueFull, RateLimiter, TokenBucket, WorkQueue
+from spellinator.bench import bench_process, compare
+from spellinator.metrics import Counter, Histogram, Registry
+from spellinator.analyze import PROFILE_NAME, CostModel, build_profile, choose_parameters, worst_cases
+from spellinator.exhaustive import SortedSpill, iter_transcriptions, segmentation_graph
+from spellinator.difftest import diff_word, generate_corpus, summarize
+from spellinator.library import Library, LibraryRegistry
+from spellinator.profiling import profile_request
+from spellinator import reference
+from spellinator.store import STANDARD_ARGS, ResultStore, warm, write_store
 
-from datetime import time, datetime
+from datetime import date, time, datetime, timedelta
+from io import StringIO
+from itertools import count, permutations, product
+from pathlib import Path
+from shutil import copytree
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
 
 
 def expected_cost_calc(soc_delta, avg_cost):
@@ -67,5 +100,813 @@ class MyTestCase(unittest.TestCase):
         self.assertAlmostEqual(total_cost, expected_cost, delta=0.05)
 
 
+class EcostBatchTestCase(unittest.TestCase):
+    def test_matches_ecost_calculator(self):
+        rng = random.Random(7)
+        rows = []
+        for _ in range(500):
+            start, stop = rng.randrange(24 * 60), rng.randrange(24 * 60)
+            rows.append((
+                rng.randrange(1, 100),
+                time(start // 60, start % 60),
+                time(stop // 60, stop % 60) if stop != start else time(23, 59),
+                rng.random() < 0.1,
+                rng.random() < 0.1,
+                date(2023, 1, 1) + timedelta(days=rng.randrange(2 * 365)),
+                rng.choice([0.85, 0.90]),
+                rng.choice([66.6, 75.0]),
+            ))
+        # Summer starts strictly after June 1 and ends before October 1
+        rows.extend((10, time(16), time(19), False, False, day, 0.9, 66.6)
+                    for day in (date(2023, 6, 1), date(2023, 6, 2), date(2023, 9, 30), date(2023, 10, 1)))
+
+        columns = list(zip(*rows))
+        batch = ecost_batch(columns[0], columns[1], columns[2], columns[5], columns[3], columns[4],
+                            columns[6], columns[7])
+        for idx, (soc, start, stop, peak, offpeak, day, efficiency, capacity) in enumerate(rows):
+            expected = ecost_calculator(soc, start, stop, peak, offpeak, day, efficiency, capacity)
+            self.assertEqual(tuple(float(value) for value in expected),
+                             tuple(float(column[idx]) for column in batch))
+
+    def test_broadcasts_scalars(self):
+        kwh, _, _, _, hours, total, _ = ecost_batch(10, ['17:00', '08:00'], ['19:00', '10:00'],
+                                                    datetime(2023, 6, 15))
+        self.assertEqual(kwh.shape, (2,))
+        self.assertEqual(list(hours), [2.0, 2.0])
+        self.assertEqual(float(total[0]), ecost_calculator(10, time(17), time(19), today_ovrd=date(2023, 6, 15))[5])
+
+
+class ChargingWindowTestCase(unittest.TestCase):
+    def test_contiguous_window_is_cheapest(self):
+        start = datetime(2023, 6, 15, 15, 0)
+        sessions, _, _, average = optimal_charging_window(20, 6.6, start, timedelta(hours=8), allow_split=False)
+        self.assertEqual(len(sessions), 1)
+        needed = int((sessions[0][1] - sessions[0][0]).total_seconds() // 60)
+
+        prices = list(price_timeline(start, 8 * 60))
+        costs = [sum(prices[idx:idx + needed]) for idx in range(len(prices) - needed + 1)]
+        first = min(range(len(costs)), key=lambda idx: (round(costs[idx], 6), idx))
+        self.assertEqual(sessions[0][0], start + timedelta(minutes=first))
+        self.assertAlmostEqual(average, costs[first] / needed)
+
+    def test_split_avoids_peak(self):
+        start = datetime(2023, 6, 15, 16, 0)
+        sessions, kwh, total, average = optimal_charging_window(80, 6.6, start, timedelta(days=1))
+        # Every minute charged off-peak
+        self.assertAlmostEqual(average, 0.44)
+        self.assertAlmostEqual(total, kwh * 0.44)
+        self.assertEqual(sessions[0], (start, datetime(2023, 6, 15, 17, 0)))
+
+        _, _, contiguous, _ = optimal_charging_window(80, 6.6, start, timedelta(days=1), allow_split=False)
+        self.assertLessEqual(total, contiguous)
+
+    def test_too_long(self):
+        sessions, _, total, _ = optimal_charging_window(100, 1.0, datetime(2023, 6, 15), timedelta(hours=2))
+        self.assertEqual((sessions, total), ([], None))
+
+    def test_rejects_invalid_requests(self):
+        start = datetime(2023, 6, 15)
+        for soc_delta, power, horizon in ((20, 0, timedelta(hours=8)), (20, -6.6, timedelta(hours=8)),
+                                          (-20, 6.6, timedelta(hours=8)), (20, 6.6, timedelta(weeks=520))):
+            with self.subTest(soc_delta=soc_delta, power=power, horizon=horizon):
+                with self.assertRaises(ValueError):
+                    optimal_charging_window(soc_delta, power, start, horizon)
+
+
+class TariffTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plan = load_tariffs()['TOU-D']
+
+    def minute_price(self, moment):
+        peak_rate, offpeak_rate = self.plan.rates(moment.replace(hour=0, minute=0))
+        peak = self.plan.is_peak_day(moment.date()) and self.plan.peak_start <= moment.time() < self.plan.peak_end
+        return peak_rate if peak else offpeak_rate
+
+    def test_timeline_matches_brute_force(self):
+        timeline = self.plan.timeline(2023)
+        self.assertEqual(len(timeline), 365 * 1440)
+        for start, end in [(0, 1440), (151 * 1440 + 1000, 153 * 1440 + 100), (45678, 123456)]:
+            prices = [self.minute_price(datetime(2023, 1, 1) + timedelta(minutes=minute))
+                      for minute in range(start, end)]
+            self.assertAlmostEqual(timeline.cost(start, end), sum(prices))
+            self.assertEqual(list(timeline.minute_rates(start, end)), prices)
+
+    def test_price_session_across_days(self):
+        start, stop = datetime(2023, 12, 29, 16, 0), datetime(2024, 1, 2, 18, 30)
+        hours, peak_hours, average = price_session(self.plan, start, stop)
+        minutes = int((stop - start).total_seconds() // 60)
+        prices = [self.minute_price(start + timedelta(minutes=minute)) for minute in range(minutes)]
+        self.assertEqual(hours, minutes / 60)
+        # Friday Dec 29 and Monday/Tuesday Jan 1-2 have peak hours
+        self.assertEqual(peak_hours, 3 + 3 + 1.5)
+        self.assertAlmostEqual(average, sum(prices) / minutes)
+
+    def test_same_day_session_matches_ecost(self):
+        day = date(2023, 6, 15)
+        _, peak, _, _, hours, _, average = ecost_calculator(10, time(16), time(21, 30), today_ovrd=day)
+        session = price_session(self.plan, datetime(2023, 6, 15, 16), datetime(2023, 6, 15, 21, 30))
+        self.assertEqual(session[:2], (hours, peak))
+        self.assertAlmostEqual(session[2], average)
+
+    def test_compare_plans(self):
+        sessions = [(datetime(2023, 7, 3, 17), datetime(2023, 7, 3, 19), 10.0)]
+        self.assertEqual(list(compare_plans(sessions)), list(load_tariffs()))
+        self.assertAlmostEqual(compare_plans(sessions, ['TOU-D'])['TOU-D'], 10.0 * 0.56)
+
+
+class ColumnsTestCase(unittest.TestCase):
+    def test_columnwise_layout(self):
+        self.assertEqual(list_columns(['a', 'bb', 'c', 'd', 'e'], 2, gap=1).split('\n'),
+                         ['a  d  ', 'bb e  ', 'c     '])
+        self.assertEqual(list_columns([]), '')
+
+    def test_limit_only_consumes_what_is_printed(self):
+        items = count()
+        self.assertEqual(list_columns(items, 1, limit=3).split(), ['0', '1', '2'])
+        self.assertEqual(next(items), 3)
+
+    def test_max_chars_drops_whole_rows(self):
+        full = list_columns(range(100), 4)
+        capped = list_columns(range(100), 4, max_chars=100)
+        self.assertLessEqual(len(capped), 100)
+        self.assertTrue(full.startswith(capped))
+        # n rows of width w take n * w + (n - 1) characters
+        self.assertEqual(len(capped.split('\n')), 101 // (len(full.split('\n')[0]) + 1))
+
+    def test_write_lines(self):
+        stream = StringIO()
+        self.assertEqual(write_lines(iter(['a', 'b', 'c']), stream), 3)
+        self.assertEqual(stream.getvalue(), 'a\nb\nc')
+
+
+class IncrementalTestCase(unittest.TestCase):
+    def batch(self, word, allow_homographs=False):
+        phoneme_dict, grapheme_dict = load_nemes('spellinator/en/phonemes.csv')
+        weight_dict = load_weights('spellinator/en/weights.csv')
+        SequenceNode.target_length = len(word)
+        spellings, _ = true_translate(reverse_translate(word, grapheme_dict.values()), phoneme_dict, weight_dict,
+                                      allow_homographs=allow_homographs, stack_limit=10 ** 9,
+                                      weight_table=load_weight_table('spellinator/en/weights.csv', weight_dict))
+        return spellings
+
+    def test_matches_batch_engine_while_typing(self):
+        for allow_homographs in (False, True):
+            speller = load_speller(allow_homographs=allow_homographs, max_work=10 ** 9)
+            for end in range(1, len('phone') + 1):
+                self.assertEqual(speller.update('phone'[:end]), self.batch('phone'[:end], allow_homographs))
+            self.assertFalse(speller.truncated)
+
+    def test_backspace_reuses_prefix(self):
+        speller = load_speller(max_work=10 ** 9)
+        speller.update('knigt')
+        frontier = speller.frontiers[2]
+        self.assertEqual(speller.update('Knight'), self.batch('knight'))
+        self.assertIs(speller.frontiers[2], frontier)
+        self.assertEqual(speller.update('kn'), self.batch('kn'))
+        self.assertEqual(speller.update(''), set())
+
+    def test_work_cap(self):
+        speller = load_speller(max_work=50)
+        spellings = speller.update('arthur')
+        self.assertTrue(speller.truncated)
+        self.assertEqual(speller.work, 50)
+        self.assertTrue(spellings <= self.batch('arthur'))
+
+    def test_truncated_frontiers_are_expanded_again(self):
+        speller = load_speller(max_work=50)
+        speller.update('arthu')
+        self.assertTrue(speller.truncated)
+        speller.max_work = 10 ** 9
+        self.assertEqual(speller.update('arthur'), self.batch('arthur'))
+        self.assertFalse(speller.truncated)
+
+
+class WeightTableTestCase(unittest.TestCase):
+    def test_window_matches_string_scoring(self):
+        weight_dict = generate_weights('spellinator/en/weights.csv')
+        table = WeightTable(weight_dict, context_window=3)
+        for window in [('r', 'r', 'th'), ('c', 'a', 't'), ('ll', 'm', 'o'), ('k', 'c', 'k')]:
+            self.assertEqual(table[window], sequence_weight(''.join(window), sorted(weight_dict.items())))
+
+        self.assertEqual(len(table), 4)
+        table[('c', 'a', 't')]
+        self.assertEqual(len(table), 4)
+
+    def test_context_window(self):
+        weight_dict = generate_weights('spellinator/en/weights.csv')
+        self.assertEqual(WeightTable(weight_dict, context_window=2).score(('r', 'r', 'r')), 0.5)
+        self.assertEqual(WeightTable(weight_dict, context_window=3).score(('r', 'r', 'r')), 0.0)
+        with self.assertRaises(ValueError):
+            WeightTable(weight_dict, context_window=0)
+
+    def test_edited_file_rebuilds_table(self):
+        with TemporaryDirectory() as tmp:
+            weights = Path(tmp, 'weights.csv')
+            weights.write_text('0.5,"rr"\n')
+            table = load_weight_table(weights, load_weights(weights))
+            self.assertEqual(table.score(('r', 'r')), 0.5)
+            self.assertIs(load_weight_table(weights, load_weights(weights)), table)
+
+            weights.write_text('0.25,"rr"\n')
+            # Same size and a coarse clock could leave the modification time unchanged
+            os.utime(weights, ns=(0, 0))
+            table = load_weight_table(weights, load_weights(weights))
+            self.assertEqual(table.score(('r', 'r')), 0.25)
+
+
+class SpellStatsTestCase(unittest.TestCase):
+    def test_run_reports_stats(self):
+        received = []
+        printer, stats = run(['cat', '-s', '50'], stats_hook=received.append)
+        self.assertEqual(received, [stats])
+        self.assertEqual(stats.word, 'cat')
+        self.assertGreater(stats.segmentation_nodes, 0)
+        self.assertGreater(stats.transcription_nodes, 0)
+        self.assertGreater(stats.results, 0)
+        self.assertEqual(set(stats.timings), set(SpellStats.stages))
+        self.assertEqual(stats.rejections,
+                         stats.length_rejections + stats.weight_rejections + stats.final_rejections)
+
+    def test_openmetrics(self):
+        stats = SpellStats('a"b')
+        stats.length_rejections = 3
+        text = stats.to_openmetrics()
+        self.assertTrue(text.endswith('# EOF\n'))
+        self.assertIn('spellinator_rejections{word="a\\"b",reason="length"} 3', text)
+
+
+class RunAsyncTestCase(unittest.TestCase):
+    def spellings(self, printer_stats):
+        return set(printer_stats[0].split())
+
+    def test_matches_run(self):
+        argv = ['phone', '-s', '100000', '--limit', '100000']
+        self.assertEqual(self.spellings(asyncio.run(run_async(argv, yield_every=10))), self.spellings(run(argv)))
+
+    def test_interleaved_requests(self):
+        async def both():
+            return await asyncio.gather(run_async(['cat', '-s', '100000', '-a', '--limit', '100000'], yield_every=5),
+                                        run_async(['phone', '-s', '100000', '-a', '--limit', '100000'],
+                                                  yield_every=5))
+
+        cat, phone = asyncio.run(both())
+        self.assertEqual(self.spellings(cat), self.spellings(run(['cat', '-s', '100000', '-a', '--limit', '100000'])))
+        self.assertEqual(self.spellings(phone),
+                         self.spellings(run(['phone', '-s', '100000', '-a', '--limit', '100000'])))
+
+    def test_deadline_returns_partial_results(self):
+        argv = ['shelter', '-s', '100000', '--limit', '100000']
+        printer, stats = asyncio.run(run_async(argv, timeout=0.05, yield_every=10))
+        self.assertEqual(stats.interrupted, 'deadline')
+        self.assertLess(stats.results, run(argv)[1].results)
+        self.assertEqual(len(printer.split()), stats.results)
+
+    def test_cancel_keeps_loop_responsive(self):
+        recorded = []
+
+        async def cancel_later():
+            ticks = 0
+            task = asyncio.create_task(run_async(['shelter', '-s', '100000'], stats_hook=recorded.append,
+                                                 yield_every=10))
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+                ticks += 1
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return ticks
+
+        self.assertEqual(asyncio.run(cancel_later()), 5)
+        self.assertEqual([stats.interrupted for stats in recorded], ['cancelled'])
+
+    def test_timings_exclude_other_coroutines(self):
+        async def busy():
+            # Holds the loop between the engine's yields
+            for _ in range(20):
+                await asyncio.sleep(0)
+                sleep(0.005)
+
+        async def both():
+            spelled, _ = await asyncio.gather(run_async(['cat', '-s', '100000'], yield_every=1), busy())
+            return spelled
+
+        start = perf_counter()
+        _, stats = asyncio.run(both())
+        elapsed = perf_counter() - start
+        self.assertGreater(elapsed, 0.1)
+        self.assertLess(stats.total_time, elapsed - 0.08)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        latency = Histogram('latency_seconds', 'Latency.', ('command',), registry=registry, buckets=(0.1, 1.0))
+        errors = Counter('errors_total', 'Errors.', ('command',), registry=registry)
+        latency.observe(0.05, command='spell')
+        latency.observe(0.5, command='spell')
+        errors.inc(command='spell')
+
+        text = registry.render()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{command="spell",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{command="spell",le="+Inf"} 2', text)
+        self.assertIn('latency_seconds_count{command="spell"} 2', text)
+        self.assertIn('errors_total{command="spell"} 1', text)
+        self.assertEqual(latency.count(command='spell'), 2)
+
+        with self.assertRaises(ValueError):
+            errors.inc(cmd='spell')
+        with self.assertRaises(ValueError):
+            Counter('errors_total', 'Again.', registry=registry)
+
+    def test_weight_table_lookups_survive_rebuilds(self):
+        with TemporaryDirectory() as tmp:
+            weight_file = os.path.join(tmp, 'weights.csv')
+            with open(weight_file, 'w') as fp:
+                fp.write('2.0,ab\n')
+            table = load_weight_table(weight_file, {2.0: ['ab']})
+            collect_weight_tables()
+            before = weight_table_lookups.get()
+
+            table.score(('a', 'b'))
+            collect_weight_tables()
+            collect_weight_tables()
+            self.assertEqual(weight_table_lookups.get(), before + 1)
+
+            # An edited file replaces the table, whose lookups start again from zero
+            os.utime(weight_file, ns=(0, 0))
+            load_weight_table(weight_file, {2.0: ['ab']}).score(('a', 'b'))
+            collect_weight_tables()
+            self.assertEqual(weight_table_lookups.get(), before + 2)
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def test_estimate_matches_segmentation(self):
+        _, grapheme_dict = generate_nemes('spellinator/en/phonemes.csv')
+        for word in ('a', 'cat', 'arthur', 'queue'):
+            for fast_mode in (False, True):
+                stats = SpellStats(word)
+                reverse_translate(word, grapheme_dict.values(), fast_mode, stats)
+                self.assertEqual(estimate_segmentation(word, grapheme_dict.values(), fast_mode),
+                                 stats.segmentation_nodes)
+
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=1.0, capacity=2, clock=lambda: now[0])
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertAlmostEqual(bucket.retry_after(), 1.0)
+        self.assertEqual(bucket.retry_after(3), float('inf'))
+        now[0] = 1.5
+        self.assertTrue(bucket.consume())
+        self.assertAlmostEqual(bucket.tokens, 0.5)
+
+    def test_rate_limiter_keys(self):
+        now = [0.0]
+        limiter = RateLimiter(rate=1.0, capacity=1, max_keys=2, clock=lambda: now[0])
+        self.assertTrue(limiter.consume('a'))
+        self.assertFalse(limiter.consume('a'))
+        self.assertTrue(limiter.consume('b'))
+        now[0] = 5.0
+        limiter.consume('c')
+        self.assertEqual(set(limiter.buckets), {'c'})
+
+    def test_work_queue_sheds(self):
+        async def scenario():
+            queue = WorkQueue(workers=1, max_pending=2)
+            release = asyncio.Event()
+
+            async def hold():
+                async with queue.slot():
+                    await release.wait()
+
+            tasks = [asyncio.create_task(hold()) for _ in range(2)]
+            await asyncio.sleep(0)
+            self.assertEqual(len(queue), 2)
+            with self.assertRaises(QueueFull):
+                async with queue.slot():
+                    pass
+            release.set()
+            await asyncio.gather(*tasks)
+            self.assertEqual(len(queue), 0)
+
+        asyncio.run(scenario())
+
+    def test_costly_words_are_refused_not_crashed(self):
+        library = Library('spellinator/en')
+        self.assertLessEqual(1 + MAX_COST / COST_PER_TOKEN, user_limiter.capacity)
+        # Past what a user's bucket holds, but under the cost limit before it was derived from the bucket
+        cost = request_cost('eeeeeeeeeee', library)
+        self.assertGreater(1 + cost / COST_PER_TOKEN, user_limiter.capacity)
+        self.assertIn('too many possible pronunciations', admit('eeeeeeeeeee', 'costly-user', None, library))
+        self.assertIsNone(admit('cat', 'cheap-user', None, library))
+
+
+class BeatOfFourTestCase(unittest.TestCase):
+    syllables = [['ya', 'ee', 'ob', 'ra', 'ab', 'bo'], ['yes', 'abb', 'bar', 'ree', 'tot', 'lok']]
+    # Syllables that spell some names in several ways, Rokatrokat in four
+    overlapping = [['ta', 'ro', 'at', 'or', 'ka'], ['tar', 'ota', 'rok', 'kat']]
+
+    @staticmethod
+    def valid(seq):
+        joined = ''.join(seq).capitalize()
+        return seq[-1][-1] not in 'aeiou' and seq[0][0] != 'y' and not re.search(r'((\w)\2)+', joined)
+
+    def test_counts_match_rejection_sampling(self):
+        tables = BeatOfFourTables(self.syllables)
+        for twos, threes in tables.compositions:
+            expected = 0
+            for pattern in set(permutations([0] * twos + [1] * threes)):
+                expected += sum(map(self.valid, product(*[self.syllables[kind] for kind in pattern])))
+            _, cum_counts = tables.patterns[twos, threes]
+            self.assertEqual(cum_counts[-1], expected)
+
+    def test_batch_names_are_valid(self):
+        tables = BeatOfFourTables(self.syllables)
+        names = gen_beat_of_four_batch(tables, 500, random.Random(4))
+        self.assertEqual(len(names), 500)
+        for name in names:
+            self.assertNotRegex(name, r'((\w)\2)+')
+            self.assertNotIn(name[-1], 'aeiou')
+            self.assertNotEqual(name[0], 'Y')
+
+    def test_index_covers_space(self):
+        tables = BeatOfFourTables(self.syllables)
+        names = sorted(tables.name(index) for index in range(len(tables)))
+        expected = []
+        for twos, threes in tables.compositions:
+            for pattern in set(permutations([0] * twos + [1] * threes)):
+                expected.extend(''.join(seq).capitalize()
+                                for seq in product(*[self.syllables[kind] for kind in pattern]) if self.valid(seq))
+        self.assertEqual(names, sorted(expected))
+        with self.assertRaises(IndexError):
+            tables.name(len(tables))
+
+    def test_indices_invert_name(self):
+        tables = BeatOfFourTables(self.overlapping)
+        spellings = dict()
+        for index in range(len(tables)):
+            spellings.setdefault(tables.name(index), []).append(index)
+        for name, indices in spellings.items():
+            self.assertEqual(sorted(tables.indices(name)), indices)
+        self.assertLess(len(spellings), len(tables))
+
+    def test_pages_never_repeat_names(self):
+        tables = BeatOfFourTables(self.overlapping)
+        seen = []
+        names, cursor = page_beat_of_four(tables, 50)
+        seen.extend(names)
+        while cursor:
+            names, cursor = page_beat_of_four(tables, 50, cursor)
+            seen.extend(names)
+        self.assertEqual(sorted(seen), sorted(set(tables.name(index) for index in range(len(tables)))))
+
+    def test_unique_and_paging(self):
+        tables = BeatOfFourTables(self.syllables)
+        names = gen_unique_beat_of_four(tables, 100, random.Random(2))
+        self.assertEqual(len(names), len(set(names)))
+
+        seen = []
+        names, cursor = page_beat_of_four(tables, 50)
+        seen.extend(names)
+        while cursor:
+            names, cursor = page_beat_of_four(tables, 50, cursor)
+            seen.extend(names)
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(set(seen)), len(set(tables.name(index) for index in range(len(tables)))))
+        with self.assertRaises(ValueError):
+            page_beat_of_four(tables, 5, 'not a cursor')
+
+    def test_unique_past_distinct_names(self):
+        tables = BeatOfFourTables(self.syllables)
+        distinct = set(tables.name(index) for index in range(len(tables)))
+        # Asking for more names than exist returns every name instead of looping forever
+        names = gen_unique_beat_of_four(tables, len(tables) + 10, random.Random(3))
+        self.assertEqual(sorted(names), sorted(distinct))
+
+
+class BenchCompareTestCase(unittest.TestCase):
+    def test_flags_regressions(self):
+        baseline = {'main/cat/20': {'seconds': 1.0, 'peak_kib': 1000.0, 'nodes': 13, 'results': 42}}
+        self.assertEqual(compare({'main/cat/20': {'seconds': 1.1, 'peak_kib': 1100.0}}, baseline), [])
+        regressions = compare({'main/cat/20': {'seconds': 2.0, 'peak_kib': 1000.0}}, baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('seconds', regressions[0])
+        self.assertEqual(compare({'main/new/20': {'seconds': 9.0, 'peak_kib': 9.0}}, baseline), [])
+
+    def test_counts_must_match(self):
+        baseline = {'main/cat/20': {'seconds': 1.0, 'peak_kib': 1000.0, 'nodes': 13, 'results': 42},
+                    'import/spellinator.spellinator': {'seconds': 0.05, 'peak_kib': 0.0, 'nodes': 40, 'results': 0}}
+        same = {'main/cat/20': {'seconds': 0.5, 'peak_kib': 900.0, 'nodes': 13, 'results': 42},
+                'import/spellinator.spellinator': {'seconds': 0.05, 'peak_kib': 0.0, 'nodes': 30, 'results': 0}}
+        self.assertEqual(compare(same, baseline), [])
+        changed = {'main/cat/20': {'seconds': 0.5, 'peak_kib': 900.0, 'nodes': 13, 'results': 41},
+                   'import/spellinator.spellinator': {'seconds': 0.05, 'peak_kib': 0.0, 'nodes': 120, 'results': 0}}
+        regressions = compare(changed, baseline)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('results', regressions[0])
+        self.assertIn('nodes', regressions[1])
+
+    def test_worker_is_reproducible(self):
+        # knight reaches a stack limit of 20, so its results depend on the order the stack is visited in
+        first, second = [bench_process('spellinator/en', 'knight', [20], 0, repeat=1) for _ in range(2)]
+        for name in first:
+            self.assertEqual((first[name]['nodes'], first[name]['results']),
+                             (second[name]['nodes'], second[name]['results']))
+
+
+class ColdStartTestCase(unittest.TestCase):
+    def imported(self, module, *names):
+        code = f'import sys, {module}; print(*[name in sys.modules for name in {names!r}])'
+        proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        return dict(zip(names, (value == 'True' for value in proc.stdout.split())))
+
+    def test_engine_skips_optional_imports(self):
+        self.assertEqual(self.imported('spellinator.spellinator', 'yaml', 'numpy', 'pprint'),
+                         {'yaml': False, 'numpy': False, 'pprint': False})
+
+    def test_energy_cost_imports_numpy_lazily(self):
+        self.assertEqual(self.imported('extensions.energy_cost', 'numpy'), {'numpy': False})
+
+    def test_library_is_loaded_once(self):
+        phoneme_dict, grapheme_dict = load_nemes('spellinator/en/phonemes.csv')
+        self.assertIs(load_nemes('./spellinator/en/phonemes.csv')[0], phoneme_dict)
+        self.assertIn('', phoneme_dict)
+        # The null grapheme must never reach segmentation
+        self.assertNotIn('', grapheme_dict)
+
+    def test_script_prints_results(self):
+        script = os.path.join('spellinator', 'spellinator.py')
+        for extra in ([], ['--profile']):
+            proc = subprocess.run([sys.executable, script, 'cat', '-s', '100000', '--limit', '100000'] + extra,
+                                  capture_output=True, text=True, check=True)
+            if extra:
+                self.assertTrue(proc.stdout.startswith("Profile of 'cat'"))
+            else:
+                self.assertEqual(set(proc.stdout.split()),
+                                 set(run(['cat', '-s', '100000', '--limit', '100000'])[0].split()))
+
+
+class StoreTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        results = {('cat', False): 'kat  catt', ('cat', True): 'k a t -> kat', ('dog', False): ''}
+        with TemporaryDirectory() as tmp:
+            write_store(Path(tmp, 'test.store'), results, library='0123456789abcdef')
+            with ResultStore(Path(tmp, 'test.store')) as store:
+                self.assertEqual(len(store), 3)
+                self.assertEqual(store.params, list(STANDARD_ARGS))
+                self.assertEqual(store.library, '0123456789abcdef')
+                self.assertEqual(store.get('cat'), 'kat  catt')
+                self.assertEqual(store.get('Cat is here', True), 'k a t -> kat')
+                self.assertEqual(store.get('dog'), '')
+                self.assertIsNone(store.get('dog', True))
+                self.assertIsNone(store.get('bird'))
+                self.assertIn('CAT', store)
+
+    def test_warm_matches_run(self):
+        results = warm(['cat'], jobs=1, homographs=(False,))
+        self.assertEqual(list(results), [('cat', False)])
+        # The stack and result limits pick at random, so compare against every spelling
+        printer, _ = run(['cat'])
+        self.assertTrue(results['cat', False].split())
+        self.assertLessEqual(set(results['cat', False].split()), set(printer.split()))
+
+    def test_warm_spells_with_the_fingerprinted_library(self):
+        with TemporaryDirectory() as tmp:
+            directory = Path(tmp, 'en')
+            copytree('spellinator/en', directory)
+            with open(Path(directory, 'weights.csv'), 'a') as fp:
+                fp.write('\n0.0,"k"\n')
+            library = Library(directory)
+            for jobs in (1, 2):
+                results = warm(['cat'], jobs=jobs, homographs=(False,), library=library)
+                self.assertNotIn('k', results['cat', False])
+
+            Path(directory, 'weights.csv').write_text('0.5,"rr"\n')
+            with self.assertRaises(ValueError):
+                warm(['cat'], jobs=2, homographs=(False,), library=library)
+
+
+class LibraryRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.directory = Path(self.tmp.name, 'en')
+        copytree('spellinator/en', self.directory)
+        self.registry = LibraryRegistry()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def edit(self, name, data: bytes):
+        path = self.directory / name
+        path.write_bytes(data)
+        # Past any mtime granularity of the filesystem
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_reload_swaps_version(self):
+        library = self.registry.get(self.directory)
+        self.assertIs(self.registry.get(self.directory), library)
+        self.assertEqual(self.registry.poll(), {})
+
+        weights = (self.directory / 'weights.csv').read_bytes()
+        self.edit('weights.csv', weights)
+        self.assertEqual(self.registry.poll(), {})
+        self.assertIs(self.registry.get(self.directory), library)
+
+        self.edit('weights.csv', weights.rstrip() + b'\r\n0,"cat"\r\n')
+        reloaded = self.registry.poll()
+        new_library = self.registry.get(self.directory)
+        self.assertEqual(reloaded, {self.directory.resolve(): new_library})
+        self.assertNotEqual(new_library.fingerprint, library.fingerprint)
+        self.assertEqual(new_library.weight_dict[0] - library.weight_dict[0], {'cat'})
+
+        # A request pinned to the old version still spells with it
+        old_printer, _ = run(['cat', '-y', str(self.directory)], library=library)
+        new_printer, _ = run(['cat', '-y', str(self.directory)], library=new_library)
+        self.assertIn('cat', old_printer.split())
+        self.assertNotIn('cat', new_printer.split())
+
+    def test_broken_edit_keeps_version(self):
+        library = self.registry.get(self.directory)
+        self.edit('phonemes.csv', b'b,b\r\n')
+        reloaded = self.registry.poll()
+        self.assertIsInstance(reloaded[self.directory.resolve()], ValueError)
+        self.assertIs(self.registry.get(self.directory), library)
+        self.assertEqual(self.registry.poll(), {})
+
+
+class DiffTestCase(unittest.TestCase):
+    def test_corpus_is_reproducible(self):
+        library = Library('spellinator/sp')
+        corpus = generate_corpus(library, 5, seed=3)
+        self.assertEqual(corpus, generate_corpus(library, 5, seed=3))
+        self.assertEqual(len(set(corpus)), 5)
+        for word in corpus:
+            self.assertTrue(3 <= len(word) <= 8)
+            self.assertLessEqual(estimate_segmentation(word, library.grapheme_dict.values()), 400)
+
+    def test_engine_matches_reference(self):
+        for directory in ('spellinator/en', 'spellinator/sp'):
+            library = Library(directory)
+            for allow_homographs in (False, True):
+                report = diff_word(library, 'cat', allow_homographs)
+                self.assertEqual((report['missing'], report['extra']), ([], []))
+                self.assertFalse(report['limited'])
+
+    def test_leaves_shared_random_alone(self):
+        library = Library('spellinator/en')
+        state = random.getstate()
+        diff_word(library, 'phone', stack_limit=2)
+        self.assertEqual(random.getstate(), state)
+
+    def test_summary_ignores_stack_limited(self):
+        reports = [
+            {'missing': ['kat'], 'extra': [], 'limited': False, 'speedup': 2.0},
+            {'missing': [], 'extra': ['catt'], 'limited': True, 'speedup': 0.5},
+            {'missing': [], 'extra': [], 'limited': False, 'speedup': 1.0},
+        ]
+        summary = summarize(reports)
+        self.assertEqual((summary['compared'], summary['mismatches'], summary['limited']), (3, 1, 1))
+        self.assertAlmostEqual(summary['speedup'], 1.0)
+
+
+class ExhaustiveTestCase(unittest.TestCase):
+    def test_spill_merges_sorted_unique(self):
+        rng = random.Random(5)
+        items = [''.join(rng.choice('abc') for _ in range(rng.randint(1, 6))) for _ in range(3000)]
+        with SortedSpill(memory_cap=2048) as spill:
+            for item in items:
+                spill.add(item)
+            self.assertGreater(len(spill.runs), 64)
+            self.assertEqual(list(spill), sorted(set(items)))
+
+    def test_matches_reference(self):
+        library = Library('spellinator/en')
+        with TemporaryDirectory() as tmp:
+            output = Path(tmp, 'phone.txt')
+            for homographs in ([], ['-a']):
+                printer, stats = run(['phone', '--exhaustive', '--memory-cap', '0.01', '-o', str(output),
+                                      '--limit', '8'] + homographs)
+                expected, limited = reference.spell('phone', library.phoneme_dict, library.grapheme_dict,
+                                                    library.weight_dict, bool(homographs), stack_limit=10 ** 9)
+                spellings = output.read_text().split('\n')
+                self.assertEqual(spellings, sorted(expected))
+                self.assertEqual(stats.results, len(expected))
+                self.assertFalse(stats.stack_limited)
+                if not homographs:
+                    self.assertEqual(sorted(printer.split()), spellings[:8])
+
+    def test_segmentation_graph_shares_subtrees(self):
+        library = Library('spellinator/en')
+        weight_table = library.weight_table(3)
+
+        def transcriptions(roots, word):
+            return {tuple(map(str, seq)) for root in roots
+                    for seq in iter_transcriptions(root, library.phoneme_dict, weight_table, target_length=len(word))}
+
+        stats = SpellStats('shelter')
+        graph = segmentation_graph('shelter', library.grapheme_dict.values(), stats)
+        self.assertLess(stats.segmentation_nodes, estimate_segmentation('shelter', library.grapheme_dict.values()))
+        self.assertEqual(transcriptions(graph, 'shelter'),
+                         transcriptions(reverse_translate('shelter', library.grapheme_dict.values()), 'shelter'))
+
+        # A tree of 185,492 nodes
+        stats = SpellStats('transportation')
+        segmentation_graph('transportation', library.grapheme_dict.values(), stats)
+        self.assertLess(stats.segmentation_nodes, 100)
+
+
+class AnalyzeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.library = Library('spellinator/en')
+        self.model = CostModel(self.library.profile)
+
+    def test_stored_profiles_are_current(self):
+        # Fails when a library's phonemes change without re-running `python -m spellinator analyze`
+        for directory in ('spellinator/en', 'spellinator/sp'):
+            library = Library(directory)
+            with open(library.directory / PROFILE_NAME) as fp:
+                stored = json.load(fp)
+            self.assertEqual(stored, build_profile(library.phoneme_dict, library.grapheme_dict,
+                                                   library.profile_fingerprint), directory)
+
+    def test_profile_ignores_weights(self):
+        with TemporaryDirectory() as tmp:
+            copytree('spellinator/en', tmp, dirs_exist_ok=True)
+            with open(Path(tmp, 'weights.csv'), 'a') as fp:
+                fp.write('\n0.25,"qqqq"')
+            library = Library(tmp)
+            self.assertNotEqual(library.fingerprint, self.library.fingerprint)
+            self.assertEqual(library.profile_fingerprint, self.library.profile_fingerprint)
+            self.assertEqual(library.profile['fingerprint'], self.library.profile['fingerprint'])
+
+    def test_predictions_bound_the_engine(self):
+        for word in ('cat', 'phone', 'arthur', 'mississippi'):
+            prediction = self.model.predict(word)
+            self.assertEqual(prediction.segmentation_nodes,
+                             estimate_segmentation(word, self.library.grapheme_dict.values()))
+        for word in ('cat', 'phone', 'knight'):
+            _, stats = run([word, '-s', '1000000'])
+            self.assertFalse(stats.stack_limited)
+            self.assertLessEqual(stats.transcription_nodes, self.model.predict(word).work)
+            self.assertLessEqual(stats.results, self.model.predict(word).transcriptions)
+
+    def test_budget_chooses_parameters(self):
+        stack_limit, fast_mode, prediction = choose_parameters(self.model, 'phone', 10 ** 6, 20)
+        self.assertEqual((stack_limit, fast_mode), (prediction.work, False))
+        stack_limit, fast_mode, _ = choose_parameters(self.model, 'mississippi', 2000, 1000)
+        self.assertTrue(fast_mode)
+        self.assertLess(stack_limit, 1000)
+
+        # A budget covering the whole search gives complete results even with a tiny stack limit
+        expected, _ = reference.spell('phone', self.library.phoneme_dict, self.library.grapheme_dict,
+                                      self.library.weight_dict, stack_limit=10 ** 9)
+        with TemporaryDirectory() as tmp:
+            output = Path(tmp, 'phone.txt')
+            _, stats = run(['phone', '-s', '5', '--budget', '1000000', '-o', str(output)])
+            self.assertFalse(stats.stack_limited)
+            self.assertEqual(set(output.read_text().split('\n')), expected)
+
+    def test_worst_cases(self):
+        predictions = worst_cases(self.model, 5, count=3, beam=4)
+        self.assertEqual(len(predictions), 3)
+        self.assertTrue(all(len(prediction.word) == 5 for prediction in predictions))
+        self.assertGreater(predictions[0].work, self.model.predict('cat').work)
+        self.assertGreaterEqual(predictions[0].work, predictions[-1].work)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def test_report_covers_stages_and_hotspots(self):
+        with TemporaryDirectory() as tmp:
+            collapsed = Path(tmp, 'phone.folded')
+            report = profile_request(['phone', '-s', '1000000', '--profile', '--collapsed', str(collapsed)])
+            lines = collapsed.read_text().splitlines()
+
+        _, stats = run(['phone', '-s', '1000000'])
+        self.assertEqual(report.stats.results, stats.results)
+        self.assertGreater(report.memory.peak, 0)
+        self.assertGreater(report.memory.peaks['transcription'], 0)
+        summary = report.summary()
+        for name in SpellStats.stages + ('iter_reverse_translate', 'iter_transcribe', 'WeightTable.score',
+                                         'sequence_weight', 'list_columns'):
+            self.assertIn(name, summary)
+        self.assertTrue(lines)
+        self.assertTrue(all(re.fullmatch(r'\S[^;]*(;[^;]+)* \d+', line) for line in lines))
+        self.assertTrue(any('iter_transcribe' in line for line in lines))
+
+    def test_leaves_shared_random_alone(self):
+        random.seed(11)
+        expected = random.random()
+        random.seed(11)
+        # Stack limited, so the runs only do the same work if they shuffle alike
+        report = profile_request(['knight', '-s', '20', '--profile'], seed=3)
+        self.assertEqual(random.random(), expected)
+        self.assertTrue(report.stats.stack_limited)
+        self.assertEqual(report.memory.results, report.stats.results)
+        self.assertIn('whole process', report.summary())
+
+
 if __name__ == '__main__':
     unittest.main()